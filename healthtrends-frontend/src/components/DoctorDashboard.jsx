@@ -34,14 +34,16 @@ export default function DoctorDashboard() {
             try {
                 const session = await fetchAuthSession();
                 const token = session.tokens.idToken.toString();
-                const res = await axios.get(`${READ_URL}/trends/patient/${selectedPatientId}/available_tests`, { headers: { 'Authorization': token } });
-                setAvailableTests(res.data);
+                // Resumen precalculado: una lectura por PK (último valor, conteo, riesgo por examen)
+                const res = await axios.get(`${READ_URL}/trends/patient/${selectedPatientId}/summary`, { headers: { 'Authorization': token } });
+                const tests = res.data.tests;
+                setAvailableTests(tests);
                 
                 // Lógica para mantener o seleccionar el test por defecto
-                if (res.data.length > 0) {
-                    const currentTestStillAvailable = res.data.find(t => t.test_code === selectedTest);
+                if (tests.length > 0) {
+                    const currentTestStillAvailable = tests.find(t => t.test_code === selectedTest);
                     if (!selectedTest || !currentTestStillAvailable) {
-                        setSelectedTest(res.data[0].test_code);
+                        setSelectedTest(tests[0].test_code);
                     }
                 }
             } catch (err) { console.error(err); }
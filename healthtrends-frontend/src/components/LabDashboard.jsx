@@ -6,6 +6,15 @@ import PatientSearch from './PatientSearch';
 const INGEST_URL = import.meta.env.VITE_INGEST_URL;
 const READ_URL = import.meta.env.VITE_READ_URL;
 
+// Carga masiva por trabajos: filas por parte y dónde se recuerda el trabajo en curso
+const CHUNK_ROWS = 2000;
+const UPLOAD_JOB_KEY = 'labUploadJob';
+
+const sha256Hex = async (text) => {
+  const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(text));
+  return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+};
+
 export default function LabDashboard() {
   // Estados Generales
   const [loading, setLoading] = useState(false);
@@ -59,7 +68,7 @@ export default function LabDashboard() {
   useEffect(() => { loadCatalog(); }, []);
 
   // ---------------------------------------------------------
-  // A. VALIDACIÓN Y CARGA MASIVA (MICRO-LOTES)
+  // A. VALIDACIÓN Y CARGA MASIVA (TRABAJO POR PARTES, REANUDABLE)
   // ---------------------------------------------------------
   const validateAndUpload = async () => {
     setValidationErrors([]);
@@ -104,43 +113,92 @@ export default function LabDashboard() {
     }
 
     setLoading(true);
-    
-    // Batching agresivo para evitar Timeouts
-    const BATCH_SIZE = 50; 
-    const totalBatches = Math.ceil(parsedData.length / BATCH_SIZE);
-    let successCount = 0;
+
+    // Trabajo de carga por partes: cada parte se confirma con su SHA-256 y el servidor
+    // procesa todo en segundo plano. Si se cierra la pestaña, al volver a cargar el
+    // mismo JSON se retoma desde la última parte confirmada.
+    const chunks = [];
+    for (let i = 0; i < parsedData.length; i += CHUNK_ROWS) {
+        chunks.push(JSON.stringify(parsedData.slice(i, i + CHUNK_ROWS)));
+    }
 
     try {
         const session = await fetchAuthSession();
         const token = session.tokens.idToken.toString();
+        const headers = { 'Authorization': token };
+        const fingerprint = await sha256Hex(jsonText);
+
+        // ¿Hay un trabajo a medias con este mismo contenido?
+        let job = null;
+        const saved = JSON.parse(localStorage.getItem(UPLOAD_JOB_KEY) || "null");
+        if (saved?.fingerprint === fingerprint) {
+            try {
+                const res = await axios.get(`${READ_URL}/lab/upload-jobs/${saved.jobId}`, { headers });
+                job = res.data;
+            } catch (e) { job = null; }
+        }
+        if (!job || job.status === "done") {
+            job = (await axios.post(`${READ_URL}/lab/upload-jobs`, null, { headers })).data;
+            localStorage.setItem(UPLOAD_JOB_KEY, JSON.stringify({ jobId: job.job_id, fingerprint }));
+        } else if (job.next_chunk > 0) {
+            setStatus(`↩️ Retomando la carga desde la parte ${job.next_chunk + 1}/${chunks.length}...`);
+        }
 
-        for (let i = 0; i < totalBatches; i++) {
-            const start = i * BATCH_SIZE;
-            const end = start + BATCH_SIZE;
-            const batch = parsedData.slice(start, end);
-
-            const currentPercent = Math.round(((i) / totalBatches) * 100);
-            setStatus(`⏳ Enviando lote ${i + 1}/${totalBatches}... (${currentPercent}%)`);
-            setProgress(currentPercent);
-            
-            await axios.post(`${READ_URL}/lab/upload-results`, batch, {
-                headers: { 
-                    'Authorization': token,
-                    'Content-Type': 'application/json'
+        // 1. Subir las partes que falten (con reintentos ante cortes de red / 5xx)
+        if (job.status === "receiving") {
+            for (let i = job.next_chunk; i < chunks.length; i++) {
+                const currentPercent = Math.round((i / chunks.length) * 50);
+                setStatus(`⏳ Enviando parte ${i + 1}/${chunks.length}... (${currentPercent}%)`);
+                setProgress(currentPercent);
+                const checksum = await sha256Hex(chunks[i]);
+                for (let attempt = 1; ; attempt++) {
+                    try {
+                        await axios.put(`${READ_URL}/lab/upload-jobs/${job.job_id}/chunks/${i}`, chunks[i], {
+                            headers: { ...headers, 'Content-Type': 'application/json', 'X-Chunk-SHA256': checksum }
+                        });
+                        break;
+                    } catch (error) {
+                        const code = error.response?.status;
+                        if (attempt >= 3 || (code && code < 500)) throw error;
+                        await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+                    }
                 }
-            });
+            }
+        }
 
-            successCount += batch.length;
-            await new Promise(resolve => setTimeout(resolve, 100)); // Pausa técnica
+        // 2. Cerrar la recepción y esperar el procesamiento en segundo plano
+        if (job.status === "receiving" || job.status === "failed") {
+            job = (await axios.post(`${READ_URL}/lab/upload-jobs/${job.job_id}/complete`, null, {
+                headers, params: { total_chunks: chunks.length }
+            })).data;
+        }
+        while (job.status === "queued" || job.status === "processing") {
+            const done = job.chunks_received ? job.chunks_processed / job.chunks_received : 0;
+            setProgress(50 + Math.round(done * 50));
+            setStatus(`⚙️ Procesando en el servidor: ${job.rows_inserted} registros guardados...`);
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            job = (await axios.get(`${READ_URL}/lab/upload-jobs/${job.job_id}`, { headers })).data;
         }
 
+        if (job.status === "failed") {
+            setStatus(`❌ El procesamiento falló: ${job.error}. Vuelve a presionar "Validar y Cargar" para reintentar desde donde quedó.`);
+            return;
+        }
+        localStorage.removeItem(UPLOAD_JOB_KEY);
         setProgress(100);
-        setStatus(`✅ ¡Éxito Total! Se cargaron ${successCount} registros.`);
-        setJsonText(""); 
+        const extra = [];
+        if (job.rows_duplicate) extra.push(`${job.rows_duplicate} ya existían`);
+        if (job.rows_rejected) extra.push(`${job.rows_rejected} rechazados`);
+        setStatus(`✅ ¡Éxito Total! Se cargaron ${job.rows_inserted} registros${extra.length ? ` (${extra.join(', ')})` : ''}.`);
+        if (job.errors?.length) {
+            setValidationErrors(job.errors.slice(0, 10).map(e => e.row == null
+                ? `Parte ${e.chunk + 1}: ${e.error}`
+                : `Fila ${e.chunk * CHUNK_ROWS + e.row + 1}: ${e.error}`));
+        }
+        setJsonText("");
     } catch (error) {
         console.error(error);
-        setStatus("❌ Error en la subida: " + (error.response?.data?.detail || error.message));
-        if (successCount > 0) alert(`⚠️ Hubo un error, pero se lograron guardar los primeros ${successCount} registros.`);
+        setStatus("❌ Error en la subida: " + (error.response?.data?.detail || error.message) + ". Lo ya enviado se conserva: reintenta para continuar.");
     } finally {
         setLoading(false);
     }
@@ -34,11 +34,13 @@ export default function PatientDashboard({ user }) {
             try {
                 const session = await fetchAuthSession();
                 const token = session.tokens.idToken.toString();
-                const res = await axios.get(`${READ_URL}/trends/patient/${patientId}/available_tests`, {
+                // Resumen precalculado: una lectura por PK (último valor, conteo, riesgo por examen)
+                const res = await axios.get(`${READ_URL}/trends/patient/${patientId}/summary`, {
                     headers: { 'Authorization': token }
                 });
-                setAvailableTests(res.data);
-                if (res.data.length > 0) setSelectedTest(res.data[0].test_code);
+                const tests = res.data.tests;
+                setAvailableTests(tests);
+                if (tests.length > 0) setSelectedTest(tests[0].test_code);
             } catch (e) { console.error(e); }
         };
         loadTests();
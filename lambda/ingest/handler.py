@@ -1,5 +1,7 @@
 import json
+import logging
 import os
+import time
 import boto3
 
 # Terraform nos dará esta URL como una variable de entorno
@@ -8,12 +10,19 @@ SQS_QUEUE_URL = os.environ.get("SQS_QUEUE_URL")
 # Inicializar el cliente de SQS
 sqs_client = boto3.client("sqs")
 
+# Logs en JSON vía el formato nativo de Lambda (logging_config en lambda.tf);
+# el runtime ya agrega el requestId a cada línea.
+logger = logging.getLogger()
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
 def lambda_handler(event, context):
     """
     Punto de entrada para la Lambda de ingesta.
     Recibe un evento de API Gateway, lo valida y lo envía a SQS.
     """
-    print(f"Recibido evento: {event}")
+    # Ya no volcamos el evento completo (coste de CPU y de ingesta en CloudWatch)
+    correlation_id = event.get("requestContext", {}).get("requestId") or getattr(context, "aws_request_id", None)
+    logger.debug("Evento recibido", extra={"correlation_id": correlation_id, "body_bytes": len(event.get("body") or "")})
 
     # 1. Validar y obtener el cuerpo (body)
     try:
@@ -25,7 +34,7 @@ def lambda_handler(event, context):
         body = json.loads(body_str)
 
         if not body:
-            print("Cuerpo vacío recibido.")
+            logger.info("Cuerpo vacío recibido.", extra={"correlation_id": correlation_id})
             return {
                 "statusCode": 400, # 400 Bad Request
                 "body": json.dumps({"message": "Cuerpo de la solicitud vacío."})
@@ -39,13 +48,13 @@ def lambda_handler(event, context):
             }
 
     except json.JSONDecodeError:
-        print("Cuerpo JSON mal formado.")
+        logger.info("Cuerpo JSON mal formado.", extra={"correlation_id": correlation_id})
         return {
             "statusCode": 400,
             "body": json.dumps({"message": "Cuerpo JSON mal formado."})
         }
     except Exception as e:
-        print(f"Error al procesar el cuerpo: {e}")
+        logger.exception("Error al procesar el cuerpo: %s", e, extra={"correlation_id": correlation_id})
         return {
             "statusCode": 500,
             "body": json.dumps({"message": "Error interno del servidor."})
@@ -53,14 +62,21 @@ def lambda_handler(event, context):
 
     # 2. Enviar a SQS
     try:
-        print(f"Enviando mensaje a SQS: {SQS_QUEUE_URL}")
-        
+        # Momento en que API Gateway recibió el resultado (ms epoch): el worker mide con él
+        # el lag de punta a punta hasta el commit (SentTimestamp de SQS no incluye la Lambda)
+        enqueued_at = event.get("requestContext", {}).get("requestTimeEpoch") or int(time.time() * 1000)
+        message_attributes = {"enqueued_at": {"DataType": "Number", "StringValue": str(enqueued_at)}}
+        if correlation_id:
+            # El worker lo usa como correlation id en sus logs
+            message_attributes["correlation_id"] = {"DataType": "String", "StringValue": correlation_id}
+
         sqs_client.send_message(
             QueueUrl=SQS_QUEUE_URL,
-            MessageBody=json.dumps(body) # Enviamos el cuerpo validado
+            MessageBody=json.dumps(body), # Enviamos el cuerpo validado
+            MessageAttributes=message_attributes
         )
 
-        print("Mensaje enviado a SQS exitosamente.")
+        logger.debug("Mensaje enviado a SQS exitosamente.", extra={"correlation_id": correlation_id})
 
         # 3. Responder a API Gateway
         return {
@@ -76,7 +92,7 @@ def lambda_handler(event, context):
         }
 
     except Exception as e:
-        print(f"Error al enviar a SQS: {e}")
+        logger.exception("Error al enviar a SQS: %s", e, extra={"correlation_id": correlation_id})
         return {
             "statusCode": 500,
             "body": json.dumps({"message": "Error al encolar el mensaje."})
@@ -1,13 +1,18 @@
 import boto3
+import logging
 import os
 
 client = boto3.client('cognito-idp')
 
+# Logs en JSON vía el formato nativo de Lambda (logging_config en lambda.tf)
+logger = logging.getLogger()
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
 def lambda_handler(event, context):
     """
     Este código se ejecuta automáticamente cuando un usuario confirma su email.
     """
-    print(f"Evento recibido: {event}")
+    logger.debug("Evento recibido", extra={"trigger_source": event.get('triggerSource')})
     
     # Solo actuamos si el evento es de confirmación de registro
     if event['triggerSource'] == 'PostConfirmation_ConfirmSignUp':
@@ -15,7 +20,7 @@ def lambda_handler(event, context):
             user_pool_id = event['userPoolId']
             username = event['userName']
             
-            print(f"Asignando usuario {username} al grupo Patients...")
+            logger.info("Asignando usuario %s al grupo Patients...", username)
             
             client.admin_add_user_to_group(
                 UserPoolId=user_pool_id,
@@ -23,10 +28,10 @@ def lambda_handler(event, context):
                 GroupName='Patients'
             )
             
-            print("✅ Asignación exitosa.")
+            logger.info("Asignación exitosa.")
             
         except Exception as e:
-            print(f"❌ Error asignando grupo: {e}")
+            logger.exception("Error asignando grupo: %s", e)
             # No lanzamos error para no bloquear el login del usuario, 
             # pero queda registrado en los logs.
             
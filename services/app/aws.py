@@ -0,0 +1,33 @@
+import threading
+from .config import COGNITO_REGION, COGNITO_MAX_WORKERS
+
+# --- Clientes de AWS perezosos ---
+# Importar boto3 y crear un cliente cuesta cientos de ms (carga los modelos JSON del
+# servicio). Antes se pagaba al importar database.py / admin.py en cada worker y en
+# cada tarea nueva; ahora se crean en el primer uso, una sola vez por proceso
+# (los clientes de boto3 son thread-safe).
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service: str, **config):
+    client = _clients.get(service)
+    if client is None:
+        with _lock:
+            client = _clients.get(service)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                client = boto3.client(service, region_name=COGNITO_REGION, config=Config(**config) if config else None)
+                _clients[service] = client
+    return client
+
+
+def secrets_client():
+    return get_client("secretsmanager")
+
+
+def cognito_client():
+    # Un hilo del pool de cambios masivos = una conexión HTTP (el default de botocore es 10)
+    return get_client("cognito-idp", max_pool_connections=max(10, COGNITO_MAX_WORKERS))
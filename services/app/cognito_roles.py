@@ -0,0 +1,97 @@
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from .config import USER_POOL_ID, COGNITO_MAX_WORKERS, COGNITO_MAX_RETRIES
+from .metrics import COGNITO_CALLS
+
+logger = logging.getLogger(__name__)
+
+# --- Cambios de rol en Cognito (uno o muchos usuarios) ---
+# Cognito limita las APIs de administración por cuenta (unas decenas de RPS):
+# cada llamada se reintenta con backoff exponencial + jitter cuando responde
+# con throttling, y los lotes corren en un pool acotado de hilos
+# (COGNITO_MAX_WORKERS) para no disparar más throttling del que evitamos.
+
+THROTTLING_CODES = {"TooManyRequestsException", "ThrottlingException", "LimitExceededException", "InternalErrorException"}
+BACKOFF_BASE_SECONDS = 0.2
+BACKOFF_MAX_SECONDS = 5.0
+PAGE_SIZE = 60  # Máximo de list_users
+
+
+def call_with_retry(client, operation: str, **kwargs):
+    """client.<operation>(**kwargs) reintentando el throttling (full jitter)."""
+    for attempt in range(COGNITO_MAX_RETRIES + 1):
+        try:
+            response = getattr(client, operation)(**kwargs)
+            COGNITO_CALLS.labels(operation, "ok").inc()
+            return response
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code not in THROTTLING_CODES or attempt == COGNITO_MAX_RETRIES:
+                COGNITO_CALLS.labels(operation, "error").inc()
+                raise
+            COGNITO_CALLS.labels(operation, "throttled").inc()
+            time.sleep(random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)))
+
+
+def _email_of(cognito_user):
+    return next((a["Value"] for a in cognito_user.get("Attributes", []) if a["Name"] == "email"), None)
+
+
+def resolve_usernames(client, emails) -> dict:
+    """
+    email -> Username en UN barrido paginado del pool (en vez de un list_users filtrado
+    por usuario). Se corta en cuanto aparecen todos los emails pedidos.
+    """
+    pending = {e.lower(): e for e in emails}
+    found = {}
+    kwargs = {"UserPoolId": USER_POOL_ID, "Limit": PAGE_SIZE, "AttributesToGet": ["email"]}
+    while pending:
+        response = call_with_retry(client, "list_users", **kwargs)
+        for cognito_user in response.get("Users", []):
+            email = (_email_of(cognito_user) or "").lower()
+            if email in pending:
+                found[pending.pop(email)] = cognito_user["Username"]
+        if not response.get("PaginationToken"):
+            break
+        kwargs["PaginationToken"] = response["PaginationToken"]
+    return found
+
+
+def set_role(client, username: str, role: str) -> dict:
+    """Deja al usuario SOLO en `role` (evita que sea "Patient" y "Doctor" a la vez)."""
+    current = call_with_retry(client, "admin_list_groups_for_user", UserPoolId=USER_POOL_ID, Username=username)
+    old_roles = [g["GroupName"] for g in current.get("Groups", [])]
+    removed = [r for r in old_roles if r != role]
+    for old_role in removed:
+        call_with_retry(client, "admin_remove_user_from_group", UserPoolId=USER_POOL_ID, Username=username, GroupName=old_role)
+    if role not in old_roles:
+        call_with_retry(client, "admin_add_user_to_group", UserPoolId=USER_POOL_ID, Username=username, GroupName=role)
+    return {"removed": removed, "changed": bool(removed) or role not in old_roles}
+
+
+def _assign_one(client, email, role, username):
+    if username is None:
+        return {"email": email, "role": role, "status": "not_found", "detail": "Usuario no encontrado en Cognito."}
+    try:
+        outcome = set_role(client, username, role)
+    except ClientError as e:
+        logger.warning("Error cambiando rol de %s: %s", email, e)
+        return {"email": email, "role": role, "status": "error", "detail": str(e)}
+    return {
+        "email": email, "role": role, "status": "updated" if outcome["changed"] else "unchanged",
+        "removed": outcome["removed"],
+    }
+
+
+def assign_roles(client, assignments) -> list:
+    """
+    assignments: [(email, role)]. Resuelve los emails en un barrido y aplica los cambios
+    de grupo en paralelo. Devuelve un resultado por usuario, en el mismo orden.
+    """
+    usernames = resolve_usernames(client, [email for email, _ in assignments])
+    with ThreadPoolExecutor(max_workers=COGNITO_MAX_WORKERS) as pool:
+        futures = [pool.submit(_assign_one, client, email, role, usernames.get(email)) for email, role in assignments]
+        return [f.result() for f in futures]
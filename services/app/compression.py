@@ -0,0 +1,108 @@
+import gzip
+import anyio.to_thread
+from .config import COMPRESSION_MIN_BYTES, COMPRESSION_THREAD_MIN_BYTES
+
+try:
+    import brotli
+except ImportError:  # Sin brotli instalado solo ofrecemos gzip
+    brotli = None
+
+# --- Compresión de respuestas (brotli / gzip) ---
+# Middleware ASGI puro: solo comprime respuestas con Content-Length (JSON) que
+# superen COMPRESSION_MIN_BYTES. Las respuestas en streaming (SSE, descargas)
+# pasan tal cual, sin buffer. Los cuerpos grandes (historiales columnar, analytics)
+# se comprimen en un hilo: brotli/gzip de cientos de KB frenaría a todas las peticiones.
+
+COMPRESSIBLE_TYPES = ("application/json", "application/vnd.", "text/")
+GZIP_LEVEL = 5       # Buen balance CPU / tamaño para JSON
+BROTLI_QUALITY = 4   # Calidades altas son demasiado lentas para respuestas en línea
+
+
+def _choose_encoding(accept_encoding: str):
+    accepted = {part.split(";")[0].strip() for part in accept_encoding.lower().split(",")}
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def _merge_vary(headers: list) -> list:
+    """Un solo Vary con Accept-Encoding agregado a lo que ya variaba (p. ej. Accept)."""
+    tokens = []
+    for name, value in headers:
+        if name.lower() == b"vary":
+            tokens += [token.strip() for token in value.decode("latin-1").split(",") if token.strip()]
+    if "*" not in tokens and "accept-encoding" not in {token.lower() for token in tokens}:
+        tokens.append("Accept-Encoding")
+    return [(k, v) for k, v in headers if k.lower() != b"vary"] + [(b"vary", ", ".join(tokens).encode("latin-1"))]
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_BYTES, thread_size: int = COMPRESSION_THREAD_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.thread_size = thread_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope.get("headers") or [])
+        encoding = _choose_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+
+        start_message = None
+        passthrough = False
+        chunks = []
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                # Solo se juntan respuestas con Content-Length (cuerpo completo y acotado): los
+                # middlewares de Starlette las reenvían en varios pedazos, pero un stream SSE
+                # (sin Content-Length) no se puede retener
+                response_headers = {k.lower(): v for k, v in message["headers"]}
+                content_type = response_headers.get(b"content-type", b"").decode("latin-1")
+                length = response_headers.get(b"content-length")
+                passthrough = not (
+                    length is not None and length.isdigit() and int(length) >= self.minimum_size
+                    and b"content-encoding" not in response_headers
+                    and content_type.startswith(COMPRESSIBLE_TYPES)
+                    and not content_type.startswith("text/event-stream")
+                )
+                if passthrough:
+                    return await send(message)
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                return await send(message)
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(chunks)
+            if len(body) < self.minimum_size:  # HEAD, o un cuerpo que no llegó completo
+                await send(start_message)
+                return await send({"type": "http.response.body", "body": body})
+
+            if len(body) >= self.thread_size:
+                compressed = await anyio.to_thread.run_sync(_compress, body, encoding)
+            else:
+                compressed = _compress(body, encoding)
+            new_headers = [(k, v) for k, v in start_message["headers"] if k.lower() != b"content-length"]
+            new_headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(compressed)).encode()),
+            ]
+            await send(dict(start_message, headers=_merge_vary(new_headers)))
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
@@ -8,4 +8,87 @@ JWKS_URL = f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{USER_POOL_ID}/.
 DB_SECRET_ARN = os.environ.get("DB_SECRET_ARN")
 DB_HOST = os.environ.get("DB_HOST")
 DB_NAME = "postgres"
-DB_USER = "postgres"
\ No newline at end of file
+DB_USER = "postgres"
+
+# Réplicas de lectura (hosts separados por coma; vacío = todo va al primario). Solo sin DB_SHARDS
+DB_REPLICA_HOSTS = [h.strip() for h in os.environ.get("DB_REPLICA_HOSTS", "").split(",") if h.strip()]
+REPLICA_STICKY_SECONDS = float(os.environ.get("REPLICA_STICKY_SECONDS", "10"))
+REPLICA_COOLDOWN_SECONDS = float(os.environ.get("REPLICA_COOLDOWN_SECONDS", "30"))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", "5"))
+
+# Segundos que se reutiliza el secreto de la BD / las llaves JWKS antes de volver a pedirlos
+SECRET_CACHE_TTL = int(os.environ.get("SECRET_CACHE_TTL", "300"))
+JWKS_CACHE_TTL = int(os.environ.get("JWKS_CACHE_TTL", "3600"))
+
+# Log de queries lentas: umbral en ms, fracción de lentas a las que se les captura
+# el plan (EXPLAIN en un hilo y conexión aparte, ver query_log) y máximo de huellas SQL guardadas en memoria
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "200"))
+EXPLAIN_SAMPLE_RATE = float(os.environ.get("EXPLAIN_SAMPLE_RATE", "0.05"))
+QUERY_STATS_MAX = int(os.environ.get("QUERY_STATS_MAX", "500"))
+
+# Respuestas más chicas que esto no se comprimen (no vale la pena el CPU)
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+# ...y las más grandes que esto se comprimen en un hilo, sin frenar el event loop
+COMPRESSION_THREAD_MIN_BYTES = int(os.environ.get("COMPRESSION_THREAD_MIN_BYTES", str(64 << 10)))
+
+# Peso del último resultado en el EWMA del estado incremental de tendencia (0 < alpha < 1)
+TREND_EWMA_ALPHA = float(os.environ.get("TREND_EWMA_ALPHA", "0.3"))
+
+# Error relativo máximo de los percentiles de población (sketches por examen y mes)
+SKETCH_RELATIVE_ACCURACY = float(os.environ.get("SKETCH_RELATIVE_ACCURACY", "0.01"))
+
+# Notificaciones en vivo (SSE): "postgres" = LISTEN/NOTIFY (cubre worker y todas las
+# tareas del API), "memory" = solo lo publicado por este mismo proceso (desarrollo)
+NOTIFY_BACKEND = os.environ.get("NOTIFY_BACKEND", "postgres").lower()
+SSE_MAX_CLIENTS = int(os.environ.get("SSE_MAX_CLIENTS", "1000"))            # Streams abiertos por proceso
+SSE_MAX_PATIENTS = int(os.environ.get("SSE_MAX_PATIENTS", "200"))           # Pacientes por suscripción
+SSE_KEEPALIVE_SECONDS = float(os.environ.get("SSE_KEEPALIVE_SECONDS", "15"))  # < idle timeout del ALB (60 s)
+
+# Cambios de rol masivos en Cognito: hilos en paralelo, reintentos ante throttling y tope por petición
+COGNITO_MAX_WORKERS = int(os.environ.get("COGNITO_MAX_WORKERS", "8"))
+COGNITO_MAX_RETRIES = int(os.environ.get("COGNITO_MAX_RETRIES", "5"))
+BULK_ROLE_MAX_USERS = int(os.environ.get("BULK_ROLE_MAX_USERS", "1000"))
+
+# Límite por usuario (token bucket) según el tipo de ruta: "peticiones por segundo/ráfaga".
+# read = GET, write = POST/PUT/PATCH/DELETE, admin = /admin/*
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_READ = os.environ.get("RATE_LIMIT_READ", "20/40")
+RATE_LIMIT_WRITE = os.environ.get("RATE_LIMIT_WRITE", "5/20")
+RATE_LIMIT_ADMIN = os.environ.get("RATE_LIMIT_ADMIN", "2/10")
+# "Grupo.tipo=rate/ráfaga" separados por coma. USER = presupuesto de CADA usuario de ese grupo;
+# GROUP = presupuesto compartido por todo el grupo (los grupos sin entrada no tienen tope común)
+RATE_LIMIT_USER_BUDGETS = os.environ.get("RATE_LIMIT_USER_BUDGETS", "Labs.write=20/100")
+RATE_LIMIT_GROUP_BUDGETS = os.environ.get("RATE_LIMIT_GROUP_BUDGETS", "Labs.write=50/200")
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "10000"))  # Buckets en memoria por proceso
+
+# Descarte de carga: conexiones simultáneas a la BD por proceso, espera máxima por una y
+# espera media (en la ventana) a partir de la cual se rechazan peticiones nuevas con 503
+DB_MAX_CONCURRENCY = int(os.environ.get("DB_MAX_CONCURRENCY", "20"))
+DB_SLOT_TIMEOUT_SECONDS = float(os.environ.get("DB_SLOT_TIMEOUT_SECONDS", "2"))
+DB_WAIT_SHED_SECONDS = float(os.environ.get("DB_WAIT_SHED_SECONDS", "0.25"))
+DB_WAIT_WINDOW_SECONDS = float(os.environ.get("DB_WAIT_WINDOW_SECONDS", "5"))
+
+# /health/ready cachea el SELECT 1 contra la BD estos segundos (el ALB sondea cada pocos)
+READY_CHECK_CACHE_SECONDS = float(os.environ.get("READY_CHECK_CACHE_SECONDS", "5"))
+# Si el arranque falla (p. ej. RDS todavía no responde) se reintenta con backoff hasta este tope
+STARTUP_RETRY_MAX_SECONDS = float(os.environ.get("STARTUP_RETRY_MAX_SECONDS", "30"))
+
+# /metrics de Prometheus en un puerto interno aparte (como el worker), nunca en el del ALB.
+# 0 = desactivado
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+
+# Shards de pacientes: "nombre=host[:puerto][/bd]" separados por coma. Vacío = un solo shard
+# (DB_HOST / DB_NAME). El paciente se asigna por hash consistente del patient_id (sharding.py):
+# agregar un shard solo mueve ~1/N de los pacientes (ver `python -m app.rebalance`).
+DB_SHARDS = os.environ.get("DB_SHARDS", "")
+SHARD_VNODES = int(os.environ.get("SHARD_VNODES", "128"))                # Puntos por shard en el anillo
+SHARD_SCATTER_WORKERS = int(os.environ.get("SHARD_SCATTER_WORKERS", "8"))  # Consultas en paralelo por scatter
+
+# Cargas masivas por trabajos (upload_jobs.py): tamaño máximo de cada parte, filas por
+# transacción al procesar, hilos por proceso, segundos sin heartbeat para dar por muerto
+# un procesamiento (otra tarea lo retoma) y horas que se guarda un trabajo inactivo
+UPLOAD_CHUNK_MAX_BYTES = int(os.environ.get("UPLOAD_CHUNK_MAX_BYTES", str(5 << 20)))
+UPLOAD_JOB_TXN_ROWS = int(os.environ.get("UPLOAD_JOB_TXN_ROWS", "20000"))
+UPLOAD_JOB_WORKERS = int(os.environ.get("UPLOAD_JOB_WORKERS", "2"))
+UPLOAD_JOB_STALE_SECONDS = int(os.environ.get("UPLOAD_JOB_STALE_SECONDS", "300"))
+UPLOAD_JOB_TTL_HOURS = int(os.environ.get("UPLOAD_JOB_TTL_HOURS", "72"))
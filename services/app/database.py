@@ -1,52 +1,315 @@
-import boto3
+import hashlib
+import logging
+import time
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.extensions
 from fastapi import HTTPException
-from .config import DB_SECRET_ARN, DB_HOST, DB_NAME, DB_USER, COGNITO_REGION
+from .config import DB_SECRET_ARN, DB_NAME, DB_USER, SECRET_CACHE_TTL
+from .metrics import DB_CONNECT_SECONDS, DB_QUERY_SECONDS, DB_CONNECTIONS_IN_USE, DB_ROUTE, cache_hit, cache_miss
+from . import query_log, replicas, sharding
+from .aws import secrets_client
+from .throttling import db_slots
+from .versioning import ensure_version_tracking, VERSION_DDL
+from .trend_state import ensure_trend_state, TREND_STATE_DDL
+from .rollups import ensure_rollups, ROLLUP_DDL
+from .sketches import ensure_sketches, SKETCH_DDL
+from .reference_ranges import ensure_reference_ranges, REFERENCE_RANGES_DDL
+from .notifications import ensure_notifications, NOTIFY_DDL
+from .dedup import ensure_dedup, DEDUP_DDL
+from .upload_jobs import ensure_upload_jobs, UPLOAD_JOBS_DDL
+from .patient_summary import ensure_patient_summaries, PATIENT_SUMMARY_DDL
 
-secrets_client = boto3.client("secretsmanager", region_name=COGNITO_REGION)
+logger = logging.getLogger(__name__)
 
-def get_db_connection():
+# --- Cursores y conexiones instrumentadas (métricas de tiempo de query + log de lentas) ---
+class _TimedCursorMixin:
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        result = super().execute(query, vars)
+        self._observe(query, vars, time.perf_counter() - start, explainable=True)
+        return result
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        result = super().executemany(query, vars_list)
+        self._observe(query, None, time.perf_counter() - start, explainable=False)
+        return result
+
+    def _observe(self, query, vars, elapsed, explainable):
+        route = query_log.current_route()
+        DB_QUERY_SECONDS.labels(route).observe(elapsed)
+        query_log.record(self, query, vars, elapsed, route, explainable=explainable)
+
+_timed_cursor_classes = {}
+
+def _timed(cursor_factory):
+    """Devuelve (y cachea) la subclase cronometrada de cualquier cursor_factory (RealDictCursor, etc.)."""
+    cls = _timed_cursor_classes.get(cursor_factory)
+    if cls is None:
+        cls = type(f"Timed{cursor_factory.__name__}", (_TimedCursorMixin, cursor_factory), {})
+        _timed_cursor_classes[cursor_factory] = cls
+    return cls
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """Conexión que cronometra cada sentencia y lleva la cuenta de conexiones en uso."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        DB_CONNECTIONS_IN_USE.inc()
+        self._counted = True
+        self._slot = False  # True si ocupa un cupo de DB_MAX_CONCURRENCY (se libera en close)
+
+    def cursor(self, *args, cursor_factory=None, **kwargs):
+        factory = cursor_factory or self.cursor_factory or psycopg2.extensions.cursor
+        return super().cursor(*args, cursor_factory=_timed(factory), **kwargs)
+
+    def close(self):
+        if self._counted:
+            self._counted = False
+            DB_CONNECTIONS_IN_USE.dec()
+        if self._slot:
+            self._slot = False
+            db_slots.release()
+        super().close()
+
+# --- Caché del secreto (evita una llamada a Secrets Manager por petición) ---
+_secret_cache = {"value": None, "expires": 0.0}
+
+def get_db_password():
+    now = time.monotonic()
+    if _secret_cache["value"] and now < _secret_cache["expires"]:
+        cache_hit("db_secret")
+        return _secret_cache["value"]
+    cache_miss("db_secret")
+    response = secrets_client().get_secret_value(SecretId=DB_SECRET_ARN)
+    _secret_cache["value"] = response['SecretString']
+    _secret_cache["expires"] = now + SECRET_CACHE_TTL
+    return _secret_cache["value"]
+
+def _connect(host, connect_timeout=5, gated=True, port=None, dbname=DB_NAME):
+    if gated:
+        db_slots.acquire()  # 503 si no hay cupo a tiempo (throttling.DbSlots)
+    try:
+        with DB_CONNECT_SECONDS.time():
+            conn = psycopg2.connect(
+                host=host, port=port, database=dbname, user=DB_USER, password=get_db_password(), connect_timeout=connect_timeout,
+                connection_factory=InstrumentedConnection,
+            )
+    except Exception:
+        if gated:
+            db_slots.release()
+        raise
+    conn._slot = gated
+    return conn
+
+def get_db_connection(patient_id: str = None, gated: bool = True, shard=None):
+    """
+    Conexión al PRIMARIO (escrituras y lecturas que no toleran lag).
+    Va al shard del paciente (o al `shard` dado); sin ninguno de los dos, al primer shard,
+    que es donde se leen las tablas replicadas (sin sharding es la única BD).
+    gated=False no ocupa cupo de DB_MAX_CONCURRENCY (conexiones de larga vida, como el LISTEN).
+    """
+    if shard is None:
+        shard = sharding.shard_for(patient_id) if patient_id is not None else sharding.home_shard()
     try:
-        response = secrets_client.get_secret_value(SecretId=DB_SECRET_ARN)
-        password = response['SecretString']
-        return psycopg2.connect(
-            host=DB_HOST, database=DB_NAME, user=DB_USER, password=password, connect_timeout=5
-        )
+        conn = _connect(shard.host, gated=gated, port=shard.port, dbname=shard.dbname)
+        DB_ROUTE.labels("primary", shard.name).inc()
+        return conn
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error BD: {e}")
+        _secret_cache["value"] = None  # Por si el secreto rotó: lo volvemos a pedir en el próximo intento
+        logger.error("Error BD: %s", e)
         raise HTTPException(status_code=500, detail="Error de conexión a base de datos")
 
-def init_db():
-    """Ejecuta las migraciones iniciales al arrancar"""
-    print("🔄 Startup: Verificando tablas...")
+class ShardConnections:
+    """
+    Una conexión al primario por shard para escrituras que tocan varios (catálogo replicado,
+    lotes de varios pacientes). Se abren al primer get() y commit() confirma en todos al final:
+    si un shard rechaza su parte, rollback() deshace la de todos. (No es 2PC: un commit que
+    falla a mitad de la lista deja confirmados los anteriores.)
+    """
+
+    def __init__(self, gated: bool = True):
+        self._conns = {}
+        self._gated = gated
+
+    def get(self, shard):
+        conn = self._conns.get(shard)
+        if conn is None:
+            conn = self._conns[shard] = get_db_connection(gated=self._gated, shard=shard)
+        return conn
+
+    def commit(self):
+        for conn in self._conns.values():
+            conn.commit()
+
+    def rollback(self):
+        for conn in self._conns.values():
+            conn.rollback()
+
+    def close(self):
+        for conn in self._conns.values():
+            conn.close()
+        self._conns.clear()
+
+mark_write = replicas.mark_write  # Llamar tras un commit: las lecturas del usuario vuelven al primario un rato
+
+def get_read_connection(user: dict = None, patient_id: str = None, shard=None):
+    """
+    Conexión para endpoints de solo lectura: una réplica sana (round-robin) o,
+    si no hay / fallan todas / el usuario acaba de escribir, el primario.
+    Con sharding va siempre al primario del shard (DB_REPLICA_HOSTS es de la BD única).
+    """
+    if sharding.is_sharded():
+        return get_db_connection(patient_id, shard=shard)
+    if replicas.is_pinned(user):
+        return get_db_connection()
+    for host in replicas.candidates():
+        try:
+            conn = _connect(host, connect_timeout=2)
+        except HTTPException:
+            raise  # Sin cupo: la réplica no tiene la culpa
+        except Exception as e:
+            logger.warning("Réplica %s no disponible: %s", host, e)
+            replicas.mark_unhealthy(host)
+            continue
+        if replicas.needs_lag_check(host) and not replicas.lag_ok(conn):
+            logger.warning("Réplica %s con demasiado lag, se omite", host)
+            replicas.mark_unhealthy(host)
+            conn.close()
+            continue
+        DB_ROUTE.labels("replica", sharding.home_shard().name).inc()
+        return conn
+    return get_db_connection()
+
+BASE_TABLES_DDL = """
+CREATE TABLE IF NOT EXISTS lab_results (
+    id SERIAL PRIMARY KEY, patient_id VARCHAR(100), test_code VARCHAR(50), 
+    test_name VARCHAR(150), value NUMERIC(10, 2), unit VARCHAR(30), 
+    test_date TIMESTAMP, ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS patient_profiles (
+    patient_id VARCHAR(100) PRIMARY KEY, full_name VARCHAR(200), 
+    dob DATE, gender VARCHAR(20), email VARCHAR(255), 
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS test_types (
+    code VARCHAR(50) PRIMARY KEY, name VARCHAR(150), unit VARCHAR(50)
+);
+CREATE TABLE IF NOT EXISTS app_schema_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id), fingerprint VARCHAR(64) NOT NULL,
+    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# Huella de TODO el DDL: si la BD ya tiene esta versión, el arranque no toca el esquema.
+# (CREATE OR REPLACE TRIGGER toma un lock sobre lab_results en cada tarea que arranca)
+SCHEMA_FINGERPRINT = hashlib.sha256("".join([
+    BASE_TABLES_DDL, REFERENCE_RANGES_DDL, VERSION_DDL, TREND_STATE_DDL, ROLLUP_DDL, SKETCH_DDL, NOTIFY_DDL, DEDUP_DDL, UPLOAD_JOBS_DDL,
+    PATIENT_SUMMARY_DDL,
+]).encode()).hexdigest()
+SCHEMA_LOCK_KEY = 7301  # pg_advisory_lock: una sola tarea migra a la vez
+
+@contextmanager
+def _timed_step(steps: dict, name: str):
+    start = time.perf_counter()
     try:
-        conn = get_db_connection()
-        conn.autocommit = True
-        with conn.cursor() as cursor:
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS lab_results (
-                id SERIAL PRIMARY KEY, patient_id VARCHAR(100), test_code VARCHAR(50), 
-                test_name VARCHAR(150), value NUMERIC(10, 2), unit VARCHAR(30), 
-                test_date TIMESTAMP, ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """)
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS patient_profiles (
-                patient_id VARCHAR(100) PRIMARY KEY, full_name VARCHAR(200), 
-                dob DATE, gender VARCHAR(20), email VARCHAR(255), 
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """)
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS test_types (
-                code VARCHAR(50) PRIMARY KEY, name VARCHAR(150), unit VARCHAR(50)
-            );
-            """)
-            # Seed inicial
-            cursor.execute("SELECT COUNT(*) FROM test_types")
-            if cursor.fetchone()[0] == 0:
-                cursor.execute("INSERT INTO test_types VALUES ('HBA1C', 'Hemoglobina A1c', '%'), ('GLUCOSE', 'Glucosa', 'mg/dL') ON CONFLICT DO NOTHING;")
-        conn.close()
-        print("✅ Tablas verificadas.")
+        yield
+    finally:
+        steps[name] = round((time.perf_counter() - start) * 1000, 1)
+
+def init_db() -> dict:
+    """
+    Ejecuta las migraciones iniciales al arrancar, salvo que el esquema ya esté al día.
+    Devuelve el tiempo (ms) de cada paso para el readiness y benchmarks/startup.py.
+    Con sharding migra todos los shards en paralelo y devuelve el detalle de cada uno.
+    """
+    if not sharding.is_sharded():
+        return init_shard(sharding.home_shard())
+    results = sharding.scatter(init_shard, operation="init_db")
+    statuses = {result["schema"] for result in results}
+    schema = next(s for s in ("error", "migrated", "current") if s in statuses)
+    return {"schema": schema, "shards": {shard.name: r for shard, r in zip(sharding.all_shards(), results)}}
+
+def init_shard(shard) -> dict:
+    logger.info("Startup: Verificando tablas del shard %s...", shard.name)
+    steps = {}
+    try:
+        with _timed_step(steps, "connect"):
+            conn = get_db_connection(gated=False, shard=shard)
+        try:
+            return apply_schema(conn, steps)
+        finally:
+            conn.close()
     except Exception as e:
-        print(f"⚠️ Error no crítico en startup: {e}")
\ No newline at end of file
+        logger.warning("Error no crítico en startup: %s", e)
+        return {"schema": "error", "error": str(e), "steps": steps}
+
+def apply_schema(conn, steps: dict = None) -> dict:
+    """
+    Migra la BD de `conn` (cualquier conexión psycopg2) salvo que ya esté al día.
+    La usan init_shard y el benchmark del worker (processor/benchmark.py) contra un Postgres local.
+    """
+    steps = {} if steps is None else steps
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        with _timed_step(steps, "schema_lock"):
+            cursor.execute("SELECT pg_advisory_lock(%s)", (SCHEMA_LOCK_KEY,))
+        try:
+            if _applied_fingerprint(cursor) == SCHEMA_FINGERPRINT:
+                logger.info("Esquema al día (%s): no se ejecuta DDL.", SCHEMA_FINGERPRINT[:12])
+                return {"schema": "current", "steps": steps}
+            _migrate(cursor, steps)
+            cursor.execute("""
+                INSERT INTO app_schema_state (fingerprint) VALUES (%s)
+                ON CONFLICT (id) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, applied_at = CURRENT_TIMESTAMP
+            """, (SCHEMA_FINGERPRINT,))
+        finally:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (SCHEMA_LOCK_KEY,))
+    logger.info("Tablas verificadas.")
+    return {"schema": "migrated", "steps": steps}
+
+def _applied_fingerprint(cursor):
+    cursor.execute("SELECT to_regclass('app_schema_state') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return None
+    cursor.execute("SELECT fingerprint FROM app_schema_state")
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def _migrate(cursor, steps: dict):
+    with _timed_step(steps, "tables"):
+        cursor.execute(BASE_TABLES_DDL)
+        # Seed inicial
+        cursor.execute("SELECT COUNT(*) FROM test_types")
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("INSERT INTO test_types VALUES ('HBA1C', 'Hemoglobina A1c', '%'), ('GLUCOSE', 'Glucosa', 'mg/dL') ON CONFLICT DO NOTHING;")
+    # Rangos de referencia + bandera de anormal en lab_results
+    with _timed_step(steps, "reference_ranges"):
+        ensure_reference_ranges(cursor)
+    # Versión de datos por (paciente, examen) para ETag / 304
+    with _timed_step(steps, "versioning"):
+        ensure_version_tracking(cursor)
+    # Estado incremental (EWMA / Welford / pendiente) por (paciente, examen)
+    with _timed_step(steps, "trend_state"):
+        ensure_trend_state(cursor)
+    # Pirámide de rollups (día / semana / mes / trimestre / año)
+    with _timed_step(steps, "rollups"):
+        ensure_rollups(cursor)
+    # Sketches de cuantiles de población por (examen, mes)
+    with _timed_step(steps, "sketches"):
+        ensure_sketches(cursor)
+    # NOTIFY al confirmar resultados (streams SSE)
+    with _timed_step(steps, "notifications"):
+        ensure_notifications(cursor)
+    # Llave de deduplicación + índice único (ingesta idempotente)
+    with _timed_step(steps, "dedup"):
+        ensure_dedup(cursor)
+    # Trabajos de carga masiva reanudables (partes + avance)
+    with _timed_step(steps, "upload_jobs"):
+        ensure_upload_jobs(cursor)
+    # Resumen por paciente (primer render del dashboard con una lectura por PK)
+    with _timed_step(steps, "patient_summary"):
+        ensure_patient_summaries(cursor)
@@ -0,0 +1,146 @@
+"""
+Llave de deduplicación de lab_results e ingesta idempotente.
+
+dedup_key es una columna generada: md5 de (paciente, examen, fecha, valor) tal como
+quedan guardados, así que la calcula Postgres en TODOS los caminos de escritura
+(worker, /lab/upload-results, rebalanceo) sin que ninguno tenga que acordarse. Un
+mensaje de SQS reentregado (el worker cayó entre el COMMIT y el delete) o un lote
+reenviado por el navegador trae el mismo contenido, y con el índice único el
+INSERT ... ON CONFLICT DO NOTHING lo descarta: los triggers (versiones, tendencias,
+rollups, sketches) nunca ven el duplicado.
+
+El índice único no se puede crear mientras la tabla tenga duplicados viejos: la
+migración lo crea solo si no hay; si los hay, este script los borra (deja el primero
+que entró, el de menor id) y después crea el índice. Mientras tanto los INSERT ...
+ON CONFLICT DO NOTHING siguen funcionando (sin índice simplemente no deduplican).
+
+Desde services/ (todos los shards de DB_SHARDS):
+    python -m app.dedup --dry-run --db-password postgres
+    python -m app.dedup --batch 5000
+"""
+import argparse
+import json
+import logging
+import time
+import psycopg2
+from . import sharding
+
+logger = logging.getLogger(__name__)
+
+DEDUP_DDL = """
+ALTER TABLE lab_results ADD COLUMN IF NOT EXISTS dedup_key CHAR(32) GENERATED ALWAYS AS (md5(
+    patient_id || '|' || test_code || '|' || COALESCE(EXTRACT(EPOCH FROM test_date)::text, '')
+    || '|' || COALESCE(value::text, '')
+)) STORED;
+"""
+INDEX_NAME = "idx_lab_results_dedup"
+CREATE_INDEX_SQL = f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {INDEX_NAME} ON lab_results (dedup_key)"
+HAS_DUPLICATES_SQL = """
+SELECT EXISTS (SELECT 1 FROM lab_results WHERE dedup_key IS NOT NULL GROUP BY dedup_key HAVING COUNT(*) > 1)
+"""
+
+# Una sola pasada (un sort) junta los id sobrantes; después se borran por lotes
+VICTIMS_SQL = """
+CREATE TEMP TABLE IF NOT EXISTS dedup_victims (id INTEGER PRIMARY KEY);
+TRUNCATE dedup_victims;
+INSERT INTO dedup_victims
+SELECT id FROM (
+    SELECT id, row_number() OVER (PARTITION BY dedup_key ORDER BY id) AS n
+    FROM lab_results WHERE dedup_key IS NOT NULL
+) ranked WHERE n > 1;
+"""
+# Un DELETE por lote = los triggers por sentencia corrigen tendencias / rollups / sketches una vez por lote
+DELETE_BATCH_SQL = """
+WITH batch AS (
+    DELETE FROM dedup_victims WHERE id IN (SELECT id FROM dedup_victims ORDER BY id LIMIT %s) RETURNING id
+)
+DELETE FROM lab_results WHERE id IN (SELECT id FROM batch)
+"""
+
+
+def _index_state(cursor):
+    """None si no existe, True si es válido, False si quedó inválido (CONCURRENTLY que falló)."""
+    cursor.execute("""
+        SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s
+    """, (INDEX_NAME,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _create_index(cursor) -> bool:
+    """CREATE UNIQUE INDEX CONCURRENTLY (requiere autocommit). False si aparecieron duplicados."""
+    if _index_state(cursor) is False:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}")
+    try:
+        cursor.execute(CREATE_INDEX_SQL)
+        return True
+    except psycopg2.errors.UniqueViolation:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}")
+        return False
+
+
+def ensure_dedup(cursor) -> str:
+    """
+    Columna generada + índice único si la tabla no tiene duplicados. Corre en la migración
+    de arranque (autocommit). Devuelve "indexed", o "pending" si falta correr `python -m app.dedup`.
+    """
+    cursor.execute(DEDUP_DDL)
+    if _index_state(cursor):
+        return "indexed"
+    cursor.execute(HAS_DUPLICATES_SQL)
+    if not cursor.fetchone()[0] and _create_index(cursor):
+        return "indexed"
+    logger.warning("lab_results tiene resultados duplicados: corre `python -m app.dedup` para crear %s", INDEX_NAME)
+    return "pending"
+
+
+def deduplicate(conn, batch: int, dry_run: bool = False, attempts: int = 3) -> dict:
+    """Borra los duplicados de un shard por lotes y crea el índice único."""
+    conn.autocommit = True
+    report = {"duplicates": 0, "deleted": 0, "indexed": False}
+    with conn.cursor() as cursor:
+        cursor.execute(DEDUP_DDL)
+        for _ in range(attempts):
+            cursor.execute(VICTIMS_SQL)
+            cursor.execute("SELECT COUNT(*) FROM dedup_victims")
+            found = cursor.fetchone()[0]
+            report["duplicates"] += found
+            if dry_run:
+                report["indexed"] = bool(_index_state(cursor))
+                return report
+            while True:
+                cursor.execute(DELETE_BATCH_SQL, (batch,))  # autocommit: cada lote se confirma solo
+                if cursor.rowcount == 0:
+                    break
+                report["deleted"] += cursor.rowcount
+            # Si entró un duplicado nuevo mientras tanto el índice falla: otra pasada
+            if _create_index(cursor):
+                report["indexed"] = True
+                break
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Borra resultados duplicados y crea el índice único de dedup_key")
+    parser.add_argument("--batch", type=int, default=5000, help="Filas borradas por transacción")
+    parser.add_argument("--dry-run", action="store_true", help="Solo contar los duplicados")
+    parser.add_argument("--db-password", help="Password directo en vez de Secrets Manager (desarrollo)")
+    args = parser.parse_args()
+    from . import database  # database importa este módulo (ensure_dedup)
+    if args.db_password:
+        database._secret_cache.update(value=args.db_password, expires=float("inf"))
+
+    results = {}
+    for shard in sharding.all_shards():
+        start = time.perf_counter()
+        conn = database.get_db_connection(gated=False, shard=shard)
+        try:
+            results[shard.name] = deduplicate(conn, args.batch, args.dry_run)
+        finally:
+            conn.close()
+        results[shard.name]["seconds"] = round(time.perf_counter() - start, 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,49 @@
-from fastapi import Header, HTTPException
+import time
+from fastapi import Header, HTTPException, Request
 from jose import jwt, JWTError
-import requests
-from .config import JWKS_URL, APP_CLIENT_ID, COGNITO_REGION, USER_POOL_ID
+from .config import JWKS_URL, APP_CLIENT_ID, COGNITO_REGION, USER_POOL_ID, JWKS_CACHE_TTL
+from .metrics import AUTH_SECONDS, cache_hit, cache_miss
+from .throttling import enforce_rate_limit
 
-async def get_current_user(authorization: str = Header(None)):
+# Caché de las llaves públicas de Cognito (antes se descargaban en CADA petición)
+_jwks_cache = {"keys": None, "expires": 0.0, "fetched": 0.0}
+JWKS_MIN_REFRESH_SECONDS = 60  # Un token con 'kid' desconocido no puede forzar descargas en cada petición
+
+def get_jwks(force_refresh: bool = False):
+    now = time.monotonic()
+    if force_refresh and now - _jwks_cache["fetched"] < JWKS_MIN_REFRESH_SECONDS:
+        force_refresh = False
+    if not force_refresh and _jwks_cache["keys"] is not None and now < _jwks_cache["expires"]:
+        cache_hit("jwks")
+        return _jwks_cache["keys"]
+    cache_miss("jwks")
+    import requests  # Solo hace falta al refrescar las llaves (~1 vez por hora): no en el arranque
+    _jwks_cache["keys"] = requests.get(JWKS_URL, timeout=5).json()["keys"]
+    _jwks_cache["expires"] = now + JWKS_CACHE_TTL
+    _jwks_cache["fetched"] = now
+    return _jwks_cache["keys"]
+
+def _find_rsa_key(keys, kid):
+    for key in keys:
+        if key["kid"] == kid:
+            return {"kty": key["kty"], "kid": key["kid"], "use": key["use"], "n": key["n"], "e": key["e"]}
+    return {}
+
+async def get_current_user(request: Request, authorization: str = Header(None)):
     if not authorization: raise HTTPException(status_code=401, detail="Falta header")
     token = authorization.replace("Bearer ", "")
-    try:
-        jwks = requests.get(JWKS_URL).json()
-        header = jwt.get_unverified_header(token)
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == header["kid"]:
-                rsa_key = {"kty": key["kty"], "kid": key["kid"], "use": key["use"], "n": key["n"], "e": key["e"]}
-        if not rsa_key: raise HTTPException(status_code=401, detail="Llave no encontrada")
-        
-        payload = jwt.decode(token, rsa_key, algorithms=["RS256"], audience=APP_CLIENT_ID, issuer=f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{USER_POOL_ID}")
-        return payload 
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Token inválido")
\ No newline at end of file
+    with AUTH_SECONDS.time():
+        try:
+            header = jwt.get_unverified_header(token)
+            rsa_key = _find_rsa_key(get_jwks(), header["kid"])
+            if not rsa_key:
+                # Puede que Cognito haya rotado las llaves: refrescamos una vez
+                rsa_key = _find_rsa_key(get_jwks(force_refresh=True), header["kid"])
+            if not rsa_key: raise HTTPException(status_code=401, detail="Llave no encontrada")
+            
+            payload = jwt.decode(token, rsa_key, algorithms=["RS256"], audience=APP_CLIENT_ID, issuer=f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{USER_POOL_ID}")
+        except JWTError:
+            raise HTTPException(status_code=401, detail="Token inválido")
+    # Presupuesto por usuario / grupo y tipo de ruta (429 + Retry-After si se agotó)
+    enforce_rate_limit(request, payload)
+    return payload
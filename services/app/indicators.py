@@ -0,0 +1,186 @@
+import math
+import re
+import numpy as np
+
+# --- Indicadores de tendencia vectorizados (NumPy) ---
+# La serie (paciente, examen) se carga UNA vez como dos arrays (epoch, valor) y
+# cada indicador es una pasada vectorizada sobre tiempos irregulares:
+#   sma:<ventana>   media móvil por TIEMPO (no por número de puntos), ventana (t - w, t]
+#   ewma:<vida media> suavizado exponencial con decaimiento según el tiempo transcurrido
+#   roc:<ventana>   tasa de cambio por mes: pendiente por mínimos cuadrados en la ventana
+#   zscore          desvío contra la línea base del propio paciente (su primer periodo)
+# Las ventanas se resuelven con sumas acumuladas + searchsorted: O(n log n) sin bucles por punto.
+
+DAY = 86400.0
+MONTH = 30.436875 * DAY
+WINDOW_UNITS = {"h": 3600.0, "d": DAY, "w": 7 * DAY, "m": MONTH, "y": 365.2425 * DAY}
+MAX_WINDOW = 10 * 365.2425 * DAY
+MAX_INDICATORS = 10
+DEFAULT_INDICATORS = "sma:30d,sma:90d,ewma:30d,roc:90d,zscore"
+DEFAULT_WINDOWS = {"sma": "30d", "ewma": "30d", "roc": "90d"}
+EWMA_BLOCK_TAUS = 500  # exp(500) cabe en float64: la serie se parte en bloques de ese largo
+
+SERIES_SQL = """
+SELECT EXTRACT(EPOCH FROM test_date)::float8, value::float8 FROM lab_results
+WHERE patient_id = %s AND test_code = %s AND value IS NOT NULL AND test_date IS NOT NULL
+ORDER BY test_date
+"""
+UNIT_SQL = """
+SELECT unit FROM lab_results WHERE patient_id = %s AND test_code = %s ORDER BY test_date DESC LIMIT 1
+"""
+
+_WINDOW_RE = re.compile(r"^(\d+(?:\.\d+)?)([hdwmy])$")
+
+
+def parse_window(text: str) -> float:
+    """'30d' -> segundos. Unidades: h, d, w, m (mes medio), y."""
+    match = _WINDOW_RE.match(text.strip().lower())
+    if not match:
+        raise ValueError(f"Ventana inválida: {text!r} (ej: 12h, 30d, 6w, 3m, 1y)")
+    seconds = float(match.group(1)) * WINDOW_UNITS[match.group(2)]
+    if not 0 < seconds <= MAX_WINDOW:
+        raise ValueError(f"Ventana fuera de rango: {text!r}")
+    return seconds
+
+
+def parse_indicators(spec: str) -> list:
+    """'sma:7d,ewma:30d,zscore' -> [(clave de salida, nombre, segundos | None)]"""
+    parsed = []
+    for item in spec.split(","):
+        item = item.strip().lower()
+        if not item:
+            continue
+        name, _, window = item.partition(":")
+        if name == "zscore":
+            parsed.append(("zscore", name, None))
+            continue
+        if name not in DEFAULT_WINDOWS:
+            raise ValueError(f"Indicador desconocido: {name!r}. Opciones: sma, ewma, roc, zscore")
+        window = window or DEFAULT_WINDOWS[name]
+        parsed.append((f"{name}_{window}", name, parse_window(window)))
+    if not parsed:
+        raise ValueError("Indica al menos un indicador")
+    if len(parsed) > MAX_INDICATORS:
+        raise ValueError(f"Máximo {MAX_INDICATORS} indicadores por petición")
+    return list({key: (key, name, w) for key, name, w in parsed}.values())  # Sin repetidos, en orden
+
+
+def load_series(cursor, patient_id, test_code):
+    """(epoch en segundos, valores, unidad del último resultado) de la serie completa."""
+    cursor.execute(SERIES_SQL, (patient_id, test_code))
+    rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 2)
+    cursor.execute(UNIT_SQL, (patient_id, test_code))
+    unit = cursor.fetchone()
+    return rows[:, 0].copy(), rows[:, 1].copy(), unit[0] if unit else None
+
+
+def _window_sums(t, window, *columns):
+    """Cantidad de puntos y suma de cada columna en la ventana (t_i - window, t_i] de cada i."""
+    idx = np.arange(1, len(t) + 1)
+    left = np.searchsorted(t, t - window, side="right")
+    sums = []
+    for column in columns:
+        cs = np.concatenate(([0.0], np.cumsum(column)))
+        sums.append(cs[idx] - cs[left])
+    return idx - left, sums
+
+
+def rolling_mean(t, v, window):
+    count, (total,) = _window_sums(t, window, v)
+    return total / count
+
+
+def ewma(t, v, halflife):
+    """
+    s_i = d_i s_(i-1) + (1 - d_i) v_i con d_i = exp(-(t_i - t_(i-1)) / tau).
+    Con u_i = s_i e^(x_i), x = (t - t_bloque) / tau, la recurrencia es una suma acumulada:
+    u_i = u_(i-1) + (e^(x_i) - e^(x_(i-1))) v_i.
+    """
+    tau = halflife / math.log(2)
+    n = len(t)
+    out = np.empty(n)
+    start, previous = 0, None
+    while start < n:
+        end = int(np.searchsorted(t, t[start] + EWMA_BLOCK_TAUS * tau, side="right"))
+        ex = np.exp((t[start:end] - t[start]) / tau)
+        if previous is None:
+            first = v[0]
+        else:
+            decay = math.exp(-(t[start] - t[start - 1]) / tau)
+            first = decay * previous + (1 - decay) * v[start]
+        u = first + np.concatenate(([0.0], np.cumsum(np.diff(ex) * v[start + 1:end])))
+        out[start:end] = u / ex
+        previous, start = out[end - 1], end
+    return out
+
+
+def rate_of_change(t, v, window):
+    """Pendiente (unidades por mes) de la recta de mínimos cuadrados en la ventana; NaN con < 2 fechas."""
+    x = (t - t[0]) / MONTH
+    count, (sx, sv, sxv, sxx) = _window_sums(t, window, x, v, x * v, x * x)
+    denominator = count * sxx - sx * sx
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (count * sxv - sx * sv) / denominator
+    slope[(count < 2) | (denominator <= 1e-9 * np.maximum(count * sxx, 1.0))] = np.nan
+    return slope
+
+
+def baseline_stats(t, v, baseline):
+    """Media y desvío de los resultados del primer periodo (`baseline` segundos) de la serie."""
+    mask = t <= t[0] + baseline
+    n = int(mask.sum())
+    if n < 3:
+        return {"n": n, "mean": None, "std": None, "until": float(t[0] + baseline)}
+    values = v[mask]
+    return {"n": n, "mean": float(values.mean()), "std": float(values.std(ddof=1)), "until": float(t[0] + baseline)}
+
+
+def zscore(v, baseline):
+    if not baseline["std"]:
+        return np.full(len(v), np.nan)
+    return (v - baseline["mean"]) / baseline["std"]
+
+
+def compute(t, v, indicators, baseline_window):
+    """Todos los indicadores pedidos sobre la serie completa -> ({clave: array}, línea base | None)."""
+    results, baseline = {}, None
+    for key, name, window in indicators:
+        if name == "sma":
+            results[key] = rolling_mean(t, v, window)
+        elif name == "ewma":
+            results[key] = ewma(t, v, window)
+        elif name == "roc":
+            results[key] = rate_of_change(t, v, window)
+        else:
+            baseline = baseline_stats(t, v, baseline_window)
+            results[key] = zscore(v, baseline)
+    return results, baseline
+
+
+def downsample(t, v, max_points):
+    """
+    Índices a conservar: el mínimo y el máximo de cada intervalo de tiempo (más el primer
+    y el último punto). A diferencia de promediar, los picos clínicos no desaparecen.
+    """
+    n = len(t)
+    if n <= max_points:
+        return np.arange(n)
+    buckets = max(1, (max_points - 2) // 2)
+    inner = np.arange(1, n - 1)
+    span = t[-1] - t[0] or 1.0
+    bucket = np.minimum(((t[inner] - t[0]) / span * buckets).astype(np.int64), buckets - 1)
+    order = inner[np.lexsort((v[inner], bucket))]  # Por intervalo y, dentro, por valor
+    sorted_bucket = bucket[order - 1]
+    edges = np.flatnonzero(np.diff(sorted_bucket)) + 1
+    firsts = np.concatenate(([0], edges))
+    lasts = np.concatenate((edges - 1, [len(order) - 1]))
+    return np.unique(np.concatenate(([0], order[firsts], order[lasts], [n - 1])))
+
+
+def select(t, v, start, end, max_points):
+    """(puntos en [start, end], índices a devolver) sobre la serie completa."""
+    lo = int(np.searchsorted(t, start, side="left")) if start is not None else 0
+    hi = int(np.searchsorted(t, end, side="right")) if end is not None else len(t)
+    if max_points and hi > lo:
+        return hi - lo, lo + downsample(t[lo:hi], v[lo:hi], max_points)
+    return max(hi - lo, 0), np.arange(lo, hi)
@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from .config import READY_CHECK_CACHE_SECONDS, STARTUP_RETRY_MAX_SECONDS
+from .database import init_db, get_db_connection
+from .metrics import start_metrics_server
+from . import notifications, sharding, upload_jobs
+
+logger = logging.getLogger(__name__)
+
+# --- Arranque en segundo plano, liveness y readiness ---
+# El proceso acepta conexiones apenas importa la app: las migraciones y el listener
+# LISTEN corren en un hilo. Mientras tanto /health/ready responde 503 (el ALB todavía
+# no le manda tráfico) y /health/live 200 (ECS no lo reinicia por lento).
+# Si falla (BD que todavía no responde, migración con error) se reintenta con backoff y
+# /health/ready lo informa como "failed" con el error.
+
+_PROCESS_START = time.monotonic()
+_state = {"ready": False, "warmup_ms": None, "init": None, "error": None, "attempts": 0}
+_ping_state = {"ok": False, "checked": 0.0, "error": None}
+_ping_lock = threading.Lock()
+
+
+def _init_errors(result) -> dict:
+    """{shard: error} de los shards que no pudieron migrar."""
+    shards = result.get("shards") or {sharding.home_shard().name: result}
+    return {name: r.get("error") for name, r in shards.items() if r["schema"] == "error"}
+
+
+def _start_once():
+    _state["init"] = init_db()
+    errors = _init_errors(_state["init"])
+    if errors:
+        raise RuntimeError(f"Migración fallida: {errors}")
+    # Un listener LISTEN/NOTIFY por shard y por proceso para los streams SSE
+    # (fuera de los cupos de DB_MAX_CONCURRENCY: la conexión vive lo que el proceso)
+    for shard in sharding.all_shards():
+        notifications.start(lambda shard=shard: get_db_connection(gated=False, shard=shard), shard.name)
+
+
+def _warm_up():
+    start = time.perf_counter()
+    delay = 1
+    while True:
+        _state["attempts"] += 1
+        try:
+            _start_once()  # Idempotente: el esquema ya migrado no se vuelve a tocar y cada listener arranca una vez
+            break
+        except Exception as e:
+            logger.exception("Falló el arranque (intento %d), se reintenta en %d s", _state["attempts"], delay)
+            _state["error"] = str(e)
+            time.sleep(delay)
+            delay = min(delay * 2, STARTUP_RETRY_MAX_SECONDS)
+    # Cargas masivas que quedaron a medias (tarea reiniciada / desplegada)
+    try:
+        upload_jobs.resume_pending()
+    except Exception as e:
+        logger.warning("No se pudieron retomar los trabajos de carga: %s", getattr(e, "detail", e))
+    _state["warmup_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    _state["error"] = None
+    _state["ready"] = True
+    logger.info("Arranque completo en %.0f ms (%s)", _state["warmup_ms"], _state["init"])
+
+
+def start():
+    start_metrics_server()
+    threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+
+def stop():
+    notifications.stop()
+
+
+def _ping(shard):
+    """None si el shard responde; si no, el motivo."""
+    try:
+        conn = get_db_connection(gated=False, shard=shard)  # Sin cupo: con la BD saturada igual responde
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        finally:
+            conn.close()
+        return None
+    except Exception as e:
+        return getattr(e, "detail", None) or str(e)
+
+
+def _database_ok() -> bool:
+    """
+    SELECT 1 contra el primario de cada shard, cacheado READY_CHECK_CACHE_SECONDS (el ALB
+    sondea seguido). Solo el primer shard (catálogo) decide: si cae otro, sus pacientes dan
+    500 pero sacar TODAS las tareas del ALB dejaría sin servicio también a los demás.
+    """
+    with _ping_lock:
+        now = time.monotonic()
+        if now - _ping_state["checked"] < READY_CHECK_CACHE_SECONDS:
+            return _ping_state["ok"]
+        errors = {
+            shard.name: error
+            for shard, error in zip(sharding.all_shards(), sharding.scatter(_ping, operation="ready_check"))
+            if error
+        }
+        _ping_state.update(ok=sharding.home_shard().name not in errors, error=errors or None, checked=now)
+        return _ping_state["ok"]
+
+
+def liveness() -> dict:
+    return {"status": "alive", "uptime_seconds": round(time.monotonic() - _PROCESS_START, 1)}
+
+
+def readiness():
+    """(listo?, detalle). Listo = terminó el arranque y la BD responde."""
+    detail = {"warmup_ms": _state["warmup_ms"], "init": _state["init"]}
+    if not _state["ready"]:
+        if _state["error"]:
+            return False, dict(detail, status="failed", error=_state["error"], attempts=_state["attempts"])
+        return False, dict(detail, status="starting")
+    ok = _database_ok()
+    errors = _ping_state["error"]
+    status = "degraded" if not ok else "partial" if errors else "ready"
+    return ok, dict(detail, status=status, database=errors or "ok")
@@ -0,0 +1,128 @@
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+
+# --- Logging estructurado (JSON) y no bloqueante ---
+# Los handlers escriben en una cola en memoria; un hilo (QueueListener) es el
+# único que toca stdout. Si la cola se llena, descartamos en vez de bloquear
+# la petición. Los logs "por petición/mensaje" se marcan con extra={"sample": True}
+# y se muestrean según su nivel (LOG_SAMPLE_RATES="DEBUG=0.01,INFO=0.1").
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATES = {
+    logging.getLevelName(level.strip().upper()): float(rate)
+    for level, rate in (
+        item.split("=") for item in os.environ.get("LOG_SAMPLE_RATES", "DEBUG=0.01,INFO=0.1").split(",") if item
+    )
+}
+
+correlation_id: ContextVar = ContextVar("correlation_id", default=None)
+
+_STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "correlation_id", "sample"}
+_listener = None
+dropped_records = 0
+
+
+def new_correlation_id() -> str:
+    return uuid.uuid4().hex
+
+
+class _ContextFilter(logging.Filter):
+    """Corre en el hilo que loguea: aplica el muestreo y captura el correlation id."""
+
+    def filter(self, record):
+        if getattr(record, "sample", False):
+            rate = LOG_SAMPLE_RATES.get(record.levelno, 1.0)
+            if rate < 1.0 and random.random() >= rate:
+                return False
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Resolvemos el mensaje y el traceback aquí (los args pueden cambiar después)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global dropped_records
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.correlation_id:
+            entry["correlation_id"] = record.correlation_id
+        # Campos extra: logger.info("...", extra={"patient_id": ...})
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def setup_logging():
+    """Configura el logger raíz una sola vez por proceso."""
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=False)
+    _listener.start()
+
+    handler = _NonBlockingQueueHandler(log_queue)
+    handler.addFilter(_ContextFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+
+
+def flush_logging(timeout: float = 2.0):
+    """Espera (con límite) a que el hilo de logging vacíe la cola."""
+    if _listener is None:
+        return
+    deadline = time.monotonic() + timeout
+    while not _listener.queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+async def correlation_middleware(request, call_next):
+    """Asigna un correlation id por petición (respeta X-Request-ID si viene) y lo devuelve en la respuesta."""
+    cid = request.headers.get("x-request-id") or new_correlation_id()
+    correlation_id.set(cid)
+    start = time.perf_counter()
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = cid
+    logging.getLogger("app.access").info(
+        "%s %s", request.method, request.url.path,
+        extra={"sample": True, "status": response.status_code, "duration_ms": round((time.perf_counter() - start) * 1000, 1)},
+    )
+    return response
@@ -1,10 +1,21 @@
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from .database import init_db
-from .routers import admin, catalog, patients, trends, lab
+from .logger import setup_logging, correlation_middleware
+from .metrics import metrics_middleware
+from .compression import CompressionMiddleware
+from .throttling import load_shedding_middleware
+from .routers import admin, catalog, patients, trends, lab, events
+from . import lifecycle
+
+setup_logging()  # Logs JSON por un hilo en segundo plano (nunca bloquean la petición)
 
 app = FastAPI(title="HealthTrends Enterprise API")
 
+# Descarte de carga: 503 + Retry-After si la espera por conexiones a la BD se dispara
+# (se registra antes que CORS para que el 503 lleve sus headers y el navegador lo vea)
+app.middleware("http")(load_shedding_middleware)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -14,10 +25,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Inicializar BD al arrancar
+# Compresión brotli/gzip para respuestas grandes (historiales largos)
+app.add_middleware(CompressionMiddleware)
+
+# Métricas Prometheus: latencia y conteo por ruta / código de estado
+# (el scraper las lee en METRICS_PORT, un puerto interno: ver metrics.start_metrics_server)
+app.middleware("http")(metrics_middleware)
+# Correlation id por petición (X-Request-ID) para todos los logs
+app.middleware("http")(correlation_middleware)
+
+# Migraciones + listener en segundo plano: el proceso no espera a la BD para levantar
 @app.on_event("startup")
 def startup_event():
-    init_db()
+    lifecycle.start()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    lifecycle.stop()
 
 # Registrar Rutas
 app.include_router(admin.router, prefix="/admin")       # Rutas de administración
@@ -25,7 +49,18 @@ app.include_router(catalog.router, prefix="/catalog")   # Ahora existirá /catal
 app.include_router(patients.router, prefix="/patients") # Ahora existirá /patients/profile
 app.include_router(trends.router, prefix="/trends")     # Para tendencias
 app.include_router(lab.router) # <--- AGREGAR ESTO
+app.include_router(events.router, prefix="/events")     # Streams SSE de resultados nuevos
 
 @app.get("/")
 def read_root():
-    return {"message": "HealthTrends Modular API is Running"}
\ No newline at end of file
+    return {"message": "HealthTrends Modular API is Running"}
+
+# Liveness (¿el proceso responde?) y readiness (¿puede atender?: arranque terminado + BD)
+@app.get("/health/live", include_in_schema=False)
+def health_live():
+    return lifecycle.liveness()
+
+@app.get("/health/ready", include_in_schema=False)
+def health_ready():
+    ready, detail = lifecycle.readiness()
+    return JSONResponse(detail, status_code=200 if ready else 503)
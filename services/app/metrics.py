@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from fastapi import Request
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from .config import METRICS_PORT
+from .query_log import current_scope
+
+logger = logging.getLogger(__name__)
+
+# --- Métricas Prometheus del API ---
+# Todas las etiquetas son de baja cardinalidad: usamos la PLANTILLA de la ruta
+# ("/trends/patient/{patient_id}/...") y nunca la URL real con IDs.
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Latencia por ruta",
+    ["method", "route"],
+)
+REQUEST_COUNT = Counter(
+    "http_requests_total", "Peticiones por ruta y código de estado",
+    ["method", "route", "status"],
+)
+
+DB_CONNECT_SECONDS = Histogram(
+    "db_connect_duration_seconds", "Tiempo en obtener una conexión (secreto + connect)",
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Tiempo de ejecución de sentencias SQL",
+    ["route"],
+)
+DB_ROUTE = Counter(
+    "db_connections_total", "Conexiones abiertas por destino",
+    ["target", "shard"],  # primary | replica ; nombre del shard (DB_SHARDS)
+)
+SHARD_SCATTER_SECONDS = Histogram(
+    "shard_scatter_duration_seconds", "Consultas a todos los shards en paralelo (hasta el más lento)",
+    ["operation"],
+)
+DB_CONNECTIONS_IN_USE = Gauge(
+    "db_connections_in_use", "Conexiones a la BD abiertas en este proceso",
+)
+
+AUTH_SECONDS = Histogram(
+    "auth_duration_seconds", "Validación del JWT (incluye descarga de JWKS si hace falta)",
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Aciertos / fallos de las cachés en memoria",
+    ["cache", "result"],
+)
+SSE_CLIENTS = Gauge(
+    "sse_clients", "Streams SSE abiertos en este proceso",
+)
+SSE_EVENTS = Counter(
+    "sse_events_total", "Eventos enviados a clientes SSE",
+    ["event"],  # results | resync
+)
+UPLOAD_JOB_ROWS = Counter(
+    "upload_job_rows_total", "Filas procesadas por los trabajos de carga masiva",
+    ["result"],  # inserted | duplicate | rejected
+)
+NOTIFY_LISTENER_UP = Gauge(
+    "notify_listener_up", "1 si la conexión LISTEN a la BD está activa",
+    ["shard"],
+)
+COGNITO_CALLS = Counter(
+    "cognito_calls_total", "Llamadas a la API de Cognito",
+    ["operation", "result"],  # ok | throttled | error
+)
+RATE_LIMITED = Counter(
+    "rate_limited_total", "Peticiones rechazadas con 429 por el token bucket",
+    ["route_class", "scope"],  # read | write | admin ; user | group
+)
+LOAD_SHED = Counter(
+    "load_shed_total", "Peticiones rechazadas con 503 para proteger la BD",
+    ["reason"],  # db_wait (espera media alta) | db_timeout (no hubo conexión a tiempo)
+)
+DB_SLOT_WAIT_SECONDS = Histogram(
+    "db_slot_wait_seconds", "Espera por un cupo de conexión a la BD (DB_MAX_CONCURRENCY)",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5),
+)
+DB_SLOT_WAIT_RECENT = Gauge(
+    "db_slot_wait_recent_seconds", "Espera media por un cupo en la ventana DB_WAIT_WINDOW_SECONDS",
+)
+DB_SLOT_WAITING = Gauge(
+    "db_slot_waiting", "Hilos esperando un cupo de conexión a la BD",
+)
+
+
+def cache_hit(cache: str):
+    CACHE_REQUESTS.labels(cache, "hit").inc()
+
+
+def cache_miss(cache: str):
+    CACHE_REQUESTS.labels(cache, "miss").inc()
+
+
+def scope_route_template(scope: dict) -> str:
+    route = scope.get("route")
+    if route is None:
+        return "unmatched"
+    # Según la versión de FastAPI, route.path puede venir sin el prefijo del router
+    # incluido ("/tests" en vez de "/catalog/tests"): lo recuperamos de la URL real.
+    path = scope.get("path", "")
+    n_prefix = path.rstrip("/").count("/") - route.path.rstrip("/").count("/")
+    prefix = "/".join(path.split("/")[:n_prefix + 1]) if n_prefix > 0 else ""
+    return prefix + route.path
+
+
+def route_template(request: Request) -> str:
+    return scope_route_template(request.scope)
+
+
+async def metrics_middleware(request: Request, call_next):
+    start = time.perf_counter()
+    current_scope.set(request.scope)  # Para etiquetar las queries con su ruta (query_log)
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = route_template(request)
+        REQUEST_LATENCY.labels(request.method, route).observe(time.perf_counter() - start)
+        REQUEST_COUNT.labels(request.method, route, str(status)).inc()
+
+
+_server_lock = threading.Lock()
+_server_started = False
+
+
+def start_metrics_server():
+    """
+    Expone /metrics en METRICS_PORT (0 = desactivado). Es un puerto aparte del de la API:
+    el security group solo deja entrar al ALB por el 80, así que el tráfico por ruta, las
+    tasas de error y el estado de las conexiones no quedan a la vista de cualquiera.
+    """
+    global _server_started
+    with _server_lock:
+        if not METRICS_PORT or _server_started:
+            return
+        try:
+            start_http_server(METRICS_PORT)
+            _server_started = True
+            logger.info("Métricas en :%d/metrics", METRICS_PORT)
+        except OSError as e:
+            logger.warning("No se pudo abrir el puerto de métricas %d: %s", METRICS_PORT, e)
@@ -1,9 +1,14 @@
 from pydantic import BaseModel
+from typing import List, Optional
+from datetime import datetime
 
 class RoleRequest(BaseModel):
     email: str
     role: str
 
+class BulkRoleRequest(BaseModel):
+    assignments: List[RoleRequest]
+
 class ProfileRequest(BaseModel):
     full_name: str
     dob: str
@@ -12,4 +17,19 @@ class ProfileRequest(BaseModel):
 class TestTypeRequest(BaseModel):
     code: str
     name: str
-    unit: str
\ No newline at end of file
+    unit: str
+
+class ReferenceRange(BaseModel):
+    sex: Optional[str] = None       # 'M' / 'F' / None = cualquiera
+    age_min: Optional[int] = None   # Años cumplidos, rango [age_min, age_max)
+    age_max: Optional[int] = None
+    low: Optional[float] = None
+    high: Optional[float] = None
+
+class LabResultItem(BaseModel):
+    patient_id: str
+    test_code: str
+    test_name: str
+    value: float
+    unit: str
+    test_date: datetime # ✅ Acepta fechas pasadas
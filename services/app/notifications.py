@@ -0,0 +1,247 @@
+import asyncio
+import json
+import logging
+import select
+import threading
+from .config import NOTIFY_BACKEND
+from .metrics import NOTIFY_LISTENER_UP
+
+logger = logging.getLogger(__name__)
+
+# --- Notificaciones en vivo de resultados (para los streams SSE) ---
+# Un trigger por SENTENCIA sobre lab_results hace pg_notify('lab_results', ...) con
+# los (paciente, examen) tocados. Postgres entrega el NOTIFY solo al hacer COMMIT (y
+# nunca tras un ROLLBACK), así que, igual que versioning.py, cubre el worker, el
+# upload y los borrados sin tocar esos caminos.
+# Cada proceso del API tiene UN solo listener (un hilo con una conexión LISTEN) y el
+# Broker reparte en memoria a todos los clientes suscritos a esos pacientes.
+
+CHANNEL = "lab_results"
+QUEUE_SIZE = 100            # Eventos pendientes por cliente; si se llena, se le pide un resync
+RECONNECT_MAX_SECONDS = 30  # Backoff máximo del listener al perder la conexión
+RESYNC = {"op": "resync"}   # "Pudiste perder eventos: vuelve a consultar"
+
+# pg_notify admite payloads de < 8000 bytes: se manda un NOTIFY por cada 20 series
+NOTIFY_DDL = """
+CREATE OR REPLACE FUNCTION notify_lab_results() RETURNS trigger AS $$
+DECLARE
+    ps VARCHAR[]; ts VARCHAR[]; ds TIMESTAMP[];
+    payload TEXT;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(patient_id), array_agg(test_code), array_agg(test_date) INTO ps, ts, ds FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(patient_id), array_agg(test_code), array_agg(test_date) INTO ps, ts, ds FROM old_rows;
+    ELSE
+        SELECT array_agg(patient_id), array_agg(test_code), array_agg(test_date) INTO ps, ts, ds FROM (
+            SELECT patient_id, test_code, test_date FROM old_rows UNION ALL SELECT patient_id, test_code, test_date FROM new_rows
+        ) k;
+    END IF;
+
+    FOR payload IN
+        SELECT json_build_object('op', lower(TG_OP), 'items', json_agg(json_build_object(
+                   'patient_id', p, 'test_code', t, 'count', c, 'last_date', d) ORDER BY p, t))::text
+        FROM (
+            SELECT p, t, COUNT(*) AS c, MAX(d) AS d, (ROW_NUMBER() OVER (ORDER BY p, t) - 1) / 20 AS chunk
+            FROM unnest(ps, ts, ds) AS k(p, t, d)
+            WHERE p IS NOT NULL
+            GROUP BY p, t
+        ) s
+        GROUP BY chunk
+    LOOP
+        PERFORM pg_notify('lab_results', payload);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER lab_results_notify_ins AFTER INSERT ON lab_results
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_lab_results();
+CREATE OR REPLACE TRIGGER lab_results_notify_del AFTER DELETE ON lab_results
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_lab_results();
+CREATE OR REPLACE TRIGGER lab_results_notify_upd AFTER UPDATE ON lab_results
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION notify_lab_results();
+"""
+
+
+def ensure_notifications(cursor):
+    """Crea la función + triggers de NOTIFY (no hay nada que rellenar hacia atrás)."""
+    cursor.execute(NOTIFY_DDL)
+
+
+class Subscription:
+    """Un cliente SSE: su cola de eventos vive en el event loop que lo atiende."""
+
+    def __init__(self, patient_ids, loop):
+        self.patient_ids = frozenset(patient_ids)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.overflowed = False
+
+    def _offer(self, event):
+        # Corre en el event loop. Un cliente lento no frena a los demás: se descarta y se le pide resync
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def offer(self, event):
+        """Seguro desde cualquier hilo (el listener publica desde el suyo)."""
+        self.loop.call_soon_threadsafe(self._offer, event)
+
+
+class Broker:
+    """Reparte los eventos a los clientes suscritos a cada paciente (índice paciente -> clientes)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_patient = {}
+
+    def subscribe(self, patient_ids) -> Subscription:
+        sub = Subscription(patient_ids, asyncio.get_running_loop())
+        with self._lock:
+            for patient_id in sub.patient_ids:
+                self._by_patient.setdefault(patient_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        with self._lock:
+            for patient_id in sub.patient_ids:
+                subs = self._by_patient.get(patient_id)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._by_patient[patient_id]
+
+    def publish(self, event: dict):
+        """event = {"op": ..., "items": [{"patient_id", "test_code", "count", "last_date"}]}."""
+        matched = {}
+        with self._lock:
+            for item in event.get("items", []):
+                for sub in self._by_patient.get(item.get("patient_id"), ()):
+                    matched.setdefault(sub, []).append(item)
+        for sub, items in matched.items():
+            sub.offer({"op": event.get("op"), "items": items})
+
+    def resync_all(self):
+        """Tras un corte del listener pudimos perder eventos: todos los clientes deben re-consultar."""
+        with self._lock:
+            subs = {sub for subs in self._by_patient.values() for sub in subs}
+        for sub in subs:
+            sub.offer(RESYNC)
+
+
+class MemoryBackend:
+    """Sin BD: solo llega lo que publique este mismo proceso (desarrollo / un solo proceso, sin worker)."""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def start(self, connect, name="default"):
+        pass
+
+    def stop(self):
+        pass
+
+    def publish(self, event: dict):
+        self.broker.publish(event)
+
+
+class PostgresBackend:
+    """
+    Un hilo por proceso y por shard con una conexión LISTEN; los NOTIFY los emite el
+    trigger de lab_results (cada shard notifica solo lo que se escribe en él).
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self._threads = {}
+        self._stop = threading.Event()
+
+    def start(self, connect, name="default"):
+        if name in self._threads:
+            return
+        self._stop.clear()
+        thread = threading.Thread(target=self._run, args=(connect, name), name=f"notify-listener-{name}", daemon=True)
+        self._threads[name] = thread
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads.values():
+            thread.join(timeout=5)
+        self._threads.clear()
+
+    def publish(self, event: dict):
+        pass  # El trigger ya publicó al hacer COMMIT (y también cubre al worker)
+
+    def _run(self, connect, name):
+        delay = 1
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+                NOTIFY_LISTENER_UP.labels(name).set(1)
+                if delay > 1:
+                    self.broker.resync_all()  # Reconexión: lo publicado mientras tanto se perdió
+                delay = 1
+                logger.info("Listener de notificaciones conectado (%s)", name)
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+            except Exception as e:
+                NOTIFY_LISTENER_UP.labels(name).set(0)
+                logger.warning("Listener de notificaciones (%s) caído, reintentando en %ss: %s", name, delay, e)
+                self._stop.wait(delay)
+                delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+            finally:
+                if conn is not None:
+                    conn.close()
+        NOTIFY_LISTENER_UP.labels(name).set(0)
+
+    def _dispatch(self, payload):
+        try:
+            self.broker.publish(json.loads(payload))
+        except (ValueError, AttributeError) as e:
+            logger.warning("Payload de notificación inválido: %s", e)
+
+
+broker = Broker()
+_BACKENDS = {"memory": MemoryBackend, "postgres": PostgresBackend}
+backend = _BACKENDS.get(NOTIFY_BACKEND, PostgresBackend)(broker)
+
+
+def start(connect, name="default"):
+    """Arranca el listener de un shard en este proceso. `connect` devuelve una conexión a su primario."""
+    backend.start(connect, name)
+
+
+def stop():
+    backend.stop()
+
+
+def results_event(op, rows) -> dict:
+    """Mismo formato que el trigger a partir de filas (patient_id, test_code, test_date)."""
+    series = {}
+    for patient_id, test_code, test_date in rows:
+        item = series.setdefault((patient_id, test_code), {
+            "patient_id": patient_id, "test_code": test_code, "count": 0, "last_date": None,
+        })
+        item["count"] += 1
+        if test_date is not None and (item["last_date"] is None or test_date > item["last_date"]):
+            item["last_date"] = test_date
+    items = [series[key] for key in sorted(series)]
+    for item in items:
+        item["last_date"] = item["last_date"].isoformat() if item["last_date"] else None
+    return {"op": op, "items": items}
+
+
+def publish(event: dict):
+    """Publicar desde el API tras un COMMIT (con el backend "postgres" no hace falta: lo hace el trigger)."""
+    backend.publish(event)
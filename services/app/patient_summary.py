@@ -0,0 +1,191 @@
+# --- Resumen por paciente para el primer render del dashboard ---
+# Una fila por paciente con un documento JSONB {test_code: {...}}: nombre y unidad,
+# último valor y fecha, cantidad de resultados, primera fecha, bandera de anormal del
+# último resultado, los últimos 6 valores y el nivel de riesgo que sale de ellos (misma
+# regla que /risk-analysis: promedio de los 3 últimos contra los 3 anteriores).
+# Triggers por SENTENCIA sobre lab_results la mantienen, como en trend_state.py:
+#   * INSERT en orden cronológico -> se fusiona con la entrada guardada, sin releer nada.
+#   * INSERT con fecha anterior a la última, UPDATE (p. ej. re-marcado de anormales) o
+#     DELETE -> se reconstruye solo la entrada de esa serie desde el historial.
+# `version` sube con cada cambio: el ETag sale de la misma lectura por PK.
+
+PATIENT_SUMMARY_DDL = """
+CREATE TABLE IF NOT EXISTS patient_summaries (
+    patient_id VARCHAR(100) PRIMARY KEY,
+    tests JSONB NOT NULL DEFAULT '{}',      -- {test_code: lab_summary_entry(...)}
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- recent = ultimos valores en orden cronologico (hasta 6). Umbrales de get_risk_analysis;
+-- risk_level ademas sube a WARNING si el ultimo resultado esta fuera de rango.
+CREATE OR REPLACE FUNCTION lab_summary_risk(recent DOUBLE PRECISION[], flag CHAR(1)) RETURNS jsonb AS $$
+    SELECT jsonb_build_object(
+        'trend', CASE WHEN c IS NULL THEN 'insufficient_data' WHEN c > 15 THEN 'worsening'
+                      WHEN c > 5 THEN 'worsening_gradual' WHEN c < -15 THEN 'improving' ELSE 'stable' END,
+        'alert_level', CASE WHEN c > 15 THEN 'CRITICAL' WHEN c > 5 THEN 'WARNING' WHEN c < -15 THEN 'INFO' ELSE 'none' END,
+        'change_percent', round(c::numeric, 2),
+        'risk_level', CASE WHEN c > 15 THEN 'CRITICAL' WHEN c > 5 OR flag IS NOT NULL THEN 'WARNING'
+                           WHEN c < -15 THEN 'INFO' ELSE 'none' END
+    )
+    FROM (SELECT CASE
+        WHEN cardinality(recent) < 6 THEN NULL
+        WHEN recent[1] + recent[2] + recent[3] = 0 THEN 0
+        ELSE (recent[4] + recent[5] + recent[6] - (recent[1] + recent[2] + recent[3]))
+             / (recent[1] + recent[2] + recent[3]) * 100
+    END AS c) x
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION lab_summary_entry(
+    test_name VARCHAR, unit VARCHAR, last_value DOUBLE PRECISION, last_date TIMESTAMP, flag CHAR(1),
+    n BIGINT, first_date TIMESTAMP, recent DOUBLE PRECISION[]
+) RETURNS jsonb AS $$
+    SELECT jsonb_build_object(
+        'test_name', test_name, 'unit', unit, 'last_value', last_value, 'last_date', last_date,
+        'abnormal_flag', flag, 'count', n, 'first_date', first_date, 'recent_values', to_jsonb(recent)
+    ) || lab_summary_risk(recent, flag)
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Ultimos 6 valores: los guardados (orden cronologico) seguidos de los nuevos (vienen del mas nuevo al mas viejo)
+CREATE OR REPLACE FUNCTION lab_summary_recent(old jsonb, new_desc DOUBLE PRECISION[]) RETURNS DOUBLE PRECISION[] AS $$
+    SELECT COALESCE(array_agg(v ORDER BY o), '{}') FROM (
+        SELECT v, o FROM (
+            SELECT x::float8 AS v, i AS o FROM jsonb_array_elements_text(COALESCE(old, '[]')) WITH ORDINALITY AS a(x, i)
+            UNION ALL
+            SELECT y, 1000000 - j FROM unnest(new_desc) WITH ORDINALITY AS b(y, j)
+        ) u ORDER BY o DESC LIMIT 6
+    ) last6
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Recalcula desde el historial la entrada de las series indicadas (las que ya no tienen
+-- resultados salen del documento). La fila queda aunque quede vacia: version no retrocede.
+CREATE OR REPLACE FUNCTION rebuild_patient_summaries(ps VARCHAR[], ts VARCHAR[]) RETURNS void AS $$
+BEGIN
+    INSERT INTO patient_summaries (patient_id)
+    SELECT DISTINCT p FROM unnest(ps) AS k(p) WHERE p IS NOT NULL ORDER BY 1
+    ON CONFLICT (patient_id) DO NOTHING;
+    PERFORM 1 FROM patient_summaries WHERE patient_id = ANY(ps) ORDER BY patient_id FOR UPDATE;
+
+    UPDATE patient_summaries d
+    SET tests = (d.tests - x.codes) || x.patch, version = d.version + 1, updated_at = CURRENT_TIMESTAMP
+    FROM (
+        SELECT k.p, array_agg(k.t) AS codes,
+               COALESCE(jsonb_object_agg(k.t, e.entry) FILTER (WHERE e.entry IS NOT NULL), '{}') AS patch
+        FROM (SELECT DISTINCT p, t FROM unnest(ps, ts) AS k(p, t) WHERE p IS NOT NULL AND t IS NOT NULL) k
+        -- LATERAL: index scans por serie sobre (patient_id, test_code, test_date)
+        LEFT JOIN LATERAL (
+            SELECT lab_summary_entry(l.test_name, l.unit, l.y, l.test_date, l.abnormal_flag, c.n, c.first_date, rc.recent) AS entry
+            FROM (
+                SELECT COUNT(*) AS n, MIN(r.test_date) AS first_date FROM lab_results r
+                WHERE r.patient_id = k.p AND r.test_code = k.t AND r.value IS NOT NULL AND r.test_date IS NOT NULL
+            ) c
+            CROSS JOIN LATERAL (
+                SELECT r.test_name, r.unit, r.value::float8 AS y, r.test_date, r.abnormal_flag FROM lab_results r
+                WHERE r.patient_id = k.p AND r.test_code = k.t AND r.value IS NOT NULL AND r.test_date IS NOT NULL
+                ORDER BY r.test_date DESC, r.id DESC LIMIT 1
+            ) l
+            CROSS JOIN LATERAL (
+                SELECT array_agg(z.y ORDER BY z.test_date, z.id) AS recent FROM (
+                    SELECT r.value::float8 AS y, r.test_date, r.id FROM lab_results r
+                    WHERE r.patient_id = k.p AND r.test_code = k.t AND r.value IS NOT NULL AND r.test_date IS NOT NULL
+                    ORDER BY r.test_date DESC, r.id DESC LIMIT 6
+                ) z
+            ) rc
+        ) e ON TRUE
+        GROUP BY k.p
+    ) x
+    WHERE d.patient_id = x.p;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_patient_summaries() RETURNS trigger AS $$
+DECLARE
+    stale_p VARCHAR[];
+    stale_t VARCHAR[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO patient_summaries (patient_id)
+        SELECT DISTINCT patient_id FROM new_rows
+        WHERE patient_id IS NOT NULL AND test_code IS NOT NULL AND value IS NOT NULL AND test_date IS NOT NULL
+        ORDER BY 1
+        ON CONFLICT (patient_id) DO NOTHING;
+        PERFORM 1 FROM patient_summaries WHERE patient_id IN (SELECT patient_id FROM new_rows) ORDER BY patient_id FOR UPDATE;
+
+        -- Cada serie se fusiona con su entrada si todos sus puntos nuevos van despues del ultimo;
+        -- si no, queda para reconstruir. Una sola escritura por paciente.
+        WITH valid AS (
+            SELECT * FROM new_rows
+            WHERE patient_id IS NOT NULL AND test_code IS NOT NULL AND value IS NOT NULL AND test_date IS NOT NULL
+        ), latest AS (
+            SELECT DISTINCT ON (patient_id, test_code) patient_id, test_code, test_name, unit,
+                   value::float8 AS y, test_date, abnormal_flag
+            FROM valid ORDER BY patient_id, test_code, test_date DESC, id DESC
+        ), series AS (
+            SELECT patient_id, test_code, COUNT(*) AS n, MIN(test_date) AS first_date,
+                   (array_agg(value::float8 ORDER BY test_date DESC, id DESC))[1:6] AS recent_desc
+            FROM valid GROUP BY patient_id, test_code
+        ), merged AS (
+            SELECT s.patient_id, s.test_code, s.n, s.first_date, s.recent_desc, l.test_name, l.unit, l.y,
+                   l.test_date, l.abnormal_flag, d.tests -> s.test_code AS e,
+                   s.first_date < ((d.tests -> s.test_code) ->> 'last_date')::timestamp AS stale
+            FROM series s
+            JOIN latest l USING (patient_id, test_code)
+            JOIN patient_summaries d ON d.patient_id = s.patient_id
+        ), applied AS (
+            UPDATE patient_summaries d
+            SET tests = d.tests || p.patch, version = d.version + 1, updated_at = CURRENT_TIMESTAMP
+            FROM (
+                SELECT patient_id, jsonb_object_agg(test_code, lab_summary_entry(
+                    test_name, unit, y, test_date, abnormal_flag,
+                    COALESCE((e ->> 'count')::bigint, 0) + n,
+                    LEAST(first_date, (e ->> 'first_date')::timestamp),
+                    lab_summary_recent(e -> 'recent_values', recent_desc)
+                )) AS patch
+                FROM merged WHERE stale IS NOT TRUE GROUP BY patient_id
+            ) p
+            WHERE d.patient_id = p.patient_id
+        )
+        SELECT array_agg(patient_id), array_agg(test_code) INTO stale_p, stale_t FROM merged WHERE stale;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(patient_id), array_agg(test_code) INTO stale_p, stale_t
+        FROM (SELECT DISTINCT patient_id, test_code FROM old_rows ORDER BY 1, 2) k;
+    ELSE
+        SELECT array_agg(patient_id), array_agg(test_code) INTO stale_p, stale_t FROM (
+            SELECT patient_id, test_code FROM old_rows UNION SELECT patient_id, test_code FROM new_rows ORDER BY 1, 2
+        ) k;
+    END IF;
+
+    IF cardinality(stale_p) > 0 THEN
+        PERFORM rebuild_patient_summaries(stale_p, stale_t);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER lab_results_summary_ins AFTER INSERT ON lab_results
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION update_patient_summaries();
+CREATE OR REPLACE TRIGGER lab_results_summary_del AFTER DELETE ON lab_results
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION update_patient_summaries();
+CREATE OR REPLACE TRIGGER lab_results_summary_upd AFTER UPDATE ON lab_results
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION update_patient_summaries();
+"""
+
+
+def ensure_patient_summaries(cursor):
+    """Crea la tabla + triggers. El backfill (todas las series) solo corre la primera vez."""
+    cursor.execute("SELECT to_regclass('patient_summaries') IS NULL")
+    first_time = cursor.fetchone()[0]
+    cursor.execute(PATIENT_SUMMARY_DDL)
+    if first_time:
+        cursor.execute("""
+            SELECT rebuild_patient_summaries(array_agg(patient_id), array_agg(test_code))
+            FROM (SELECT DISTINCT patient_id, test_code FROM lab_results) k
+        """)
+
+
+def summary_tests(tests: dict) -> list:
+    """Documento {test_code: entrada} -> lista ordenada por nombre (mismo orden que available_tests)."""
+    return [
+        dict({"test_code": code}, **entry)
+        for code, entry in sorted(tests.items(), key=lambda item: (item[1].get("test_name") or "", item[0]))
+    ]
@@ -0,0 +1,254 @@
+import csv
+import io
+import json
+import tempfile
+from datetime import date
+from anyio import from_thread
+from .sharding import home_shard, is_sharded, scatter, shard_for
+
+# --- Importación masiva de perfiles de paciente (CSV / NDJSON) ---
+# El cuerpo se lee en streaming (nunca entero en memoria), cada fila se valida en
+# Python y las válidas se mandan con COPY a una tabla temporal. Después, UN solo
+# INSERT ... ON CONFLICT por conjuntos las fusiona en patient_profiles.
+# Las celdas vacías NO borran lo que ya había en el perfil.
+# Con sharding cada fila va primero al archivo temporal de su shard y después cada
+# shard hace su COPY + merge en paralelo.
+
+FIELDS = ["patient_id", "full_name", "dob", "gender", "email"]
+MAX_LENGTHS = {"patient_id": 100, "full_name": 200, "gender": 20, "email": 255}
+MAX_REPORTED_ERRORS = 50  # Filas rechazadas que se devuelven con su motivo (el resto solo se cuenta)
+SPOOL_MAX_BYTES = 8 << 20  # Por shard: pasado esto el archivo temporal se va a disco
+
+STAGING_DDL = """
+CREATE TEMP TABLE profile_import (
+    line_no BIGINT NOT NULL, patient_id VARCHAR(100) NOT NULL, full_name VARCHAR(200),
+    dob DATE, gender VARCHAR(20), email VARCHAR(255)
+) ON COMMIT DROP;
+CREATE TEMP TABLE profile_import_touched (patient_id VARCHAR(100) NOT NULL) ON COMMIT DROP;
+"""
+
+# La última fila de cada paciente gana (un ON CONFLICT no puede tocar la misma fila dos veces).
+# (xmax = 0) distingue filas insertadas de actualizadas; las que no cambian no se reescriben.
+MERGE_SQL = """
+WITH latest AS (
+    SELECT DISTINCT ON (patient_id) patient_id, full_name, dob, gender, email
+    FROM profile_import ORDER BY patient_id, line_no DESC
+), merged AS (
+    INSERT INTO patient_profiles AS p (patient_id, full_name, dob, gender, email)
+    SELECT patient_id, full_name, dob, gender, email FROM latest
+    ON CONFLICT (patient_id) DO UPDATE SET
+        full_name = COALESCE(EXCLUDED.full_name, p.full_name), dob = COALESCE(EXCLUDED.dob, p.dob),
+        gender = COALESCE(EXCLUDED.gender, p.gender), email = COALESCE(EXCLUDED.email, p.email)
+    WHERE (p.full_name, p.dob, p.gender, p.email) IS DISTINCT FROM (
+        COALESCE(EXCLUDED.full_name, p.full_name), COALESCE(EXCLUDED.dob, p.dob),
+        COALESCE(EXCLUDED.gender, p.gender), COALESCE(EXCLUDED.email, p.email))
+    RETURNING p.patient_id, (p.xmax = 0) AS inserted
+), touched AS (
+    INSERT INTO profile_import_touched SELECT patient_id FROM merged
+)
+SELECT (SELECT COUNT(*) FROM latest),
+       COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted)
+FROM merged
+"""
+
+# Los rangos por sexo / edad dependen del perfil: se recalcula la bandera de esos pacientes
+REFLAG_TOUCHED_SQL = """
+UPDATE lab_results l SET abnormal_flag = lab_abnormal_flag(l.patient_id, l.test_code, l.value, l.test_date)
+WHERE l.patient_id IN (SELECT patient_id FROM profile_import_touched)
+  AND l.abnormal_flag IS DISTINCT FROM lab_abnormal_flag(l.patient_id, l.test_code, l.value, l.test_date)
+"""
+
+
+class BodyReader(io.RawIOBase):
+    """
+    Archivo de solo lectura sobre el stream ASGI del request. Se usa desde un hilo del
+    threadpool (COPY de psycopg2 es bloqueante) y pide cada bloque al event loop.
+    """
+
+    def __init__(self, request):
+        self._chunks = request.stream().__aiter__()
+        self._chunk = memoryview(b"")  # Un bloque puede ser enorme: se avanza sin copiar el resto
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._chunk and not self._done:
+            try:
+                self._chunk = memoryview(from_thread.run(self._chunks.__anext__))
+            except StopAsyncIteration:
+                self._done = True
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+class _CopySource(io.RawIOBase):
+    """Archivo de solo lectura que va generando el texto de COPY a partir de un iterador de líneas."""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._buffer) < len(b):
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._buffer += line
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+
+def _copy_field(value):
+    if value is None:
+        return "\\N"
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def clean_profile(record: dict) -> list:
+    """Valida una fila y la devuelve en el orden de FIELDS. ValueError con el motivo si no sirve."""
+    row = []
+    for field in FIELDS:
+        value = record.get(field)
+        if value is not None and not isinstance(value, str):
+            value = str(value)
+        value = value.strip() if value else None
+        value = value or None
+        if value and field in MAX_LENGTHS and len(value) > MAX_LENGTHS[field]:
+            raise ValueError(f"{field} supera {MAX_LENGTHS[field]} caracteres")
+        if value and field == "dob":
+            try:
+                value = date.fromisoformat(value).isoformat()
+            except ValueError:
+                raise ValueError(f"dob inválida: {value!r} (se espera AAAA-MM-DD)")
+        row.append(value)
+    if not row[0]:
+        raise ValueError("Falta patient_id")
+    return row
+
+
+def read_records(text, fmt):
+    """
+    Iterador de (número de línea, dict | None si la línea no se pudo leer).
+    El encabezado del CSV se valida aquí, ANTES de empezar el COPY.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        fieldnames = [f.strip() for f in reader.fieldnames or []]
+        if "patient_id" not in fieldnames:
+            raise ValueError("El CSV necesita encabezado con al menos 'patient_id'")
+        reader.fieldnames = fieldnames
+        return ((reader.line_num, record) for record in reader)
+    return _ndjson_records(text)
+
+
+def _ndjson_records(text):
+    for line_no, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_no, record if isinstance(record, dict) else None
+
+
+class ImportStats:
+    def __init__(self):
+        self.received = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line_no, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line_no, "error": reason})
+
+
+def _copy_rows(records, stats):
+    """(patient_id, línea de COPY) de cada fila válida."""
+    for line_no, record in records:
+        stats.received += 1
+        if record is None:
+            stats.reject(line_no, "Línea ilegible")
+            continue
+        try:
+            row = clean_profile(record)
+        except ValueError as e:
+            stats.reject(line_no, str(e))
+            continue
+        yield row[0], ("\t".join([str(line_no)] + [_copy_field(v) for v in row]) + "\n").encode("utf-8")
+
+
+def _merge(cursor, source, reflag: bool):
+    """COPY de `source` a la tabla temporal + merge -> (pacientes únicos, insertados, actualizados, re-marcados)."""
+    cursor.execute(STAGING_DDL)
+    cursor.copy_expert(
+        "COPY profile_import (line_no, patient_id, full_name, dob, gender, email) FROM STDIN",
+        source, size=1 << 16,
+    )
+    cursor.execute("ANALYZE profile_import")  # Las temporales no tienen estadísticas (autovacuum no las ve)
+    cursor.execute(MERGE_SQL)
+    unique, inserted, updated = cursor.fetchone()
+    reflagged = 0
+    if reflag and inserted + updated:
+        cursor.execute(REFLAG_TOUCHED_SQL)
+        reflagged = cursor.rowcount
+    return unique, inserted, updated, reflagged
+
+
+def _merge_sharded(conns, rows, reflag: bool):
+    spools = {}
+    try:
+        for patient_id, line in rows:
+            shard = shard_for(patient_id)
+            spool = spools.get(shard)
+            if spool is None:
+                spool = spools[shard] = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+            spool.write(line)
+
+        def merge_shard(shard):
+            spools[shard].seek(0)
+            with conns.get(shard).cursor() as cursor:
+                return _merge(cursor, spools[shard], reflag)
+
+        results = scatter(merge_shard, spools, operation="import_profiles")
+    finally:
+        for spool in spools.values():
+            spool.close()
+    return [sum(column) for column in zip(*results)] if results else [0, 0, 0, 0]
+
+
+def import_profiles(conns, body, fmt: str, reflag: bool) -> dict:
+    """
+    Corre en un hilo: COPY a la tabla temporal + merge, en una sola transacción por shard
+    (sin commit; `conns` es un ShardConnections).
+    """
+    stats = ImportStats()
+    text = io.TextIOWrapper(io.BufferedReader(body, buffer_size=1 << 16), encoding="utf-8-sig", newline="")
+    rows = _copy_rows(read_records(text, fmt), stats)
+    if is_sharded():
+        unique, inserted, updated, reflagged = _merge_sharded(conns, rows, reflag)
+    else:
+        source = io.BufferedReader(_CopySource(line for _, line in rows), buffer_size=1 << 16)
+        with conns.get(home_shard()).cursor() as cursor:
+            unique, inserted, updated, reflagged = _merge(cursor, source, reflag)
+    accepted = stats.received - stats.rejected
+    return {
+        "received": stats.received,
+        "inserted": inserted,
+        "updated": updated,
+        "unchanged": unique - inserted - updated,
+        "duplicates": accepted - unique,  # Filas repetidas del mismo paciente (gana la última)
+        "rejected": stats.rejected,
+        "reflagged_results": reflagged,
+        "errors": stats.errors,
+    }
@@ -0,0 +1,172 @@
+import logging
+import random
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+import psycopg2.extensions
+from .config import SLOW_QUERY_MS, EXPLAIN_SAMPLE_RATE, QUERY_STATS_MAX
+
+logger = logging.getLogger(__name__)
+
+# --- Registro de queries lentas (por proceso) ---
+# Cada sentencia se cronometra en database._TimedCursorMixin y llega aquí con la
+# ruta que la originó. Agrupamos por "huella" (SQL normalizado sin literales) para
+# ver qué consultas se degradan conforme crecen las tablas.
+
+# El middleware guarda aquí el scope de la petición; la ruta se resuelve al
+# momento de la query (el router ya la escribió en el scope).
+current_scope: ContextVar = ContextVar("current_scope", default=None)
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_PARAM_RE = re.compile(r"%\(\w+\)s|%s")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES_RE = re.compile(r"\s+")
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def normalize_sql(query) -> str:
+    """'WHERE id = %s AND x IN (1, 2)' -> 'WHERE id = ? AND x IN (...)'"""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    sql = _STRING_RE.sub("?", str(query))
+    sql = _PARAM_RE.sub("?", sql)
+    sql = _NUMBER_RE.sub("?", sql)
+    sql = _IN_LIST_RE.sub("(...)", sql)
+    return _SPACES_RE.sub(" ", sql).strip().rstrip(";")
+
+
+def current_route() -> str:
+    from .metrics import scope_route_template
+    scope = current_scope.get()
+    return scope_route_template(scope) if scope is not None else "background"
+
+
+# EXPLAIN ANALYZE vuelve a ejecutar la sentencia: solo a SELECT simples que llaman
+# funciones conocidas sin efectos. Las demás (rebuild_*, pg_advisory_lock, FOR UPDATE,
+# funciones propias) reciben un EXPLAIN sin ANALYZE, que no ejecuta nada.
+_LOCKING_RE = re.compile(r"\bFOR\s+(?:NO\s+KEY\s+)?(?:UPDATE|SHARE|KEY\s+SHARE)\b", re.IGNORECASE)
+_CALL_RE = re.compile(r"\b([a-z_][a-z0-9_]*)\s*\(", re.IGNORECASE)
+_SAFE_CALLS = frozenset("""
+    select from where and or not in exists any all as on using join lateral values filter over within
+    partition by order group having when then else case cast array row interval with
+    count sum avg min max coalesce nullif greatest least abs round floor ceil ceiling sqrt power ln log exp
+    lower upper length substring trim concat replace split_part left right to_char to_date to_timestamp
+    date_trunc date_part extract age now make_interval generate_series unnest cardinality array_length
+    array_agg string_agg json_agg jsonb_agg json_build_object jsonb_build_object jsonb_object_agg
+    to_json to_jsonb jsonb_array_elements jsonb_array_elements_text jsonb_each jsonb_object_keys
+    stddev stddev_samp stddev_pop variance var_samp var_pop regr_slope regr_intercept corr covar_samp
+    percentile_cont percentile_disc mode row_number rank dense_rank ntile lag lead first_value last_value
+    bool_and bool_or every md5 width_bucket numeric decimal varchar char
+""".split())
+_EXPLAIN_MAX_PENDING = 4       # Planes en espera; si hay más, la muestra se descarta
+_EXPLAIN_TIMEOUT_MS = 30000    # Un EXPLAIN ANALYZE que tarde más se corta
+
+_explain_slots = threading.BoundedSemaphore(_EXPLAIN_MAX_PENDING)
+_explain_executor = None
+
+
+def explain_options(fingerprint: str) -> str:
+    """'(ANALYZE, BUFFERS)' si re-ejecutar la sentencia es inocuo; si no, EXPLAIN a secas."""
+    if fingerprint[:6].upper() != "SELECT" or _LOCKING_RE.search(fingerprint):
+        return ""
+    if any(name.lower() not in _SAFE_CALLS for name in _CALL_RE.findall(fingerprint)):
+        return ""
+    return "(ANALYZE, BUFFERS) "
+
+
+def _explain(target: dict, statement: bytes, options: str) -> str:
+    """
+    Corre el EXPLAIN en una conexión aparte (mismo host/BD que la original), en una
+    transacción READ ONLY que siempre termina en ROLLBACK: nada de lo que haga se confirma.
+    """
+    from . import database  # database importa este módulo
+    conn = database._connect(target["host"], gated=False, port=target["port"], dbname=target["dbname"])
+    try:
+        conn.set_session(readonly=True)
+        raw = psycopg2.extensions.connection.cursor(conn)  # Cursor sin instrumentar (sin recursión)
+        raw.execute("SET LOCAL statement_timeout = %s", (_EXPLAIN_TIMEOUT_MS,))
+        raw.execute(b"EXPLAIN " + options.encode() + statement)
+        return "\n".join(row[0] for row in raw.fetchall())
+    finally:
+        try:
+            conn.rollback()
+        finally:
+            conn.close()
+
+
+def _capture_plan(fingerprint: str, target: dict, statement: bytes, options: str):
+    try:
+        plan = _explain(target, statement, options)
+    except Exception as e:
+        plan = f"(EXPLAIN falló: {e})"
+    finally:
+        _explain_slots.release()
+    with _lock:
+        entry = _stats.get(fingerprint)
+        if entry is not None:
+            entry["last_plan"] = plan
+
+
+def _submit_explain(cursor, query, vars, fingerprint: str):
+    """Encola la captura del plan en un hilo aparte: la petición no espera al EXPLAIN."""
+    global _explain_executor
+    conn = cursor.connection
+    if conn.autocommit or not _explain_slots.acquire(blocking=False):
+        return  # autocommit = migraciones / tareas de mantenimiento
+    try:
+        statement = cursor.mogrify(query, vars)
+        info = conn.info
+        target = {"host": info.host, "port": info.port, "dbname": info.dbname}
+        if _explain_executor is None:
+            with _lock:
+                if _explain_executor is None:
+                    _explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query-explain")
+        _explain_executor.submit(_capture_plan, fingerprint, target, statement, explain_options(fingerprint))
+    except Exception as e:
+        _explain_slots.release()
+        logger.debug("No se pudo encolar el EXPLAIN: %s", e)
+
+
+def record(cursor, query, vars, elapsed: float, route: str, explainable: bool = True):
+    elapsed_ms = elapsed * 1000
+    if elapsed_ms < SLOW_QUERY_MS:
+        return
+
+    fingerprint = normalize_sql(query)
+    logger.warning("Query lenta", extra={"duration_ms": round(elapsed_ms, 1), "route": route, "sql": fingerprint[:300]})
+
+    with _lock:
+        entry = _stats.get(fingerprint)
+        if entry is None:
+            if len(_stats) >= QUERY_STATS_MAX:
+                # Sacamos la huella con menos tiempo acumulado para acotar la memoria
+                del _stats[min(_stats, key=lambda k: _stats[k]["total_ms"])]
+            entry = _stats[fingerprint] = {
+                "fingerprint": fingerprint, "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                "routes": set(), "last_plan": None,
+            }
+        entry["count"] += 1
+        entry["total_ms"] += elapsed_ms
+        entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+        entry["routes"].add(route)
+
+    # Después de registrar la huella: el hilo del EXPLAIN guarda el plan en esa entrada
+    is_select = fingerprint[:6].upper() == "SELECT"
+    if explainable and is_select and random.random() < EXPLAIN_SAMPLE_RATE:
+        _submit_explain(cursor, query, vars, fingerprint)
+
+
+def top_slow_queries(limit: int = 20, order_by: str = "total_ms"):
+    with _lock:
+        entries = [dict(e, routes=sorted(e["routes"])) for e in _stats.values()]
+    for e in entries:
+        e["mean_ms"] = e["total_ms"] / e["count"]
+    entries.sort(key=lambda e: e[order_by], reverse=True)
+    return [
+        dict(e, total_ms=round(e["total_ms"], 2), mean_ms=round(e["mean_ms"], 2), max_ms=round(e["max_ms"], 2))
+        for e in entries[:limit]
+    ]
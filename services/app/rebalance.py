@@ -0,0 +1,235 @@
+"""
+Rebalanceo de pacientes entre shards (p. ej. al agregar uno a DB_SHARDS).
+
+Con la topología DESTINO (--shards, o DB_SHARDS) recorre cada shard buscando los
+pacientes que según el anillo ya no le tocan, y los mueve a su shard nuevo: sus
+resultados, su perfil y sus versiones de datos y de resumen (para que ningún ETag viejo dé un 304
+equivocado). Los triggers de lab_results rehacen tendencias, rollups y sketches en
+los dos lados. Antes se deja el catálogo (test_types, rangos) de todos los shards
+igual al del primero.
+
+Es idempotente: en el destino no se repiten filas que ya estén, y en el origen solo
+se borran las filas copiadas (lo que llegue mientras tanto queda para la próxima
+pasada). Procedimiento para agregar un shard:
+  1. Crear la BD nueva y migrarla (--init, o arrancar el API con el DB_SHARDS nuevo).
+  2. --dry-run para ver cuántos pacientes se mueven; luego sin --dry-run.
+  3. Desplegar API y worker con el DB_SHARDS nuevo y volver a correrlo: barre lo que
+     se escribió en el shard viejo mientras tanto.
+
+Desde services/:
+    python -m app.rebalance --shards "s0=localhost/shard0,s1=localhost/shard1,s2=localhost/shard2" \\
+        --db-password postgres --init --dry-run
+"""
+import argparse
+import json
+import time
+from collections import Counter
+from psycopg2.extras import execute_values
+from . import database
+from .sharding import HashRing, parse_shards
+from .config import DB_SHARDS
+from .reference_ranges import REFLAG_SQL
+
+# Una fila de lab_results es "la misma" si coincide en todo esto (los id son por shard)
+SAME_ROW = """
+    l.patient_id = m.patient_id AND l.test_code IS NOT DISTINCT FROM m.test_code
+    AND l.test_date IS NOT DISTINCT FROM m.test_date AND l.value IS NOT DISTINCT FROM m.value
+    AND l.ingested_at IS NOT DISTINCT FROM m.ingested_at
+"""
+PATIENTS_SQL = "SELECT DISTINCT patient_id FROM lab_results WHERE patient_id IS NOT NULL UNION SELECT patient_id FROM patient_profiles"
+
+
+def _connect(shard):
+    conn = database.get_db_connection(gated=False, shard=shard)
+    conn.autocommit = False
+    return conn
+
+
+def _columns(cursor, table, skip=()):
+    """Columnas escribibles (sin las generadas, como dedup_key) en orden."""
+    cursor.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = %s AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+    """, (table,))
+    return [name for (name,) in cursor.fetchall() if name not in skip]
+
+
+def _ranges_by_code(cursor) -> dict:
+    cursor.execute("SELECT test_code, sex, age_min, age_max, low, high FROM test_reference_ranges")
+    ranges = {}
+    for row in cursor.fetchall():
+        ranges.setdefault(row[0], Counter())[row] += 1
+    return ranges
+
+
+def sync_catalog(shards) -> dict:
+    """
+    Deja test_types y los rangos de los demás shards como en el primero. Un examen cuyos
+    rangos difieren se reemplaza y se re-marcan sus resultados en ese shard.
+    """
+    source = _connect(shards[0])
+    try:
+        with source.cursor() as cursor:
+            cursor.execute("SELECT code, name, unit FROM test_types")
+            types = cursor.fetchall()
+            ranges = _ranges_by_code(cursor)
+    finally:
+        source.close()
+    copied = {}
+    for shard in shards[1:]:
+        conn = _connect(shard)
+        try:
+            with conn.cursor() as cursor:
+                added = execute_values(
+                    cursor, "INSERT INTO test_types (code, name, unit) VALUES %s ON CONFLICT (code) DO NOTHING RETURNING code",
+                    types, fetch=True,
+                ) if types else []
+                current = _ranges_by_code(cursor)
+                changed = sorted(code for code in set(ranges) | set(current) if ranges.get(code) != current.get(code))
+                reflagged = 0
+                for code in changed:
+                    cursor.execute("DELETE FROM test_reference_ranges WHERE test_code = %s", (code,))
+                    if code in ranges:
+                        execute_values(
+                            cursor, "INSERT INTO test_reference_ranges (test_code, sex, age_min, age_max, low, high) VALUES %s",
+                            list(ranges[code].elements()),
+                        )
+                    cursor.execute(REFLAG_SQL, (code,))
+                    reflagged += cursor.rowcount
+            conn.commit()
+            copied[shard.name] = {"test_types": len(added), "ranges": changed, "reflagged": reflagged}
+        finally:
+            conn.close()
+    return copied
+
+
+def misplaced(shards, ring) -> dict:
+    """{(origen, destino): [patient_id]} de los pacientes que están en un shard que no es el suyo."""
+    moves = {}
+    for shard in shards:
+        conn = _connect(shard)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(PATIENTS_SQL)
+                for (patient_id,) in cursor.fetchall():
+                    owner = ring.lookup(str(patient_id))
+                    if owner != shard:
+                        moves.setdefault((shard, owner), []).append(patient_id)
+        finally:
+            conn.close()
+    return moves
+
+
+def move_patients(source_shard, target_shard, patient_ids) -> dict:
+    """
+    Mueve un grupo de pacientes. El origen queda con una transacción abierta (perfiles
+    bloqueados con FOR UPDATE) mientras se escribe y confirma el destino; recién después
+    se borran en el origen las filas copiadas.
+    """
+    source, target = _connect(source_shard), _connect(target_shard)
+    try:
+        with source.cursor() as src, target.cursor() as dst:
+            lab_columns = _columns(src, "lab_results", skip={"id"})
+            if _columns(dst, "lab_results", skip={"id"}) != lab_columns:
+                raise RuntimeError(f"lab_results no tiene las mismas columnas en {source_shard.name} y {target_shard.name} (corre --init)")
+            profile_columns = _columns(src, "patient_profiles")
+            cols = ", ".join(lab_columns)
+
+            src.execute(f"SELECT {', '.join(profile_columns)} FROM patient_profiles WHERE patient_id = ANY(%s) FOR UPDATE", (patient_ids,))
+            profiles = src.fetchall()
+            src.execute(f"SELECT id, {cols} FROM lab_results WHERE patient_id = ANY(%s)", (patient_ids,))
+            rows = src.fetchall()
+            src.execute("SELECT patient_id, test_code, version FROM lab_data_versions WHERE patient_id = ANY(%s)", (patient_ids,))
+            versions = src.fetchall()
+            src.execute("SELECT patient_id, version FROM patient_summaries WHERE patient_id = ANY(%s)", (patient_ids,))
+            summary_versions = src.fetchall()
+
+            dst.execute(f"CREATE TEMP TABLE moving ON COMMIT DROP AS SELECT {cols} FROM lab_results WITH NO DATA")
+            execute_values(dst, f"INSERT INTO moving ({cols}) VALUES %s", [row[1:] for row in rows], page_size=1000)
+            dst.execute(f"""
+                INSERT INTO lab_results ({cols})
+                SELECT {', '.join('m.' + c for c in lab_columns)} FROM moving m
+                WHERE NOT EXISTS (SELECT 1 FROM lab_results l WHERE {SAME_ROW})
+                ON CONFLICT DO NOTHING
+            """)
+            inserted = dst.rowcount
+            if profiles:
+                # Un perfil que ya esté en el destino se escribió después del despliegue: gana ese
+                execute_values(dst, f"""
+                    INSERT INTO patient_profiles ({', '.join(profile_columns)}) VALUES %s
+                    ON CONFLICT (patient_id) DO NOTHING
+                """, profiles)
+            if versions:
+                # La versión del destino queda por encima de cualquiera que se haya servido desde el origen
+                execute_values(dst, """
+                    INSERT INTO lab_data_versions (patient_id, test_code, version) VALUES %s
+                    ON CONFLICT (patient_id, test_code) DO UPDATE
+                    SET version = lab_data_versions.version + EXCLUDED.version, updated_at = CURRENT_TIMESTAMP
+                """, versions)
+            if summary_versions:
+                # Igual con el resumen (el trigger ya lo armó con los resultados copiados)
+                execute_values(dst, """
+                    INSERT INTO patient_summaries (patient_id, version) VALUES %s
+                    ON CONFLICT (patient_id) DO UPDATE
+                    SET version = patient_summaries.version + EXCLUDED.version, updated_at = CURRENT_TIMESTAMP
+                """, summary_versions)
+            target.commit()
+
+            src.execute("DELETE FROM lab_results WHERE id = ANY(%s)", ([row[0] for row in rows],))
+            src.execute("DELETE FROM patient_profiles WHERE patient_id = ANY(%s)", (patient_ids,))
+            src.execute("""
+                DELETE FROM lab_data_versions v WHERE v.patient_id = ANY(%s)
+                AND NOT EXISTS (SELECT 1 FROM lab_results l WHERE l.patient_id = v.patient_id)
+            """, (patient_ids,))
+            src.execute("""
+                DELETE FROM patient_summaries s WHERE s.patient_id = ANY(%s)
+                AND NOT EXISTS (SELECT 1 FROM lab_results l WHERE l.patient_id = s.patient_id)
+            """, (patient_ids,))
+            source.commit()
+        return {"patients": len(patient_ids), "rows": len(rows), "inserted": inserted, "profiles": len(profiles)}
+    finally:
+        source.close()
+        target.close()
+
+
+def rebalance(shards, batch: int, dry_run: bool) -> dict:
+    ring = HashRing(shards)
+    report = {"catalog": None if dry_run else sync_catalog(shards), "moves": {}}
+    for (source, target), patient_ids in misplaced(shards, ring).items():
+        key = f"{source.name}->{target.name}"
+        totals = report["moves"][key] = {"patients": len(patient_ids)}
+        if dry_run:
+            continue
+        start = time.perf_counter()
+        for i in range(0, len(patient_ids), batch):
+            for name, value in move_patients(source, target, patient_ids[i:i + batch]).items():
+                if name != "patients":
+                    totals[name] = totals.get(name, 0) + value
+            print(f"  {key}: {min(i + batch, len(patient_ids))}/{len(patient_ids)} pacientes", flush=True)
+        totals["seconds"] = round(time.perf_counter() - start, 2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mueve cada paciente al shard que le toca según DB_SHARDS")
+    parser.add_argument("--shards", default=DB_SHARDS, help="Topología destino (default: DB_SHARDS)")
+    parser.add_argument("--batch", type=int, default=50, help="Pacientes por transacción")
+    parser.add_argument("--dry-run", action="store_true", help="Solo contar lo que se movería")
+    parser.add_argument("--init", action="store_true", help="Migrar antes el esquema de todos los shards")
+    parser.add_argument("--db-password", help="Password directo en vez de Secrets Manager (desarrollo)")
+    args = parser.parse_args()
+
+    shards = parse_shards(args.shards)
+    if len(shards) < 2:
+        parser.error("Hacen falta al menos dos shards (--shards o DB_SHARDS)")
+    if args.db_password:
+        database._secret_cache.update(value=args.db_password, expires=float("inf"))
+    if args.init:
+        for shard in shards:
+            print(f"init {shard.name}: {database.init_shard(shard)['schema']}")
+    print(json.dumps(rebalance(shards, args.batch, args.dry_run), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# --- Rangos de referencia y bandera de resultado anormal ---
+# Cada examen puede tener varios rangos: uno genérico (sex/edad NULL) y otros más
+# específicos por sexo ('M' / 'F') y/o banda de edad [age_min, age_max).
+# lab_abnormal_flag() elige el rango más específico que aplica al paciente en la
+# fecha del examen y devuelve 'L' (bajo), 'H' (alto) o NULL (normal / sin rango).
+# La bandera se calcula al INSERTAR (lab.py y el worker la llaman en su INSERT),
+# así que la worklist de anormales solo lee el índice parcial, sin escanear resultados.
+
+REFERENCE_RANGES_DDL = """
+CREATE TABLE IF NOT EXISTS test_reference_ranges (
+    id SERIAL PRIMARY KEY,
+    test_code VARCHAR(50) NOT NULL,
+    sex CHAR(1),                     -- 'M' / 'F' / NULL = cualquiera
+    age_min INTEGER, age_max INTEGER,  -- Edad cumplida, [age_min, age_max); NULL = sin limite
+    low NUMERIC(10, 2), high NUMERIC(10, 2)
+);
+CREATE INDEX IF NOT EXISTS idx_test_reference_ranges_code ON test_reference_ranges (test_code);
+
+ALTER TABLE lab_results ADD COLUMN IF NOT EXISTS abnormal_flag CHAR(1);
+
+-- Worklist de anormales recientes: el indice solo contiene filas marcadas
+CREATE INDEX IF NOT EXISTS idx_lab_results_abnormal_recent ON lab_results (test_date DESC NULLS LAST, id DESC)
+    WHERE abnormal_flag IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION lab_abnormal_flag(p VARCHAR, t VARCHAR, v NUMERIC, d TIMESTAMP) RETURNS CHAR(1) AS $$
+    SELECT CASE WHEN v < r.low THEN 'L' WHEN v > r.high THEN 'H' END
+    FROM test_reference_ranges r
+    LEFT JOIN patient_profiles pp ON pp.patient_id = p
+    WHERE r.test_code = t
+      AND (r.sex IS NULL OR r.sex = upper(left(pp.gender, 1)))
+      AND (r.age_min IS NULL OR date_part('year', age(d, pp.dob)) >= r.age_min)
+      AND (r.age_max IS NULL OR date_part('year', age(d, pp.dob)) < r.age_max)
+    ORDER BY (r.sex IS NOT NULL)::int + (r.age_min IS NOT NULL OR r.age_max IS NOT NULL)::int DESC, r.id
+    LIMIT 1
+$$ LANGUAGE sql STABLE;
+"""
+
+# Rangos genéricos para los exámenes del seed inicial (adultos, en ayunas)
+SEED_RANGES = [("HBA1C", None, None, None, 4.0, 5.6), ("GLUCOSE", None, None, None, 70, 99)]
+
+# Recalcula la bandera de los resultados existentes de un examen (solo toca las filas que cambian)
+REFLAG_SQL = """
+    UPDATE lab_results SET abnormal_flag = lab_abnormal_flag(patient_id, test_code, value, test_date)
+    WHERE test_code = %s
+      AND abnormal_flag IS DISTINCT FROM lab_abnormal_flag(patient_id, test_code, value, test_date)
+"""
+
+# Lo mismo para un paciente cuyo perfil (sexo / fecha de nacimiento) cambió
+REFLAG_PATIENT_SQL = """
+    UPDATE lab_results SET abnormal_flag = lab_abnormal_flag(patient_id, test_code, value, test_date)
+    WHERE patient_id = %s
+      AND abnormal_flag IS DISTINCT FROM lab_abnormal_flag(patient_id, test_code, value, test_date)
+"""
+
+
+def ensure_reference_ranges(cursor):
+    """Crea la tabla de rangos, la columna/índice de la bandera y la función. El seed + backfill solo corre la primera vez."""
+    cursor.execute("SELECT to_regclass('test_reference_ranges') IS NULL")
+    first_time = cursor.fetchone()[0]
+    cursor.execute(REFERENCE_RANGES_DDL)
+    if first_time:
+        cursor.executemany(
+            "INSERT INTO test_reference_ranges (test_code, sex, age_min, age_max, low, high) VALUES (%s, %s, %s, %s, %s, %s)",
+            SEED_RANGES,
+        )
+        for code, *_ in SEED_RANGES:
+            cursor.execute(REFLAG_SQL, (code,))
+
+
+def has_demographic_ranges(cursor) -> bool:
+    """¿Hay rangos por sexo / edad? Si no, la bandera no depende del perfil del paciente."""
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM test_reference_ranges WHERE sex IS NOT NULL OR age_min IS NOT NULL OR age_max IS NOT NULL)")
+    return cursor.fetchone()[0]
@@ -0,0 +1,72 @@
+import itertools
+import threading
+import time
+from .config import DB_REPLICA_HOSTS, REPLICA_STICKY_SECONDS, REPLICA_COOLDOWN_SECONDS, REPLICA_MAX_LAG_SECONDS
+
+# --- Ruteo de lecturas a réplicas ---
+# Round-robin entre las réplicas sanas. Una réplica que falla al conectar (o que
+# va más atrasada que REPLICA_MAX_LAG_SECONDS) queda fuera durante
+# REPLICA_COOLDOWN_SECONDS. Tras una escritura, las lecturas de ese usuario van
+# al primario durante REPLICA_STICKY_SECONDS (lectura-después-de-escritura).
+# El estado es por proceso: con varias tareas detrás del ALB cada una lleva el suyo.
+
+LAG_CHECK_INTERVAL = 10  # Segundos entre chequeos de lag por réplica
+
+_lock = threading.Lock()
+_rr = itertools.count()
+_unhealthy_until = {}   # host -> monotonic
+_lag_checked_at = {}    # host -> monotonic
+_pinned_until = {}      # user_key -> monotonic
+
+
+def user_key(user: dict):
+    return (user or {}).get("username") or (user or {}).get("sub")
+
+
+def mark_write(user: dict):
+    """Fija las lecturas de este usuario al primario durante la ventana de stickiness."""
+    key = user_key(user)
+    if not key or not DB_REPLICA_HOSTS:
+        return
+    now = time.monotonic()
+    with _lock:
+        _pinned_until[key] = now + REPLICA_STICKY_SECONDS
+        if len(_pinned_until) > 10000:  # Limpieza perezosa de entradas vencidas
+            for k in [k for k, until in _pinned_until.items() if until <= now]:
+                del _pinned_until[k]
+
+
+def is_pinned(user: dict) -> bool:
+    key = user_key(user)
+    return bool(key) and _pinned_until.get(key, 0) > time.monotonic()
+
+
+def candidates():
+    """Réplicas sanas en orden round-robin."""
+    if not DB_REPLICA_HOSTS:
+        return []
+    now = time.monotonic()
+    start = next(_rr) % len(DB_REPLICA_HOSTS)
+    ordered = DB_REPLICA_HOSTS[start:] + DB_REPLICA_HOSTS[:start]
+    return [host for host in ordered if _unhealthy_until.get(host, 0) <= now]
+
+
+def mark_unhealthy(host: str):
+    _unhealthy_until[host] = time.monotonic() + REPLICA_COOLDOWN_SECONDS
+
+
+def needs_lag_check(host: str) -> bool:
+    now = time.monotonic()
+    if now - _lag_checked_at.get(host, 0) < LAG_CHECK_INTERVAL:
+        return False
+    _lag_checked_at[host] = now
+    return True
+
+
+def lag_ok(conn) -> bool:
+    with conn.cursor() as cursor:
+        # NULL en el primario o si aún no se ha replicado nada: lo damos por bueno
+        cursor.execute("SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())")
+        lag = cursor.fetchone()[0]
+    conn.rollback()
+    return lag is None or float(lag) <= REPLICA_MAX_LAG_SECONDS
@@ -0,0 +1,142 @@
+# --- Pirámide de rollups (día / semana ISO / mes / trimestre / año) ---
+# Por (paciente, examen, resolución, bucket) guardamos count / sum / sumsq / min / max,
+# suficiente para promedio, desviación y rango de cualquier bucket. Igual que
+# versioning.py, lo mantiene un trigger por SENTENCIA sobre lab_results:
+#   * INSERT -> se suman los agregados del lote (upsert, sin releer nada).
+#   * UPDATE / DELETE -> min/max no se pueden "restar": se recalculan solo los
+#     buckets tocados (cada uno es un rango acotado del índice por fecha).
+
+RESOLUTIONS = ["year", "quarter", "month", "week", "day"]  # De la más gruesa a la más fina
+
+ROLLUP_DDL = """
+CREATE TABLE IF NOT EXISTS lab_rollups (
+    patient_id VARCHAR(100) NOT NULL, test_code VARCHAR(50) NOT NULL,
+    resolution VARCHAR(10) NOT NULL, bucket_start DATE NOT NULL,
+    count BIGINT NOT NULL, sum DOUBLE PRECISION NOT NULL, sumsq DOUBLE PRECISION NOT NULL,
+    min DOUBLE PRECISION NOT NULL, max DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (patient_id, test_code, resolution, bucket_start)
+);
+
+-- date_trunc('week') ya es la semana ISO (lunes)
+CREATE OR REPLACE VIEW lab_rollup_resolutions (resolution, step) AS
+VALUES ('day', interval '1 day'), ('week', interval '1 week'), ('month', interval '1 month'),
+       ('quarter', interval '3 months'), ('year', interval '1 year');
+
+-- Recalcula desde lab_results los buckets (de todas las resoluciones) que contienen esas fechas
+CREATE OR REPLACE FUNCTION refresh_lab_rollup_buckets(ps VARCHAR[], ts VARCHAR[], ds TIMESTAMP[]) RETURNS void AS $$
+BEGIN
+    DELETE FROM lab_rollups l
+    USING unnest(ps, ts, ds) AS k(p, t, d) CROSS JOIN lab_rollup_resolutions r
+    WHERE l.patient_id = k.p AND l.test_code = k.t
+      AND l.resolution = r.resolution AND l.bucket_start = date_trunc(r.resolution, k.d)::date;
+
+    INSERT INTO lab_rollups (patient_id, test_code, resolution, bucket_start, count, sum, sumsq, min, max)
+    SELECT b.p, b.t, b.resolution, b.bucket_start, a.c, a.s, a.ss, a.mn, a.mx
+    FROM (
+        SELECT DISTINCT k.p, k.t, r.resolution, r.step, date_trunc(r.resolution, k.d)::date AS bucket_start
+        FROM unnest(ps, ts, ds) AS k(p, t, d) CROSS JOIN lab_rollup_resolutions r
+        WHERE k.p IS NOT NULL AND k.t IS NOT NULL AND k.d IS NOT NULL
+    ) b
+    CROSS JOIN LATERAL (
+        SELECT COUNT(*) AS c, SUM(x.value::float8) AS s, SUM(x.value::float8 * x.value::float8) AS ss,
+               MIN(x.value::float8) AS mn, MAX(x.value::float8) AS mx
+        FROM lab_results x
+        WHERE x.patient_id = b.p AND x.test_code = b.t AND x.value IS NOT NULL
+          AND x.test_date >= b.bucket_start AND x.test_date < b.bucket_start + b.step
+    ) a
+    WHERE a.c > 0
+    ORDER BY 1, 2, 3, 4;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_lab_rollups() RETURNS trigger AS $$
+DECLARE
+    ps VARCHAR[]; ts VARCHAR[]; ds TIMESTAMP[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO lab_rollups (patient_id, test_code, resolution, bucket_start, count, sum, sumsq, min, max)
+        SELECT n.patient_id, n.test_code, r.resolution, date_trunc(r.resolution, n.test_date)::date,
+               COUNT(*), SUM(n.v), SUM(n.v * n.v), MIN(n.v), MAX(n.v)
+        FROM (
+            SELECT patient_id, test_code, test_date, value::float8 AS v FROM new_rows
+            WHERE patient_id IS NOT NULL AND test_code IS NOT NULL AND value IS NOT NULL AND test_date IS NOT NULL
+        ) n CROSS JOIN lab_rollup_resolutions r
+        GROUP BY 1, 2, 3, 4
+        ORDER BY 1, 2, 3, 4
+        ON CONFLICT (patient_id, test_code, resolution, bucket_start) DO UPDATE
+        SET count = lab_rollups.count + EXCLUDED.count, sum = lab_rollups.sum + EXCLUDED.sum,
+            sumsq = lab_rollups.sumsq + EXCLUDED.sumsq,
+            min = LEAST(lab_rollups.min, EXCLUDED.min), max = GREATEST(lab_rollups.max, EXCLUDED.max);
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'DELETE' THEN
+        SELECT array_agg(patient_id), array_agg(test_code), array_agg(test_date) INTO ps, ts, ds
+        FROM (SELECT DISTINCT patient_id, test_code, test_date FROM old_rows) k;
+    ELSE
+        -- Solo los buckets de filas cuyo dato cambio: re-banderear (solo abnormal_flag) no los toca
+        SELECT array_agg(p), array_agg(t), array_agg(d) INTO ps, ts, ds FROM (
+            SELECT DISTINCT k.p, k.t, k.d
+            FROM old_rows o JOIN new_rows n USING (id)
+            CROSS JOIN LATERAL (VALUES (o.patient_id, o.test_code, o.test_date), (n.patient_id, n.test_code, n.test_date)) AS k(p, t, d)
+            WHERE (o.patient_id, o.test_code, o.test_date, o.value) IS DISTINCT FROM (n.patient_id, n.test_code, n.test_date, n.value)
+        ) k;
+    END IF;
+    IF cardinality(ps) > 0 THEN
+        PERFORM refresh_lab_rollup_buckets(ps, ts, ds);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER lab_results_rollup_ins AFTER INSERT ON lab_results
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION update_lab_rollups();
+CREATE OR REPLACE TRIGGER lab_results_rollup_del AFTER DELETE ON lab_results
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION update_lab_rollups();
+CREATE OR REPLACE TRIGGER lab_results_rollup_upd AFTER UPDATE ON lab_results
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION update_lab_rollups();
+"""
+
+
+def ensure_rollups(cursor):
+    """Crea la tabla de rollups + triggers. El backfill (un GROUP BY sobre todo el historial) solo corre la primera vez."""
+    cursor.execute("SELECT to_regclass('lab_rollups') IS NULL")
+    first_time = cursor.fetchone()[0]
+    cursor.execute(ROLLUP_DDL)
+    if first_time:
+        cursor.execute("""
+            INSERT INTO lab_rollups (patient_id, test_code, resolution, bucket_start, count, sum, sumsq, min, max)
+            SELECT l.patient_id, l.test_code, r.resolution, date_trunc(r.resolution, l.test_date)::date,
+                   COUNT(*), SUM(l.value::float8), SUM(l.value::float8 * l.value::float8),
+                   MIN(l.value::float8), MAX(l.value::float8)
+            FROM lab_results l CROSS JOIN lab_rollup_resolutions r
+            WHERE l.patient_id IS NOT NULL AND l.test_code IS NOT NULL AND l.value IS NOT NULL AND l.test_date IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT DO NOTHING
+        """)
+
+
+def pick_resolution(cursor, patient_id, test_code, start_date, end_date, min_points):
+    """
+    La resolución más gruesa que todavía da >= min_points buckets en el rango.
+    Cada conteo se corta en min_points (LIMIT), así que nunca lee más de 5 * min_points filas.
+    Si ninguna llega, la más fina ("day").
+    """
+    cursor.execute("""
+        SELECT r.resolution, (
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM lab_rollups l
+                WHERE l.patient_id = %(p)s AND l.test_code = %(t)s AND l.resolution = r.resolution
+                  AND (%(start)s::timestamp IS NULL OR l.bucket_start >= date_trunc(r.resolution, %(start)s::timestamp))
+                  AND (%(end)s::timestamp IS NULL OR l.bucket_start <= %(end)s::timestamp)
+                LIMIT %(n)s
+            ) s
+        )
+        FROM unnest(%(resolutions)s::text[]) WITH ORDINALITY AS r(resolution, ord)
+        ORDER BY r.ord
+    """, {"p": patient_id, "t": test_code, "start": start_date, "end": end_date, "n": min_points,
+          "resolutions": RESOLUTIONS})
+    for resolution, buckets in cursor.fetchall():
+        if buckets >= min_points:
+            return resolution
+    return RESOLUTIONS[-1]
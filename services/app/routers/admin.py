@@ -1,13 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException
-import boto3
+import logging
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Header
+from fastapi.concurrency import run_in_threadpool
+from typing import Optional
 from psycopg2.extras import RealDictCursor
 from ..dependencies import get_current_user
-from ..database import get_db_connection
-from ..models import RoleRequest
-from ..config import USER_POOL_ID, COGNITO_REGION
+from ..database import get_read_connection, mark_write, ShardConnections
+from ..sharding import all_shards, home_shard, scatter, shard_for
+from ..models import RoleRequest, BulkRoleRequest
+from ..config import USER_POOL_ID, BULK_ROLE_MAX_USERS
+from ..aws import cognito_client
+from ..query_log import top_slow_queries
+from ..cognito_roles import assign_roles, call_with_retry, set_role
+from ..profile_import import BodyReader, import_profiles
+from ..reference_ranges import has_demographic_ranges
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["Admin"])
-cognito_client = boto3.client("cognito-idp", region_name=COGNITO_REGION)
 
 # 1. Asignar Rol (Igual)
 # services/app/routers/admin.py
@@ -20,7 +29,7 @@ def assign_role(request: RoleRequest, user: dict = Depends(get_current_user)):
 
     try:
         # 1. Buscar el Username basado en el Email
-        response = cognito_client.list_users(
+        response = cognito_client().list_users(
             UserPoolId=USER_POOL_ID,
             Filter=f'email = "{request.email}"',
             Limit=1
@@ -30,39 +39,56 @@ def assign_role(request: RoleRequest, user: dict = Depends(get_current_user)):
         
         target_username = response['Users'][0]['Username']
 
-        # 2. LIMPIEZA: Obtener grupos actuales del usuario
-        current_groups_response = cognito_client.admin_list_groups_for_user(
-            UserPoolId=USER_POOL_ID,
-            Username=target_username
-        )
-        
-        # 3. Remover usuario de TODOS los grupos actuales
-        # Esto evita que sea "Patient" y "Doctor" al mismo tiempo
-        for group in current_groups_response.get('Groups', []):
-            old_role = group['GroupName']
-            # Opcional: No te borres a ti mismo de Admin si estás editando tu propio usuario por error
-            if old_role != request.role: 
-                print(f"🧹 Removiendo rol antiguo: {old_role}")
-                cognito_client.admin_remove_user_from_group(
-                    UserPoolId=USER_POOL_ID,
-                    Username=target_username,
-                    GroupName=old_role
-                )
-
-        # 4. Asignar el NUEVO rol
-        print(f"✅ Asignando nuevo rol: {request.role}")
-        cognito_client.admin_add_user_to_group(
-            UserPoolId=USER_POOL_ID,
-            Username=target_username,
-            GroupName=request.role
-        )
+        # 2. Quitar TODOS los grupos anteriores y asignar el nuevo
+        # (con reintentos si Cognito responde con throttling)
+        logger.info("Asignando nuevo rol: %s", request.role)
+        set_role(cognito_client(), target_username, request.role)
 
         return {"message": f"Rol actualizado correctamente a {request.role}"}
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error cambiando rol: {e}")
+        logger.exception("Error cambiando rol: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+# 1b. Asignar roles en lote (onboarding de un laboratorio / clínica completa)
+@router.post("/assign-roles")
+def assign_roles_bulk(request: BulkRoleRequest, user: dict = Depends(get_current_user)):
+    groups = user.get("cognito:groups", [])
+    if "Admins" not in groups:
+        raise HTTPException(status_code=403, detail="Solo Admins.")
+
+    assignments = [(a.email.strip(), a.role) for a in request.assignments]
+    if not assignments:
+        raise HTTPException(status_code=400, detail="No hay asignaciones.")
+    if len(assignments) > BULK_ROLE_MAX_USERS:
+        raise HTTPException(status_code=400, detail=f"Máximo {BULK_ROLE_MAX_USERS} usuarios por petición.")
+    emails = [email.lower() for email, _ in assignments]
+    if len(set(emails)) != len(emails):
+        raise HTTPException(status_code=400, detail="Hay emails repetidos.")
+
+    try:
+        # Los roles se validan una vez (no 200 veces el mismo error por usuario)
+        for role in sorted({role for _, role in assignments}):
+            try:
+                call_with_retry(cognito_client(), "get_group", UserPoolId=USER_POOL_ID, GroupName=role)
+            except cognito_client().exceptions.ResourceNotFoundException:
+                raise HTTPException(status_code=400, detail=f"Rol inexistente: {role}")
+
+        results = assign_roles(cognito_client(), assignments)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error en asignación masiva de roles: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    summary = {}
+    for r in results:
+        summary[r["status"]] = summary.get(r["status"], 0) + 1
+    logger.info("Asignación masiva de roles: %s", summary)
+    return {"summary": summary, "results": results}
+
 # ✅ 2. LISTAR TODO (INCLUYENDO FANTASMAS)
 @router.get("/users")
 def list_users(user: dict = Depends(get_current_user)):
@@ -70,29 +96,35 @@ def list_users(user: dict = Depends(get_current_user)):
     if "Admins" not in groups:
         raise HTTPException(status_code=403, detail="Solo Admins.")
     
-    conn = get_db_connection()
     try:
         # A. Traemos de Cognito
         cog_users = {}
         try:
-            response = cognito_client.list_users(UserPoolId=USER_POOL_ID, Limit=60)
+            response = cognito_client().list_users(UserPoolId=USER_POOL_ID, Limit=60)
             for u in response['Users']:
                 email = next((attr['Value'] for attr in u['Attributes'] if attr['Name'] == 'email'), None)
                 if email: cog_users[email] = u['UserStatus']
         except: pass
 
-        # B. SQL PODEROSA: Perfiles + IDs Huérfanos en Resultados
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            # Esta query une los perfiles oficiales con los IDs que solo existen en resultados
-            query = """
-                SELECT patient_id, email, full_name, 'PROFILE' as type FROM patient_profiles
-                UNION
-                SELECT DISTINCT patient_id, 'N/A' as email, 'Datos Huérfanos' as full_name, 'GHOST' as type 
-                FROM lab_results 
-                WHERE patient_id NOT IN (SELECT patient_id FROM patient_profiles)
-            """
-            cursor.execute(query)
-            db_records = cursor.fetchall()
+        # B. SQL PODEROSA: Perfiles + IDs Huérfanos en Resultados (cada shard con sus pacientes)
+        def shard_records(shard):
+            conn = get_read_connection(user, shard=shard)
+            try:
+                with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                    # Esta query une los perfiles oficiales con los IDs que solo existen en resultados
+                    query = """
+                        SELECT patient_id, email, full_name, 'PROFILE' as type FROM patient_profiles
+                        UNION
+                        SELECT DISTINCT patient_id, 'N/A' as email, 'Datos Huérfanos' as full_name, 'GHOST' as type 
+                        FROM lab_results 
+                        WHERE patient_id NOT IN (SELECT patient_id FROM patient_profiles)
+                    """
+                    cursor.execute(query)
+                    return cursor.fetchall()
+            finally:
+                conn.close()
+
+        db_records = [r for rows in scatter(shard_records, operation="list_users") for r in rows]
 
         combined_list = []
         processed_emails = set()
@@ -132,11 +164,11 @@ def list_users(user: dict = Depends(get_current_user)):
 
         return combined_list
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Error: {e}")
+        logger.exception("Error listando usuarios: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 # ✅ 3. ELIMINAR INTELIGENTE (Detecta si es Email o ID)
 @router.delete("/users/{identifier}")
@@ -146,20 +178,12 @@ def delete_user(identifier: str, user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Solo Admins.")
 
     messages = []
-    conn = get_db_connection()
-    
-    try:
-        # A. Intentar borrar de Cognito (Si parece un email)
-        if "@" in identifier:
-            try:
-                response = cognito_client.list_users(UserPoolId=USER_POOL_ID, Filter=f'email = "{identifier}"', Limit=1)
-                if response['Users']:
-                    cognito_client.admin_delete_user(UserPoolId=USER_POOL_ID, Username=response['Users'][0]['Username'])
-                    messages.append("Cognito eliminado")
-            except: pass
+    # Un email no dice en qué shard está su perfil: se busca en todos
+    shards = all_shards() if "@" in identifier else [shard_for(identifier)]
+    conns = ShardConnections()
 
-        # B. Borrar de Base de Datos (Buscando por Email O por ID)
-        with conn.cursor() as cursor:
+    def delete_shard(shard):
+        with conns.get(shard).cursor() as cursor:
             # 1. Borrar resultados (buscando el ID asociado si es email, o el ID directo)
             cursor.execute("""
                 DELETE FROM lab_results 
@@ -169,19 +193,90 @@ def delete_user(identifier: str, user: dict = Depends(get_current_user)):
             
             # 2. Borrar perfil
             cursor.execute("DELETE FROM patient_profiles WHERE email = %s OR patient_id = %s", (identifier, identifier))
-            prof_count = cursor.rowcount
-            
-            if res_count > 0 or prof_count > 0:
-                messages.append(f"DB: {prof_count} perfil y {res_count} resultados eliminados")
-            else:
-                messages.append("DB limpia")
+            return cursor.rowcount, res_count
+    
+    try:
+        # A. Intentar borrar de Cognito (Si parece un email)
+        if "@" in identifier:
+            try:
+                response = cognito_client().list_users(UserPoolId=USER_POOL_ID, Filter=f'email = "{identifier}"', Limit=1)
+                if response['Users']:
+                    cognito_client().admin_delete_user(UserPoolId=USER_POOL_ID, Username=response['Users'][0]['Username'])
+                    messages.append("Cognito eliminado")
+            except: pass
 
-            conn.commit()
+        # B. Borrar de Base de Datos (Buscando por Email O por ID)
+        counts = scatter(delete_shard, shards, operation="delete_user")
+        prof_count = sum(p for p, _ in counts)
+        res_count = sum(r for _, r in counts)
+        
+        if res_count > 0 or prof_count > 0:
+            messages.append(f"DB: {prof_count} perfil y {res_count} resultados eliminados")
+        else:
+            messages.append("DB limpia")
+
+        conns.commit()
+        mark_write(user)
 
         return {"message": " | ".join(messages)}
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        conns.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conns.close()
+
+# ✅ 4. QUERIES LENTAS (por huella SQL, de este proceso)
+@router.get("/slow-queries")
+def list_slow_queries(
+    limit: int = Query(20, ge=1, le=200),
+    order_by: str = Query("total_ms", pattern="^(total_ms|mean_ms|max_ms|count)$"),
+    user: dict = Depends(get_current_user),
+):
+    groups = user.get("cognito:groups", [])
+    if "Admins" not in groups:
+        raise HTTPException(status_code=403, detail="Solo Admins.")
+
+    return top_slow_queries(limit=limit, order_by=order_by)
+
+# ✅ 5. IMPORTAR PERFILES EN LOTE (CSV / NDJSON, p. ej. para los pacientes "fantasma")
+# Cuerpo crudo (no multipart): curl --data-binary @perfiles.csv -H "Content-Type: text/csv"
+# Columnas: patient_id (obligatoria), full_name, dob (AAAA-MM-DD), gender, email.
+@router.post("/profiles/import")
+async def import_patient_profiles(
+    request: Request,
+    import_format: Optional[str] = Query(None, alias="format", pattern="^(csv|ndjson)$"),
+    content_type: Optional[str] = Header(None),
+    user: dict = Depends(get_current_user),
+):
+    groups = user.get("cognito:groups", [])
+    if "Admins" not in groups:
+        raise HTTPException(status_code=403, detail="Solo Admins.")
+
+    fmt = import_format or ("ndjson" if "json" in (content_type or "") else "csv")
+    # COPY (psycopg2) es bloqueante: corre en el threadpool y va leyendo el cuerpo por bloques
+    return await run_in_threadpool(_run_profile_import, request, fmt, user)
+
+def _run_profile_import(request: Request, fmt: str, user: dict):
+    conns = ShardConnections()  # Cada perfil va al shard de su paciente
+    try:
+        with conns.get(home_shard()).cursor() as cursor:
+            reflag = has_demographic_ranges(cursor)
+        result = import_profiles(conns, BodyReader(request), fmt, reflag)
+        conns.commit()
+        mark_write(user)
+        logger.info("Importación de perfiles: %s", {k: v for k, v in result.items() if k != "errors"})
+        return result
+    except HTTPException:
+        raise
+    except ValueError as e:
+        conns.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        conn.rollback()
+        conns.rollback()
+        logger.exception("Error importando perfiles: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        conn.close()
\ No newline at end of file
+        conns.close()
@@ -1,14 +1,23 @@
+import logging
 from fastapi import APIRouter, Depends, HTTPException
+from typing import List
 from psycopg2.extras import RealDictCursor
-from ..database import get_db_connection
+from ..database import get_read_connection, mark_write, ShardConnections
+from ..sharding import home_shard, scatter
 from ..dependencies import get_current_user
-from ..models import TestTypeRequest
+from ..models import TestTypeRequest, ReferenceRange
+from ..reference_ranges import REFLAG_SQL
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["Catalog"])
 
+# El catálogo (test_types, test_reference_ranges) está replicado en todos los shards:
+# las lecturas van al primer shard y cada escritura se aplica en todos (ShardConnections)
+
 @router.get("/tests")
 def list_test_catalog(user: dict = Depends(get_current_user)):
-    conn = get_db_connection()
+    conn = get_read_connection(user)
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute("SELECT * FROM test_types ORDER BY name")
@@ -24,15 +33,20 @@ def create_test_type(test: TestTypeRequest, user: dict = Depends(get_current_use
     if "Admins" not in groups:
         raise HTTPException(status_code=403, detail="Acceso denegado. Solo Administradores pueden crear pruebas.")
         
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cursor:
+    conns = ShardConnections()
+
+    def create_shard(shard):
+        with conns.get(shard).cursor() as cursor:
             sql = "INSERT INTO test_types (code, name, unit) VALUES (%s, %s, %s) ON CONFLICT (code) DO NOTHING"
             cursor.execute(sql, (test.code.upper(), test.name, test.unit))
-            conn.commit()
-            return {"message": "Examen creado exitosamente."}
+
+    try:
+        scatter(create_shard, operation="create_test_type")
+        conns.commit()
+        mark_write(user)
+        return {"message": "Examen creado exitosamente."}
     finally:
-        conn.close()
+        conns.close()
 
 @router.delete("/tests/{code}")
 def delete_test_type(code: str, cascade: bool = False, user: dict = Depends(get_current_user)):
@@ -40,48 +54,58 @@ def delete_test_type(code: str, cascade: bool = False, user: dict = Depends(get_
     if "Admins" not in groups:
         raise HTTPException(status_code=403, detail="Solo Admins.")
 
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cursor:
-            # 1. VERIFICACIÓN MANUAL DE DATOS ASOCIADOS
+    conns = ShardConnections()
+
+    def count_results(shard):
+        with conns.get(shard).cursor() as cursor:
             cursor.execute("SELECT COUNT(*) FROM lab_results WHERE test_code = %s", (code,))
-            count = cursor.fetchone()[0]
-
-            # 2. Si hay datos y NO pidieron cascada, bloqueamos el borrado
-            if count > 0 and not cascade:
-                raise HTTPException(
-                    status_code=409, 
-                    detail=f"CONFLICTO: Existen {count} resultados de pacientes con este examen. Debes forzar el borrado para eliminarlos también."
-                )
-
-            # 3. Si hay datos y SÍ pidieron cascada, borramos los resultados primero
-            deleted_results = 0
-            if count > 0 and cascade:
-                cursor.execute("DELETE FROM lab_results WHERE test_code = %s", (code,))
-                deleted_results = cursor.rowcount
+            return cursor.fetchone()[0]
 
-            # 4. Finalmente borramos el tipo de examen del catálogo
+    def delete_shard(shard):
+        with conns.get(shard).cursor() as cursor:
+            deleted = 0
+            if cascade:
+                cursor.execute("DELETE FROM lab_results WHERE test_code = %s", (code,))
+                deleted = cursor.rowcount
             cursor.execute("DELETE FROM test_types WHERE code = %s", (code,))
-            
-            if cursor.rowcount == 0:
-                raise HTTPException(status_code=404, detail="Examen no encontrado.")
-            
-            conn.commit()
-            
-            msg = f"Examen {code} eliminado correctamente."
-            if deleted_results > 0:
-                msg += f" (Se eliminaron también {deleted_results} resultados históricos)."
-            
-            return {"message": msg}
+            return deleted, cursor.rowcount
+
+    try:
+        # 1. VERIFICACIÓN MANUAL DE DATOS ASOCIADOS (en todos los shards)
+        count = sum(scatter(count_results, operation="delete_test_type"))
+
+        # 2. Si hay datos y NO pidieron cascada, bloqueamos el borrado
+        if count > 0 and not cascade:
+            raise HTTPException(
+                status_code=409, 
+                detail=f"CONFLICTO: Existen {count} resultados de pacientes con este examen. Debes forzar el borrado para eliminarlos también."
+            )
+
+        # 3. Si pidieron cascada, borramos los resultados primero
+        # 4. Finalmente borramos el tipo de examen del catálogo
+        outcome = scatter(delete_shard, operation="delete_test_type")
+        deleted_results = sum(deleted for deleted, _ in outcome)
+        
+        if not any(removed for _, removed in outcome):
+            raise HTTPException(status_code=404, detail="Examen no encontrado.")
+        
+        conns.commit()
+        mark_write(user)
+        
+        msg = f"Examen {code} eliminado correctamente."
+        if deleted_results > 0:
+            msg += f" (Se eliminaron también {deleted_results} resultados históricos)."
+        
+        return {"message": msg}
 
     except HTTPException as he:
         raise he # Re-lanzar excepciones HTTP controladas
     except Exception as e:
-        conn.rollback()
-        print(f"Error Delete: {e}")
+        conns.rollback()
+        logger.exception("Error Delete: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        conn.close()
+        conns.close()
 
 # ... (Mantén tus imports anteriores) ...
 
@@ -93,9 +117,10 @@ def sync_catalog_with_results(user: dict = Depends(get_current_user)):
     if "Admins" not in groups:
         raise HTTPException(status_code=403, detail="Solo Admins.")
 
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cursor:
+    conns = ShardConnections()
+
+    def find_orphans(shard):
+        with conns.get(shard).cursor() as cursor:
             # 2. Buscar códigos que están en RESULTADOS pero NO en CATÁLOGO
             cursor.execute("""
                 SELECT DISTINCT r.test_code, r.test_name, r.unit 
@@ -103,9 +128,10 @@ def sync_catalog_with_results(user: dict = Depends(get_current_user)):
                 LEFT JOIN test_types t ON r.test_code = t.code
                 WHERE t.code IS NULL
             """)
-            orphans = cursor.fetchall()
-            
-            count = 0
+            return cursor.fetchall()
+
+    def insert_orphans(shard):
+        with conns.get(shard).cursor() as cursor:
             for row in orphans:
                 # row es una tupla: (code, name, unit)
                 cursor.execute("""
@@ -113,17 +139,88 @@ def sync_catalog_with_results(user: dict = Depends(get_current_user)):
                     VALUES (%s, %s, %s)
                     ON CONFLICT (code) DO NOTHING
                 """, (row[0], row[1], row[2] or "N/A"))
-                count += 1
-            
-            conn.commit()
-            
-            if count == 0:
-                return {"message": "✅ El catálogo ya está sincronizado."}
-            
-            return {"message": f"🎉 Se recuperaron {count} exámenes faltantes al catálogo."}
 
+    try:
+        # Los huérfanos de cada shard se juntan y se agregan al catálogo de TODOS
+        orphans = list(dict.fromkeys(row for rows in scatter(find_orphans, operation="sync_catalog") for row in rows))
+        count = len(orphans)
+        if orphans:
+            scatter(insert_orphans, operation="sync_catalog")
+        
+        conns.commit()
+        mark_write(user)
+        
+        if count == 0:
+            return {"message": "✅ El catálogo ya está sincronizado."}
+        
+        return {"message": f"🎉 Se recuperaron {count} exámenes faltantes al catálogo."}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        conns.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conns.close()
+
+# --- RANGOS DE REFERENCIA ---
+@router.get("/tests/{code}/ranges")
+def list_reference_ranges(code: str, user: dict = Depends(get_current_user)):
+    conn = get_read_connection(user)
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                SELECT sex, age_min, age_max, low, high FROM test_reference_ranges
+                WHERE test_code = %s ORDER BY sex NULLS FIRST, age_min NULLS FIRST
+            """, (code.upper(),))
+            return cursor.fetchall()
+    finally:
+        conn.close()
+
+@router.put("/tests/{code}/ranges")
+def replace_reference_ranges(code: str, ranges: List[ReferenceRange], user: dict = Depends(get_current_user)):
+    """Reemplaza todos los rangos del examen y recalcula la bandera de sus resultados."""
+    groups = user.get("cognito:groups", [])
+    if "Admins" not in groups:
+        raise HTTPException(status_code=403, detail="Solo Admins.")
+
+    for r in ranges:
+        if r.sex is not None and r.sex.upper() not in ("M", "F"):
+            raise HTTPException(status_code=400, detail="sex debe ser 'M', 'F' o null")
+        if r.age_min is not None and r.age_max is not None and r.age_min >= r.age_max:
+            raise HTTPException(status_code=400, detail="age_min debe ser menor que age_max")
+        if r.low is not None and r.high is not None and r.low > r.high:
+            raise HTTPException(status_code=400, detail="low no puede ser mayor que high")
+
+    code = code.upper()
+    conns = ShardConnections()
+
+    def replace_shard(shard):
+        with conns.get(shard).cursor() as cursor:
+            cursor.execute("DELETE FROM test_reference_ranges WHERE test_code = %s", (code,))
+            cursor.executemany(
+                "INSERT INTO test_reference_ranges (test_code, sex, age_min, age_max, low, high) VALUES (%s, %s, %s, %s, %s, %s)",
+                [(code, r.sex.upper() if r.sex else None, r.age_min, r.age_max, r.low, r.high) for r in ranges],
+            )
+            # Los resultados ya guardados se vuelven a marcar con los rangos nuevos
+            cursor.execute(REFLAG_SQL, (code,))
+            return cursor.rowcount
+
+    try:
+        with conns.get(home_shard()).cursor() as cursor:
+            cursor.execute("SELECT 1 FROM test_types WHERE code = %s", (code,))
+            if cursor.fetchone() is None:
+                raise HTTPException(status_code=404, detail="Examen no encontrado.")
+
+        reflagged = sum(scatter(replace_shard, operation="replace_reference_ranges"))
+        conns.commit()
+        mark_write(user)
+        return {"message": f"Rangos de {code} actualizados.", "reflagged": reflagged}
+    except HTTPException:
+        raise
     except Exception as e:
-        conn.rollback()
+        conns.rollback()
+        logger.exception("Error Rangos: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        conn.close()
\ No newline at end of file
+        conns.close()
@@ -0,0 +1,76 @@
+import asyncio
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from .. import notifications
+from ..config import SSE_MAX_CLIENTS, SSE_MAX_PATIENTS, SSE_KEEPALIVE_SECONDS
+from ..dependencies import get_current_user
+from ..metrics import SSE_CLIENTS, SSE_EVENTS
+
+router = APIRouter(tags=["Events"])
+
+_open_streams = 0  # Streams abiertos en este proceso (tope SSE_MAX_CLIENTS)
+
+
+def _sse(event: str, data) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+async def _event_stream(patient_ids):
+    global _open_streams
+    sub = notifications.broker.subscribe(patient_ids)
+    _open_streams += 1
+    SSE_CLIENTS.inc()
+    try:
+        # retry: el navegador reintenta a los 5 s si se corta (ALB, deploy...)
+        yield b"retry: 5000\n" + _sse("ready", {"patient_ids": sorted(sub.patient_ids)})
+        while True:
+            try:
+                event = await asyncio.wait_for(sub.queue.get(), SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"  # Comentario SSE: mantiene viva la conexión
+                continue
+            if sub.overflowed or event is notifications.RESYNC:
+                # Se perdieron eventos: descartamos lo pendiente y el cliente re-consulta todo
+                while not sub.queue.empty():
+                    sub.queue.get_nowait()
+                sub.overflowed = False
+                SSE_EVENTS.labels("resync").inc()
+                yield _sse("resync", {})
+                continue
+            SSE_EVENTS.labels("results").inc()
+            yield _sse("results", event)
+    finally:
+        # Cliente desconectado (la tarea se cancela) o error: lo sacamos del broker
+        notifications.broker.unsubscribe(sub)
+        _open_streams -= 1
+        SSE_CLIENTS.dec()
+
+
+# Stream SSE: avisa cuando se confirman resultados nuevos (o borrados) de esos pacientes.
+# El aviso solo dice QUÉ cambió (paciente, examen, cuántos, última fecha); el dashboard
+# re-consulta con los GETs de siempre (que responden 304 si no le afecta).
+# EventSource no permite headers: el frontend usa fetch() en streaming con el Bearer.
+@router.get("/results")
+async def stream_results(
+    patient_ids: str = Query(..., description="IDs de paciente separados por coma"),
+    user: dict = Depends(get_current_user)
+):
+    ids = {p.strip() for p in patient_ids.split(",") if p.strip()}
+    if not ids:
+        raise HTTPException(status_code=400, detail="Indica al menos un patient_id")
+    if len(ids) > SSE_MAX_PATIENTS:
+        raise HTTPException(status_code=400, detail=f"Máximo {SSE_MAX_PATIENTS} pacientes por suscripción")
+
+    groups = user.get("cognito:groups", [])
+    if "Patients" in groups and not any(r in groups for r in ["Doctors", "Labs", "Admins"]):
+        if ids != {user.get("username") or user.get("sub")}:
+            raise HTTPException(status_code=403, detail="Prohibido")
+
+    if _open_streams >= SSE_MAX_CLIENTS:
+        raise HTTPException(status_code=503, detail="Demasiados streams abiertos", headers={"Retry-After": "30"})
+
+    return StreamingResponse(
+        _event_stream(ids), media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
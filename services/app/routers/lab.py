@@ -1,20 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
-from typing import List
-from datetime import datetime
-from ..database import get_db_connection
+import json
+import logging
+import uuid
+from fastapi import APIRouter, Depends, HTTPException, Header, Path, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from typing import List, Optional
+from psycopg2.extras import execute_values
+from ..database import get_db_connection, mark_write, ShardConnections
+from ..sharding import group_by_shard, scatter
 from ..dependencies import get_current_user
+from ..models import LabResultItem
+from ..config import UPLOAD_CHUNK_MAX_BYTES
+from .. import notifications, upload_jobs
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["Lab Operations"])
 
-# Modelo de validación
-class LabResultItem(BaseModel):
-    patient_id: str
-    test_code: str
-    test_name: str
-    value: float
-    unit: str
-    test_date: datetime # ✅ Acepta fechas pasadas
+# Tipos explícitos: dentro de un VALUES suelto Postgres no puede inferirlos
+VALUES_TEMPLATE = "(%s, %s, %s, %s::numeric, %s, %s::timestamp)"
 
 @router.post("/lab/upload-results")
 def upload_lab_results(
@@ -26,31 +29,51 @@ def upload_lab_results(
     if "Labs" not in groups and "Admins" not in groups:
         raise HTTPException(status_code=403, detail="Acceso denegado. Solo Labs.")
 
-    conn = get_db_connection()
+    # 2. Inserción Masiva Optimizada: UN solo INSERT multi-fila por shard (executemany hacía
+    # un INSERT por registro, y cada uno disparaba el trigger de versiones).
+    # La bandera de anormal se calcula aquí mismo contra los rangos de referencia.
+    # ON CONFLICT DO NOTHING (índice único de dedup_key): reenviar un lote que ya entró
+    # (reintento del navegador tras un timeout) no duplica resultados.
+    query = """
+        INSERT INTO lab_results (patient_id, test_code, test_name, value, unit, test_date, abnormal_flag)
+        SELECT v.*, lab_abnormal_flag(v.patient_id, v.test_code, v.value, v.test_date)
+        FROM (VALUES %s) AS v (patient_id, test_code, test_name, value, unit, test_date)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    """
+    # Convertimos objetos a tuplas, agrupadas por el shard de cada paciente
+    rows_by_shard = group_by_shard(
+        [(r.patient_id, r.test_code, r.test_name, r.value, r.unit, r.test_date) for r in results],
+        key=lambda row: row[0],
+    )
+    conns = ShardConnections()
+
+    def insert_shard(shard):
+        with conns.get(shard).cursor() as cursor:
+            return len(execute_values(cursor, query, rows_by_shard[shard], template=VALUES_TEMPLATE, page_size=1000, fetch=True))
+
     try:
-        with conn.cursor() as cursor:
-            # 2. Inserción Masiva Optimizada
-            query = """
-                INSERT INTO lab_results (patient_id, test_code, test_name, value, unit, test_date)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """
-            # Convertimos objetos a tuplas
-            data_tuples = [
-                (r.patient_id, r.test_code, r.test_name, r.value, r.unit, r.test_date) 
-                for r in results
-            ]
-            
-            cursor.executemany(query, data_tuples)
-            conn.commit()
-            
-            return {"message": f"✅ Procesado: {len(results)} registros insertados."}
-            
+        inserted = sum(scatter(insert_shard, rows_by_shard, operation="upload_results"))
+        # Commit recién cuando TODOS los shards aceptaron su parte: un lote rechazado no queda a medias
+        conns.commit()
+        mark_write(user)
+        notifications.publish(notifications.results_event(
+            "insert", [(r.patient_id, r.test_code, r.test_date) for r in results]
+        ))
+        duplicates = len(results) - inserted
+        message = f"✅ Procesado: {inserted} registros insertados."
+        if duplicates:
+            message += f" {duplicates} ya existían (omitidos)."
+        return {"message": message, "inserted": inserted, "duplicates": duplicates}
+
+    except HTTPException:
+        raise
     except Exception as e:
-        conn.rollback()
-        print(f"Error Bulk Upload: {e}")
+        conns.rollback()
+        logger.exception("Error Bulk Upload: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        conn.close()
+        conns.close()
 
 # ... (imports anteriores se mantienen) ...
 from datetime import date # Asegúrate de importar date
@@ -69,7 +92,7 @@ def delete_lab_results(
     if "Labs" not in groups and "Admins" not in groups:
         raise HTTPException(status_code=403, detail="Acceso denegado.")
 
-    conn = get_db_connection()
+    conn = get_db_connection(patient_id)
     try:
         with conn.cursor() as cursor:
             # 2. Ejecutar borrado por rango
@@ -84,6 +107,11 @@ def delete_lab_results(
             cursor.execute(query, (patient_id, test_code, start_date, end_date))
             deleted_count = cursor.rowcount # Obtenemos cuántos se borraron
             conn.commit()
+            mark_write(user)
+            if deleted_count:
+                notifications.publish({"op": "delete", "items": [
+                    {"patient_id": patient_id, "test_code": test_code, "count": deleted_count, "last_date": None}
+                ]})
             
             if deleted_count == 0:
                 return {"message": "⚠️ No se encontraron registros en ese rango para borrar.", "count": 0}
@@ -92,7 +120,92 @@ def delete_lab_results(
 
     except Exception as e:
         conn.rollback()
-        print(f"Error Delete: {e}")
+        logger.exception("Error Delete: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+# ✅ CARGA MASIVA REANUDABLE (trabajos por partes; detalle en upload_jobs.py)
+# 1. POST /lab/upload-jobs                          -> job_id
+# 2. PUT  /lab/upload-jobs/{job_id}/chunks/{n}      -> cuerpo = lista JSON de resultados,
+#         header X-Chunk-SHA256 = sha256 (hex) del cuerpo; n = 0, 1, 2... en orden
+# 3. POST /lab/upload-jobs/{job_id}/complete        -> se procesa en segundo plano
+# 4. GET  /lab/upload-jobs/{job_id}                 -> avance; next_chunk para retomar la subida
+def _job_owner(user: dict) -> str:
+    groups = user.get("cognito:groups", [])
+    if "Labs" not in groups and "Admins" not in groups:
+        raise HTTPException(status_code=403, detail="Acceso denegado. Solo Labs.")
+    return user.get("username") or user.get("sub")
+
+def _load_job(job_id: uuid.UUID, user: dict) -> dict:
+    owner = _job_owner(user)
+    job = upload_jobs.get_job(str(job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado.")
+    if job["created_by"] != owner and "Admins" not in user.get("cognito:groups", []):
+        raise HTTPException(status_code=403, detail="El trabajo es de otro usuario.")
+    return job
+
+def _job_call(fn, *args):
+    try:
+        return fn(*args)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@router.post("/lab/upload-jobs", status_code=201)
+def create_upload_job(user: dict = Depends(get_current_user)):
+    return upload_jobs.create_job(_job_owner(user))
+
+@router.get("/lab/upload-jobs/{job_id}")
+def get_upload_job(job_id: uuid.UUID, user: dict = Depends(get_current_user)):
+    return _load_job(job_id, user)
+
+@router.put("/lab/upload-jobs/{job_id}/chunks/{seq}")
+async def upload_job_chunk(
+    request: Request,
+    job_id: uuid.UUID,
+    seq: int = Path(..., ge=0),
+    chunk_sha256: str = Header(..., alias="X-Chunk-SHA256"),
+    content_length: Optional[int] = Header(None),
+    user: dict = Depends(get_current_user),
+):
+    too_large = HTTPException(status_code=413, detail=f"Cada parte puede pesar hasta {UPLOAD_CHUNK_MAX_BYTES} bytes.")
+    if content_length is not None and content_length > UPLOAD_CHUNK_MAX_BYTES:
+        raise too_large
+    # Sin Content-Length (transfer-encoding chunked) se corta apenas se pasa del tope,
+    # en vez de juntar en memoria un cuerpo de cualquier tamaño
+    parts, size = [], 0
+    async for part in request.stream():
+        size += len(part)
+        if size > UPLOAD_CHUNK_MAX_BYTES:
+            raise too_large
+        parts.append(part)
+    payload = b"".join(parts)
+
+    def store():
+        # sha256 + json.loads de varios MB: en el threadpool, no en el event loop
+        # El checksum se verifica ANTES de confirmar: una parte corrupta nunca queda guardada
+        digest = upload_jobs.checksum(payload)
+        if digest != chunk_sha256.strip().lower():
+            raise HTTPException(status_code=400, detail=f"Checksum inválido: la parte llegó con sha256 {digest}.")
+        try:
+            records = json.loads(payload)
+        except ValueError:
+            records = None
+        if not isinstance(records, list):
+            raise HTTPException(status_code=400, detail="La parte debe ser una lista JSON de resultados.")
+        _load_job(job_id, user)
+        return _job_call(upload_jobs.put_chunk, str(job_id), seq, payload, digest, len(records))
+
+    return await run_in_threadpool(store)
+
+@router.post("/lab/upload-jobs/{job_id}/complete", status_code=202)
+def complete_upload_job(
+    job_id: uuid.UUID,
+    total_chunks: Optional[int] = Query(None, ge=0, description="Partes enviadas (verifica que no falte ninguna)"),
+    user: dict = Depends(get_current_user),
+):
+    _load_job(job_id, user)
+    return _job_call(upload_jobs.complete_job, str(job_id), total_chunks)
@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException
-from psycopg2.extras import RealDictCursor
-from ..database import get_db_connection
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import Optional
+from datetime import datetime
+from ..database import get_db_connection, get_read_connection, mark_write
+from ..sharding import all_shards, is_sharded, merge_sorted, scatter
 from ..dependencies import get_current_user
 from ..models import ProfileRequest
+from ..serialization import FastJSONResponse, fast_cursor, fetch_dicts
+from ..reference_ranges import REFLAG_PATIENT_SQL
 
 router = APIRouter(tags=["Patients"])
 
@@ -11,7 +15,7 @@ router = APIRouter(tags=["Patients"])
 def update_profile(profile: ProfileRequest, user: dict = Depends(get_current_user)):
     patient_id = user.get("username") or user.get("sub")
     email = user.get("email")
-    conn = get_db_connection()
+    conn = get_db_connection(patient_id)
     try:
         with conn.cursor() as cursor:
             sql = """
@@ -21,14 +25,17 @@ def update_profile(profile: ProfileRequest, user: dict = Depends(get_current_use
             full_name = EXCLUDED.full_name, dob = EXCLUDED.dob, gender = EXCLUDED.gender, email = EXCLUDED.email;
             """
             cursor.execute(sql, (patient_id, profile.full_name, profile.dob, profile.gender, email))
+            # Los rangos por sexo / edad dependen del perfil
+            cursor.execute(REFLAG_PATIENT_SQL, (patient_id,))
             conn.commit()
+            mark_write(user)
             return {"message": "Perfil actualizado"}
     finally: 
         conn.close()
 
 # ✅ CORREGIDO: De "/patients" a "/"
 # Ruta final: /patients (Porque main.py ya agrega el prefijo "/patients")
-@router.get("/")
+@router.get("/", response_class=FastJSONResponse)
 def list_patients(user: dict = Depends(get_current_user)):
     groups = user.get("cognito:groups", [])
     
@@ -36,27 +43,101 @@ def list_patients(user: dict = Depends(get_current_user)):
     if "Doctors" not in groups and "Labs" not in groups and "Admins" not in groups:
         raise HTTPException(status_code=403, detail="Acceso denegado.")
     
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            # SQL para unir perfiles con resultados de laboratorio
-            sql = """
-            SELECT COALESCE(p.patient_id, l.patient_id) as id, COALESCE(p.full_name, 'Sin Nombre') as name, p.email
-            FROM patient_profiles p FULL OUTER JOIN (SELECT DISTINCT patient_id FROM lab_results) l ON p.patient_id = l.patient_id ORDER BY name;
-            """
-            cursor.execute(sql)
-            results = cursor.fetchall()
-            
-            # Formateo de la respuesta para el Frontend
-            formatted = []
-            for row in results:
-                display = row['name']
-                if row.get('email'): 
-                    display += f" ({row['email']})"
-                elif row['name'] == 'Sin Nombre': 
-                    display += f" (ID: {row['id'][:8]}...)"
-                formatted.append({"id": row['id'], "name": display})
-            
-            return formatted
-    finally: 
-        conn.close()
\ No newline at end of file
+    def shard_patients(shard):
+        conn = get_read_connection(user, shard=shard)
+        try:
+            with fast_cursor(conn) as cursor:
+                # SQL para unir perfiles con resultados de laboratorio (el perfil vive en el shard del paciente)
+                sql = """
+                SELECT COALESCE(p.patient_id, l.patient_id) as id, COALESCE(p.full_name, 'Sin Nombre') as name, p.email
+                FROM patient_profiles p FULL OUTER JOIN (SELECT DISTINCT patient_id FROM lab_results) l ON p.patient_id = l.patient_id ORDER BY name;
+                """
+                cursor.execute(sql)
+                return cursor.fetchall()
+        finally: 
+            conn.close()
+
+    # Cada shard ya viene ordenado por nombre: solo se intercalan
+    results = merge_sorted(scatter(shard_patients, operation="list_patients"), key=lambda row: row[1])
+
+    # Formateo de la respuesta para el Frontend (tuplas: id, name, email)
+    formatted = []
+    for p_id, name, email in results:
+        display = name
+        if email: 
+            display += f" ({email})"
+        elif name == 'Sin Nombre': 
+            display += f" (ID: {p_id[:8]}...)"
+        formatted.append({"id": p_id, "name": display})
+    
+    return FastJSONResponse(formatted)
+
+# ✅ Worklist de resultados anormales recientes (para médicos)
+# Ruta final: /patients/abnormal-results
+# Paginación por cursor (test_date, id): cada página es un tramo del índice parcial
+# idx_lab_results_abnormal_recent, sin OFFSET ni escaneo de resultados normales.
+# Con sharding cada shard aporta su página y se intercalan; los id son por shard, así
+# que el cursor lleva también la posición del shard para desempatar (test_date, id).
+@router.get("/abnormal-results", response_class=FastJSONResponse)
+def list_abnormal_results(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    test_code: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    groups = user.get("cognito:groups", [])
+    if "Doctors" not in groups and "Admins" not in groups:
+        raise HTTPException(status_code=403, detail="Acceso denegado.")
+
+    before = None
+    if cursor:
+        try:
+            parts = cursor.split("|")
+            if len(parts) not in (2, 3):
+                raise ValueError(cursor)
+            before = (datetime.fromisoformat(parts[0]), int(parts[1]), int(parts[2]) if len(parts) == 3 else 0)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Cursor inválido")
+
+    shards = all_shards()
+
+    def shard_page(shard):
+        position = shards.index(shard)
+        sql = """
+            SELECT l.id, l.patient_id, p.full_name AS patient_name, l.test_code, l.test_name,
+                   l.value, l.unit, l.test_date, l.abnormal_flag
+            FROM lab_results l LEFT JOIN patient_profiles p ON p.patient_id = l.patient_id
+            WHERE l.abnormal_flag IS NOT NULL AND l.test_date IS NOT NULL
+        """
+        params = []
+        if before:
+            # Mismo (test_date, id) en un shard anterior al del cursor = todavía no se devolvió
+            sql += " AND (l.test_date, l.id) < (%s, %s)" if position >= before[2] else " AND (l.test_date, l.id) <= (%s, %s)"
+            params += [before[0], before[1]]
+        if test_code:
+            sql += " AND l.test_code = %s"
+            params.append(test_code)
+        sql += " ORDER BY l.test_date DESC NULLS LAST, l.id DESC LIMIT %s"
+        params.append(limit)
+
+        conn = get_read_connection(user, shard=shard)
+        try:
+            with fast_cursor(conn) as cur:
+                cur.execute(sql, tuple(params))
+                return [(position, item) for item in fetch_dicts(cur)]
+        finally:
+            conn.close()
+
+    page = merge_sorted(
+        scatter(shard_page, operation="abnormal_results"),
+        key=lambda entry: (entry[1]["test_date"], entry[1]["id"], entry[0]), reverse=True, limit=limit,
+    )
+    items = [item for _, item in page]
+
+    next_cursor = None
+    if len(items) == limit:
+        position, last = page[-1]
+        next_cursor = f"{last['test_date'].isoformat()}|{last['id']}"
+        if is_sharded():
+            next_cursor += f"|{position}"
+    return FastJSONResponse({"items": items, "next_cursor": next_cursor})
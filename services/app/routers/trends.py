@@ -1,21 +1,43 @@
-from fastapi import APIRouter, Depends, HTTPException
+import logging
+from fastapi import APIRouter, Depends, HTTPException, Header, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from psycopg2.extras import RealDictCursor
 from typing import Optional
 from decimal import Decimal
 import math
-from ..database import get_db_connection
+import calendar
+from datetime import datetime, timezone
+from ..database import get_read_connection
+from ..sharding import scatter
 from ..dependencies import get_current_user
+from ..versioning import Validators, test_validators, patient_validators
+from ..trend_state import trend_statistics
+from ..patient_summary import summary_tests
+from ..rollups import RESOLUTIONS, pick_resolution
+from ..sketches import Sketch
+from ..config import SKETCH_RELATIVE_ACCURACY
+from ..serialization import (
+    FastJSONResponse, ColumnarJSONResponse, fast_cursor, fetch_dicts, wants_columnar, to_columns,
+)
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["Trends"])
 
 # 1. Obtener lista de exámenes disponibles
-@router.get("/patient/{patient_id}/available_tests")
-def get_available_tests(patient_id: str, user: dict = Depends(get_current_user)):
+@router.get("/patient/{patient_id}/available_tests", response_class=FastJSONResponse)
+def get_available_tests(patient_id: str, request: Request, user: dict = Depends(get_current_user)):
     # ... (validaciones de seguridad igual que antes) ...
     
-    conn = get_db_connection()
+    conn = get_read_connection(user, patient_id)
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        with fast_cursor(conn) as cursor:
+            # GET condicional: si los datos del paciente no cambiaron, 304 sin correr el DISTINCT
+            validators = patient_validators(conn, patient_id, variant="available_tests")
+            if validators.matches(request):
+                return validators.not_modified()
+
             # ✅ CORRECCIÓN: Agregamos ', unit' al SELECT
             cursor.execute("""
                 SELECT DISTINCT test_code, test_name, unit 
@@ -23,17 +45,20 @@ def get_available_tests(patient_id: str, user: dict = Depends(get_current_user))
                 WHERE patient_id = %s 
                 ORDER BY test_name
             """, (patient_id,))
-            return cursor.fetchall()
+            return validators.apply(FastJSONResponse(fetch_dicts(cursor)))
     finally:
         conn.close()
 
 # 2. Obtener historial detallado (Diario) - Consultas < 90 días
-@router.get("/patient/{patient_id}/trends/{test_code}")
+@router.get("/patient/{patient_id}/trends/{test_code}", response_class=FastJSONResponse)
 def get_trends(
     patient_id: str, 
     test_code: str, 
+    request: Request,
     start_date: Optional[str] = None, 
     end_date: Optional[str] = None, 
+    response_format: Optional[str] = Query(None, alias="format"),
+    accept: Optional[str] = Header(None),
     user: dict = Depends(get_current_user)
 ):
     groups = user.get("cognito:groups", [])
@@ -41,16 +66,33 @@ def get_trends(
         if (user.get("username") or user.get("sub")) != patient_id: 
             raise HTTPException(status_code=403, detail="Prohibido")
 
-    conn = get_db_connection()
+    conn = get_read_connection(user, patient_id)
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        # Ruta rápida: tuplas + NUMERIC como float + orjson (historiales de decenas de miles de filas)
+        with fast_cursor(conn) as cursor:
+            columnar = wants_columnar(response_format, accept)
+            validators = test_validators(
+                conn, patient_id, test_code, variant=f"trends|{columnar}|{start_date}|{end_date}"
+            )
+            if validators.matches(request):
+                return validators.not_modified()
+
             # Consulta estándar a la tabla gigante
-            query = """
-                SELECT test_date, value, unit, 
-                AVG(value) OVER (ORDER BY test_date ROWS BETWEEN 2 PRECEDING AND CURRENT ROW) as moving_avg_3_points 
-                FROM lab_results 
-                WHERE patient_id = %s AND test_code = %s
-            """
+            if columnar:
+                # Formato compacto: epoch en segundos y promedio redondeado a la precisión del dato
+                query = """
+                    SELECT EXTRACT(EPOCH FROM test_date)::bigint, value, 
+                    ROUND(AVG(value) OVER (ORDER BY test_date ROWS BETWEEN 2 PRECEDING AND CURRENT ROW), 2), unit 
+                    FROM lab_results 
+                    WHERE patient_id = %s AND test_code = %s
+                """
+            else:
+                query = """
+                    SELECT test_date, value, unit, 
+                    AVG(value) OVER (ORDER BY test_date ROWS BETWEEN 2 PRECEDING AND CURRENT ROW) as moving_avg_3_points 
+                    FROM lab_results 
+                    WHERE patient_id = %s AND test_code = %s
+                """
             params = [patient_id, test_code]
             
             if start_date: 
@@ -63,20 +105,36 @@ def get_trends(
             query += " ORDER BY test_date ASC;"
             
             cursor.execute(query, tuple(params))
-            return {
+            if columnar:
+                return validators.apply(ColumnarJSONResponse(_columnar_history(patient_id, test_code, cursor.fetchall())))
+            return validators.apply(FastJSONResponse({
                 "patient_id": patient_id, 
                 "test_code": test_code, 
-                "history": cursor.fetchall()
-            }
+                "history": fetch_dicts(cursor)
+            }))
     finally:
         conn.close()
 
-# ✅ 3. NUEVO ENDPOINT OPTIMIZADO (VISTA MATERIALIZADA)
+def _columnar_history(patient_id, test_code, rows):
+    """Historial como arrays paralelos; la unidad va una sola vez (o como array si hay mezcla)."""
+    payload = {"patient_id": patient_id, "test_code": test_code, "format": "columnar"}
+    payload.update(to_columns([r[:3] for r in rows], ["timestamps", "values", "moving_avg_3_points"]))
+    units = {r[3] for r in rows}
+    if len(units) <= 1:
+        payload["unit"] = units.pop() if units else None
+    else:
+        payload["units"] = [r[3] for r in rows]
+    return payload
+
+# ✅ 3. NUEVO ENDPOINT OPTIMIZADO (ROLLUP MENSUAL PRECALCULADO)
 # Para consultas de largo plazo (> 90 días)
-@router.get("/patient/{patient_id}/monthly-trends/{test_code}")
+@router.get("/patient/{patient_id}/monthly-trends/{test_code}", response_class=FastJSONResponse)
 def get_monthly_trends(
     patient_id: str, 
     test_code: str, 
+    request: Request,
+    response_format: Optional[str] = Query(None, alias="format"),
+    accept: Optional[str] = Header(None),
     user: dict = Depends(get_current_user)
 ):
     # Misma seguridad
@@ -85,32 +143,44 @@ def get_monthly_trends(
         if (user.get("username") or user.get("sub")) != patient_id: 
             raise HTTPException(status_code=403, detail="Prohibido")
 
-    conn = get_db_connection()
+    conn = get_read_connection(user, patient_id)
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            # Consultamos la VISTA MATERIALIZADA en lugar de la tabla gigante
+        with fast_cursor(conn) as cursor:
+            columnar = wants_columnar(response_format, accept)
+            validators = test_validators(conn, patient_id, test_code, variant=f"monthly|{columnar}")
+            if validators.matches(request):
+                return validators.not_modified()
+
+            # Consultamos el rollup mensual en lugar de la tabla gigante
             # Esto retorna el promedio ya calculado, mucho más rápido
             query = """
                 SELECT 
-                    month as date, 
-                    ROUND(avg_val::numeric, 2) as average, 
-                    ROUND(min_val::numeric, 2) as min, 
-                    ROUND(max_val::numeric, 2) as max,
-                    total_tests as count
-                FROM patient_monthly_stats 
-                WHERE patient_id = %s AND test_code = %s
-                ORDER BY month ASC
+                    bucket_start as date, 
+                    ROUND((sum / count)::numeric, 2) as average, 
+                    ROUND(min::numeric, 2) as min, 
+                    ROUND(max::numeric, 2) as max,
+                    count
+                FROM lab_rollups 
+                WHERE patient_id = %s AND test_code = %s AND resolution = 'month'
+                ORDER BY bucket_start ASC
             """
             cursor.execute(query, (patient_id, test_code))
+
+            if columnar:
+                rows = [(calendar.timegm(r[0].timetuple()),) + tuple(r[1:]) for r in cursor.fetchall()]
+                return validators.apply(ColumnarJSONResponse(dict(
+                    {"patient_id": patient_id, "test_code": test_code, "format": "columnar"},
+                    **to_columns(rows, ["months", "average", "min", "max", "count"]),
+                )))
             
-            return {
+            return validators.apply(FastJSONResponse({
                 "patient_id": patient_id, 
                 "test_code": test_code, 
-                "monthly_data": cursor.fetchall()
-            }
+                "monthly_data": fetch_dicts(cursor)
+            }))
     except Exception as e:
-        print(f"Error consultando vista materializada: {e}")
-        # Si la vista no existe (aún no se corrió el script de admin), retornamos lista vacía para no romper el front
+        logger.warning("Error consultando rollup mensual: %s", e)
+        # Si la tabla no existe (falló la migración de startup), retornamos lista vacía para no romper el front
         return {"patient_id": patient_id, "monthly_data": []}
     finally:
         conn.close()
@@ -119,6 +189,7 @@ def get_monthly_trends(
 def get_risk_analysis(
     patient_id: str, 
     test_code: str, 
+    request: Request,
     user: dict = Depends(get_current_user)
 ):
     # Misma seguridad (se omite para brevedad)
@@ -127,9 +198,13 @@ def get_risk_analysis(
         if (user.get("username") or user.get("sub")) != patient_id: 
             raise HTTPException(status_code=403, detail="Prohibido")
 
-    conn = get_db_connection()
+    conn = get_read_connection(user, patient_id)
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            validators = test_validators(conn, patient_id, test_code, variant="risk")
+            if validators.matches(request):
+                return validators.not_modified()
+
             # 1. Traer los últimos 9 resultados (para detectar cambios graduales)
             query = """
                 SELECT 
@@ -144,7 +219,7 @@ def get_risk_analysis(
             recent_results = cursor.fetchall()
             
             if len(recent_results) < 3:
-                return {"trend": "insufficient_data", "alert": "⚠️ Pocos datos para análisis"}
+                return validators.apply(JSONResponse({"trend": "insufficient_data", "alert": "⚠️ Pocos datos para análisis"}))
 
             # Convertir a listas para el análisis estadístico simple
             values = [r['value'] for r in reversed(recent_results)] # ASC orden
@@ -180,7 +255,7 @@ def get_risk_analysis(
                 alert_level = "none"
                 alert_message = "Necesita al menos 6 resultados para análisis de tendencia."
                 
-            return {
+            return validators.apply(JSONResponse(jsonable_encoder({
                 "patient_id": patient_id,
                 "test_code": test_code,
                 "latest_value": values[-1],
@@ -189,10 +264,297 @@ def get_risk_analysis(
                 "alert_level": alert_level,
                 "alert_message": alert_message,
                 "change_percent": round(change_percent, 2) if 'change_percent' in locals() else None
-            }
+            })))
             
     except Exception as e:
-        print(f"Error en Risk Analysis: {e}")
+        logger.exception("Error en Risk Analysis: %s", e)
         raise HTTPException(status_code=500, detail="Error en el análisis predictivo.")
     finally:
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+# 4. Estadísticos de tendencia incrementales (EWMA, media/varianza, pendiente)
+# Una sola lectura por PK de lab_trend_state: nunca recorre el historial.
+@router.get("/patient/{patient_id}/trend-stats/{test_code}", response_class=FastJSONResponse)
+def get_trend_statistics(
+    patient_id: str,
+    test_code: str,
+    request: Request,
+    user: dict = Depends(get_current_user)
+):
+    groups = user.get("cognito:groups", [])
+    if "Patients" in groups and not any(r in groups for r in ["Doctors", "Labs", "Admins"]):
+        if (user.get("username") or user.get("sub")) != patient_id:
+            raise HTTPException(status_code=403, detail="Prohibido")
+
+    conn = get_read_connection(user, patient_id)
+    try:
+        with fast_cursor(conn) as cursor:
+            validators = test_validators(conn, patient_id, test_code, variant="trend-stats")
+            if validators.matches(request):
+                return validators.not_modified()
+
+            cursor.execute(
+                "SELECT * FROM lab_trend_state WHERE patient_id = %s AND test_code = %s",
+                (patient_id, test_code),
+            )
+            rows = fetch_dicts(cursor)
+            if not rows:
+                raise HTTPException(status_code=404, detail="Sin resultados para ese examen")
+            return validators.apply(FastJSONResponse(dict(
+                {"patient_id": patient_id, "test_code": test_code}, **trend_statistics(rows[0])
+            )))
+    finally:
+        conn.close()
+
+
+# 5. Historial a cualquier zoom desde la pirámide de rollups
+# Elige la resolución más gruesa que todavía da >= min_points buckets en el rango
+# (o la que se pida explícitamente). Los buckets de los bordes pueden incluir
+# resultados un poco fuera del rango: se devuelven completos.
+@router.get("/patient/{patient_id}/rollups/{test_code}", response_class=FastJSONResponse)
+def get_rollups(
+    patient_id: str,
+    test_code: str,
+    request: Request,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    min_points: int = Query(100, ge=1, le=2000),
+    resolution: Optional[str] = None,
+    response_format: Optional[str] = Query(None, alias="format"),
+    accept: Optional[str] = Header(None),
+    user: dict = Depends(get_current_user)
+):
+    groups = user.get("cognito:groups", [])
+    if "Patients" in groups and not any(r in groups for r in ["Doctors", "Labs", "Admins"]):
+        if (user.get("username") or user.get("sub")) != patient_id:
+            raise HTTPException(status_code=403, detail="Prohibido")
+    if resolution is not None and resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"Resolución inválida. Opciones: {', '.join(RESOLUTIONS)}")
+
+    conn = get_read_connection(user, patient_id)
+    try:
+        with fast_cursor(conn) as cursor:
+            columnar = wants_columnar(response_format, accept)
+            validators = test_validators(
+                conn, patient_id, test_code,
+                variant=f"rollups|{columnar}|{start_date}|{end_date}|{min_points}|{resolution}",
+            )
+            if validators.matches(request):
+                return validators.not_modified()
+
+            chosen = resolution or pick_resolution(cursor, patient_id, test_code, start_date, end_date, min_points)
+            query = """
+                SELECT bucket_start, count,
+                       ROUND((sum / count)::numeric, 2) AS average,
+                       ROUND(min::numeric, 2) AS min,
+                       ROUND(max::numeric, 2) AS max,
+                       ROUND(SQRT(GREATEST(sumsq - sum * sum / count, 0) / NULLIF(count - 1, 0))::numeric, 2) AS stddev
+                FROM lab_rollups
+                WHERE patient_id = %s AND test_code = %s AND resolution = %s
+            """
+            params = [patient_id, test_code, chosen]
+            if start_date:
+                query += " AND bucket_start >= date_trunc(%s, %s::timestamp)"
+                params += [chosen, start_date]
+            if end_date:
+                query += " AND bucket_start <= %s::timestamp"
+                params.append(end_date)
+            query += " ORDER BY bucket_start ASC"
+            cursor.execute(query, tuple(params))
+
+            payload = {"patient_id": patient_id, "test_code": test_code, "resolution": chosen}
+            if columnar:
+                rows = [(calendar.timegm(r[0].timetuple()),) + tuple(r[1:]) for r in cursor.fetchall()]
+                payload["format"] = "columnar"
+                payload.update(to_columns(rows, ["buckets", "count", "average", "min", "max", "stddev"]))
+                return validators.apply(ColumnarJSONResponse(payload))
+            payload["buckets"] = fetch_dicts(cursor)
+            return validators.apply(FastJSONResponse(payload))
+    finally:
+        conn.close()
+
+
+# 6. Percentiles de población de un examen (y el percentil de un paciente)
+# Se fusionan los sketches mensuales del rango (unos cientos de filas por mes):
+# nunca se recorre lab_results.
+@router.get("/population/{test_code}/percentiles", response_class=FastJSONResponse)
+def get_population_percentiles(
+    test_code: str,
+    start_month: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    end_month: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    percentiles: str = "5,25,50,75,95",
+    patient_id: Optional[str] = None,
+    value: Optional[float] = None,
+    user: dict = Depends(get_current_user)
+):
+    groups = user.get("cognito:groups", [])
+    if "Doctors" not in groups and "Admins" not in groups:
+        raise HTTPException(status_code=403, detail="Solo médicos")
+    try:
+        requested = [float(p) for p in percentiles.split(",")]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="percentiles debe ser una lista de números separados por coma")
+    if any(p < 0 or p > 100 for p in requested):
+        raise HTTPException(status_code=400, detail="Los percentiles van de 0 a 100")
+
+    query = "SELECT sign, bucket, SUM(count) FROM lab_value_sketches WHERE test_code = %s"
+    params = [test_code]
+    if start_month:
+        query += " AND month >= %s::date"
+        params.append(f"{start_month}-01")
+    if end_month:
+        query += " AND month <= %s::date"
+        params.append(f"{end_month}-01")
+    query += " GROUP BY sign, bucket"
+
+    def shard_sketch(shard):
+        conn = get_read_connection(user, shard=shard)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(query, tuple(params))
+                return cursor.fetchall()
+        finally:
+            conn.close()
+
+    # Cada shard tiene los sketches de SUS pacientes: se suman los conteos por bucket
+    sketch = Sketch.merged(scatter(shard_sketch, operation="population_percentiles"))
+
+    # Sin valor explícito usamos el último resultado del paciente (lectura por PK en su shard)
+    if patient_id and value is None:
+        conn = get_read_connection(user, patient_id)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT last_value FROM lab_trend_state WHERE patient_id = %s AND test_code = %s",
+                    (patient_id, test_code),
+                )
+                row = cursor.fetchone()
+                value = row[0] if row else None
+        finally:
+            conn.close()
+
+    if not sketch.count:
+        raise HTTPException(status_code=404, detail="Sin resultados para ese examen en el rango")
+
+    payload = {
+        "test_code": test_code,
+        "start_month": start_month,
+        "end_month": end_month,
+        "count": sketch.count,
+        "relative_accuracy": SKETCH_RELATIVE_ACCURACY,
+        "percentiles": {f"p{p:g}": round(sketch.quantile(p / 100), 2) for p in requested},
+    }
+    if value is not None:
+        payload["patient"] = {
+            "patient_id": patient_id,
+            "value": value,
+            "percentile_rank": round(sketch.percentile_rank(value), 1),
+        }
+    return FastJSONResponse(payload)
+
+
+def _epoch(text, name):
+    """Fecha ISO -> epoch en segundos (sin zona = UTC, igual que EXTRACT(EPOCH FROM timestamp))."""
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} inválida (se espera AAAA-MM-DD o ISO 8601)")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+# 7. Indicadores de tendencia (medias móviles, EWMA, tasa de cambio, z-score) en NumPy
+# La serie se lee UNA vez y los indicadores se calculan sobre el historial completo
+# (así la ventana del primer punto del rango ve los datos anteriores); después se
+# recorta al rango y, si se pide, se reduce a max_points conservando mínimos y máximos.
+# NumPy se importa en la primera llamada (no en el arranque de cada worker).
+@router.get("/patient/{patient_id}/analytics/{test_code}", response_class=FastJSONResponse)
+def get_analytics(
+    patient_id: str,
+    test_code: str,
+    request: Request,
+    indicators: Optional[str] = Query(None, description="Ej: sma:7d,sma:30d,ewma:14d,roc:90d,zscore (por defecto sma:30d,sma:90d,ewma:30d,roc:90d,zscore)"),
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    max_points: Optional[int] = Query(None, ge=10, le=100000),
+    baseline: str = Query("365d", description="Periodo inicial de la serie que define la línea base del z-score"),
+    user: dict = Depends(get_current_user)
+):
+    groups = user.get("cognito:groups", [])
+    if "Patients" in groups and not any(r in groups for r in ["Doctors", "Labs", "Admins"]):
+        if (user.get("username") or user.get("sub")) != patient_id:
+            raise HTTPException(status_code=403, detail="Prohibido")
+    from .. import indicators as ind
+
+    try:
+        specs = ind.parse_indicators(indicators or ind.DEFAULT_INDICATORS)
+        baseline_window = ind.parse_window(baseline)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    start = _epoch(start_date, "start_date") if start_date else None
+    end = _epoch(end_date, "end_date") if end_date else None
+
+    conn = get_read_connection(user, patient_id)
+    try:
+        validators = test_validators(
+            conn, patient_id, test_code,
+            variant=f"analytics|{indicators}|{start_date}|{end_date}|{max_points}|{baseline}",
+        )
+        if validators.matches(request):
+            return validators.not_modified()
+        with conn.cursor() as cursor:
+            t, v, unit = ind.load_series(cursor, patient_id, test_code)
+    finally:
+        conn.close()  # El cálculo no necesita la conexión: se devuelve antes
+    if not len(t):
+        raise HTTPException(status_code=404, detail="Sin resultados para ese examen")
+
+    results, baseline_stats = ind.compute(t, v, specs, baseline_window)
+    points, keep = ind.select(t, v, start, end, max_points)
+
+    payload = {
+        "patient_id": patient_id,
+        "test_code": test_code,
+        "unit": unit,
+        "points": points,
+        "returned": len(keep),
+        "timestamps": t[keep].astype("int64").tolist(),
+        "values": v[keep].tolist(),
+        # NaN (sin datos suficientes en la ventana) sale como null
+        "indicators": {key: values[keep].round(4).tolist() for key, values in results.items()},
+    }
+    if baseline_stats is not None:
+        payload["baseline"] = baseline_stats
+    return validators.apply(FastJSONResponse(payload))
+
+
+# 8. Resumen del paciente para el primer render del dashboard
+# Por examen: último valor y fecha, cantidad, rango de fechas y nivel de riesgo. Una
+# lectura por PK de patient_summaries (la mantienen los triggers); el ETag sale de la misma fila.
+@router.get("/patient/{patient_id}/summary", response_class=FastJSONResponse)
+def get_patient_summary(patient_id: str, request: Request, user: dict = Depends(get_current_user)):
+    groups = user.get("cognito:groups", [])
+    if "Patients" in groups and not any(r in groups for r in ["Doctors", "Labs", "Admins"]):
+        if (user.get("username") or user.get("sub")) != patient_id:
+            raise HTTPException(status_code=403, detail="Prohibido")
+
+    conn = get_read_connection(user, patient_id)
+    try:
+        with fast_cursor(conn) as cursor:
+            cursor.execute(
+                "SELECT tests, version, updated_at FROM patient_summaries WHERE patient_id = %s", (patient_id,)
+            )
+            row = cursor.fetchone()
+    finally:
+        conn.close()
+
+    tests, version, updated_at = row or ({}, 0, None)
+    validators = Validators(version, updated_at, variant="summary")
+    if validators.matches(request):
+        return validators.not_modified()
+    return validators.apply(FastJSONResponse({
+        "patient_id": patient_id,
+        "updated_at": updated_at,
+        "tests": summary_tests(tests),
+    }))
@@ -0,0 +1,54 @@
+import orjson
+import psycopg2.extensions
+from fastapi.responses import Response
+
+# --- Ruta rápida de serialización para resultados grandes ---
+# En vez de RealDictCursor -> Decimal/datetime -> jsonable_encoder -> json.dumps,
+# pedimos tuplas, convertimos NUMERIC a float dentro de psycopg2 y codificamos
+# con orjson (que ya sabe serializar datetime/date en ISO 8601).
+
+NUMERIC_AS_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values,
+    "NUMERIC_AS_FLOAT",
+    lambda value, cursor: float(value) if value is not None else None,
+)
+
+
+def fast_cursor(conn):
+    """Cursor de tuplas con NUMERIC -> float (solo para este cursor, no global)."""
+    cursor = conn.cursor()
+    psycopg2.extensions.register_type(NUMERIC_AS_FLOAT, cursor)
+    return cursor
+
+
+def fetch_dicts(cursor):
+    """fetchall() como lista de dicts, sin el costo por fila de RealDictRow."""
+    columns = [col.name for col in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+class FastJSONResponse(Response):
+    """Respuesta JSON codificada con orjson (sin pasar por jsonable_encoder)."""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+# --- Formato columnar compacto (arrays paralelos) ---
+# Se negocia con ?format=columnar o con "Accept: application/vnd.healthtrends.columnar+json".
+COLUMNAR_MEDIA_TYPE = "application/vnd.healthtrends.columnar+json"
+
+
+def wants_columnar(response_format, accept) -> bool:
+    return response_format == "columnar" or (accept is not None and COLUMNAR_MEDIA_TYPE in accept)
+
+
+def to_columns(rows, names):
+    """[(a1, b1), (a2, b2)] -> {"a": [a1, a2], "b": [b1, b2]}"""
+    columns = list(zip(*rows)) if rows else [() for _ in names]
+    return {name: list(col) for name, col in zip(names, columns)}
+
+
+class ColumnarJSONResponse(FastJSONResponse):
+    media_type = COLUMNAR_MEDIA_TYPE
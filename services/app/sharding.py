@@ -0,0 +1,128 @@
+import bisect
+import contextvars
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from .config import DB_SHARDS, DB_HOST, DB_NAME, SHARD_VNODES, SHARD_SCATTER_WORKERS
+from .metrics import SHARD_SCATTER_SECONDS
+
+# --- Sharding de pacientes entre varias instancias de Postgres ---
+# Cada paciente vive ENTERO en un shard: lab_results, patient_profiles y todo lo que
+# mantienen los triggers (versiones, tendencias, rollups, sketches). El shard sale de
+# un anillo de hash consistente sobre el patient_id, con SHARD_VNODES puntos por shard
+# (clave = NOMBRE del shard: cambiar de host no mueve a nadie; agregar uno mueve ~1/N).
+# El catálogo (test_types, test_reference_ranges) está replicado en todos: se lee del
+# primer shard y se escribe en todos. Lo que cruza pacientes (listados, worklist,
+# percentiles) consulta todos los shards en paralelo (scatter) y mezcla en Python.
+# El worker de ingesta (processor/sharding.py) usa el mismo anillo: deben coincidir.
+
+Shard = namedtuple("Shard", ["name", "host", "port", "dbname"])
+
+
+def parse_shards(spec: str, default_host=DB_HOST, default_dbname=DB_NAME) -> list:
+    """ "s0=db-a,s1=db-b:5433/pacientes" -> [Shard]. Vacío = un solo shard "default" (DB_HOST)."""
+    shards = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, target = item.partition("=")
+        if not sep or not name.strip() or not target.strip():
+            raise ValueError(f"Shard inválido: {item!r} (se espera nombre=host[:puerto][/bd])")
+        address, _, dbname = target.strip().partition("/")
+        host, _, port = address.partition(":")
+        shards.append(Shard(name.strip(), host, int(port) if port else None, dbname or default_dbname))
+    if not shards:
+        return [Shard("default", default_host, None, default_dbname)]
+    names = [shard.name for shard in shards]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Nombres de shard repetidos: {names}")
+    return shards
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, shards, vnodes: int = SHARD_VNODES):
+        self.shards = list(shards)
+        points = sorted((_hash(f"{shard.name}#{i}"), n) for n, shard in enumerate(self.shards) for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._owners = [self.shards[n] for _, n in points]
+
+    def lookup(self, key: str) -> Shard:
+        if len(self.shards) == 1:
+            return self.shards[0]
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[i]
+
+
+SHARDS = parse_shards(DB_SHARDS)
+ring = HashRing(SHARDS)
+
+
+def is_sharded() -> bool:
+    return len(SHARDS) > 1
+
+
+def all_shards() -> list:
+    return SHARDS
+
+
+def home_shard() -> Shard:
+    """Donde se leen las tablas replicadas (y la única, sin sharding)."""
+    return SHARDS[0]
+
+
+def shard_for(patient_id) -> Shard:
+    return ring.lookup(str(patient_id))
+
+
+def group_by_shard(items, key) -> dict:
+    """{shard: [items]} según el patient_id que devuelve key(item); conserva el orden de llegada."""
+    groups = {}
+    for item in items:
+        groups.setdefault(shard_for(key(item)), []).append(item)
+    return groups
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=SHARD_SCATTER_WORKERS, thread_name_prefix="scatter")
+    return _executor
+
+
+def scatter(fn, shards=None, operation: str = "scatter") -> list:
+    """
+    fn(shard) en cada shard (por defecto todos) en paralelo -> resultados en el mismo orden.
+    Si alguno falla se re-lanza su excepción (HTTPException incluida). No anidar: fn no
+    debe llamar a scatter (el pool es compartido).
+    """
+    shards = list(SHARDS if shards is None else shards)
+    start = time.perf_counter()
+    try:
+        if len(shards) <= 1:
+            return [fn(shard) for shard in shards]
+        # Cada tarea con su copia del contexto: el log de queries usa la ruta actual (contextvars)
+        futures = [_pool().submit(contextvars.copy_context().run, fn, shard) for shard in shards]
+        return [future.result() for future in futures]
+    finally:
+        SHARD_SCATTER_SECONDS.labels(operation).observe(time.perf_counter() - start)
+
+
+def merge_sorted(lists, key=None, reverse=False, limit=None) -> list:
+    """Mezcla listas YA ordenadas (una por shard) sin reordenar todo."""
+    merged = heapq.merge(*lists, key=key, reverse=reverse)
+    return list(itertools.islice(merged, limit) if limit is not None else merged)
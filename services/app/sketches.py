@@ -0,0 +1,185 @@
+import math
+from .config import SKETCH_RELATIVE_ACCURACY
+
+# --- Sketches de cuantiles de población por (examen, mes) ---
+# DDSketch: cada valor cae en el bucket ceil(log_gamma |v|) y solo guardamos el
+# conteo por bucket. Cualquier cuantil sale con error relativo <= SKETCH_RELATIVE_ACCURACY
+# y el tamaño depende del rango de valores (unos cientos de buckets), no del volumen.
+# Es mergeable (sumar conteos: meses -> trimestres -> años) y, a diferencia de
+# t-digest/KLL, admite borrados exactos (restar conteos), así que lo mantiene un
+# trigger por SENTENCIA sobre lab_results igual que versioning.py.
+# Cambiar la precisión obliga a vaciar lab_value_sketches para que se reconstruya.
+
+GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+
+SKETCH_DDL = """
+CREATE TABLE IF NOT EXISTS lab_value_sketches (
+    test_code VARCHAR(50) NOT NULL, month DATE NOT NULL,
+    sign SMALLINT NOT NULL,          -- -1 / 0 / 1 (negativos y cero van en su propio "store")
+    bucket INTEGER NOT NULL,         -- ceil(ln|v| / ln gamma); 0 para el cero
+    count BIGINT NOT NULL,
+    PRIMARY KEY (test_code, month, sign, bucket)
+);
+
+CREATE OR REPLACE FUNCTION lab_sketch_bucket(v DOUBLE PRECISION) RETURNS INTEGER AS $$
+    SELECT CASE WHEN v = 0 THEN 0 ELSE ceil(ln(abs(v)) / ln(__GAMMA__))::integer END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION update_lab_value_sketches() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        -- Delta neto (+1 el valor nuevo, -1 el viejo) solo de las filas cuyo examen, fecha o valor
+        -- cambio: re-banderear (solo abnormal_flag) no mueve ningun bucket
+        INSERT INTO lab_value_sketches (test_code, month, sign, bucket, count)
+        SELECT test_code, date_trunc('month', test_date)::date, sign(value)::smallint,
+               lab_sketch_bucket(value::float8), SUM(c)
+        FROM (
+            SELECT n.test_code, n.test_date, n.value, 1 AS c
+            FROM old_rows o JOIN new_rows n USING (id)
+            WHERE (o.test_code, o.test_date, o.value) IS DISTINCT FROM (n.test_code, n.test_date, n.value)
+            UNION ALL
+            SELECT o.test_code, o.test_date, o.value, -1
+            FROM old_rows o JOIN new_rows n USING (id)
+            WHERE (o.test_code, o.test_date, o.value) IS DISTINCT FROM (n.test_code, n.test_date, n.value)
+        ) d
+        WHERE test_code IS NOT NULL AND value IS NOT NULL AND test_date IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+        HAVING SUM(c) <> 0
+        ORDER BY 1, 2, 3, 4
+        ON CONFLICT (test_code, month, sign, bucket) DO UPDATE
+        SET count = lab_value_sketches.count + EXCLUDED.count;
+        DELETE FROM lab_value_sketches
+        WHERE count <= 0 AND (test_code, month) IN (
+            SELECT DISTINCT o.test_code, date_trunc('month', o.test_date)::date
+            FROM old_rows o JOIN new_rows n USING (id)
+            WHERE (o.test_code, o.test_date, o.value) IS DISTINCT FROM (n.test_code, n.test_date, n.value)
+        );
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO lab_value_sketches (test_code, month, sign, bucket, count)
+        SELECT test_code, date_trunc('month', test_date)::date, sign(value)::smallint,
+               lab_sketch_bucket(value::float8), COUNT(*)
+        FROM new_rows
+        WHERE test_code IS NOT NULL AND value IS NOT NULL AND test_date IS NOT NULL
+        GROUP BY 1, 2, 3, 4
+        ORDER BY 1, 2, 3, 4
+        ON CONFLICT (test_code, month, sign, bucket) DO UPDATE
+        SET count = lab_value_sketches.count + EXCLUDED.count;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        UPDATE lab_value_sketches s SET count = s.count - o.c
+        FROM (
+            SELECT test_code, date_trunc('month', test_date)::date AS month, sign(value)::smallint AS sign,
+                   lab_sketch_bucket(value::float8) AS bucket, COUNT(*) AS c
+            FROM old_rows
+            WHERE test_code IS NOT NULL AND value IS NOT NULL AND test_date IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+        ) o
+        WHERE s.test_code = o.test_code AND s.month = o.month AND s.sign = o.sign AND s.bucket = o.bucket;
+        DELETE FROM lab_value_sketches
+        WHERE count <= 0 AND (test_code, month) IN (
+            SELECT DISTINCT test_code, date_trunc('month', test_date)::date FROM old_rows
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER lab_results_sketch_ins AFTER INSERT ON lab_results
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION update_lab_value_sketches();
+CREATE OR REPLACE TRIGGER lab_results_sketch_del AFTER DELETE ON lab_results
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION update_lab_value_sketches();
+CREATE OR REPLACE TRIGGER lab_results_sketch_upd AFTER UPDATE ON lab_results
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION update_lab_value_sketches();
+""".replace("__GAMMA__", repr(GAMMA))
+
+
+def ensure_sketches(cursor):
+    """Crea la tabla de sketches + triggers. El backfill (un GROUP BY sobre todo el historial) solo corre la primera vez."""
+    cursor.execute("SELECT to_regclass('lab_value_sketches') IS NULL")
+    first_time = cursor.fetchone()[0]
+    cursor.execute(SKETCH_DDL)
+    if first_time:
+        cursor.execute("""
+            INSERT INTO lab_value_sketches (test_code, month, sign, bucket, count)
+            SELECT test_code, date_trunc('month', test_date)::date, sign(value)::smallint,
+                   lab_sketch_bucket(value::float8), COUNT(*)
+            FROM lab_results
+            WHERE test_code IS NOT NULL AND value IS NOT NULL AND test_date IS NOT NULL
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT DO NOTHING
+        """)
+
+
+def _key(sign, bucket):
+    """Orden de los buckets por valor: negativos (de mayor a menor magnitud), cero, positivos."""
+    return (sign, sign * bucket)
+
+
+def _bucket_of(value):
+    if value == 0:
+        return 0, 0
+    return (1 if value > 0 else -1), math.ceil(math.log(abs(value)) / math.log(GAMMA))
+
+
+def _representative(sign, bucket):
+    """Valor que representa al bucket (error relativo <= alpha para todo lo que cae en él)."""
+    return sign * 2 * GAMMA ** bucket / (GAMMA + 1)
+
+
+def _fraction_below(value, sign, bucket):
+    """Qué parte del bucket (|v| en (gamma^(i-1), gamma^i]) queda por debajo de `value`."""
+    if sign == 0:
+        return 0.5
+    low, high = GAMMA ** (bucket - 1), GAMMA ** bucket
+    fraction = (abs(value) - low) / (high - low)
+    return fraction if sign > 0 else 1 - fraction
+
+
+class Sketch:
+    """Sketch ya fusionado (conteos por bucket sumados sobre varios meses)."""
+
+    def __init__(self, rows):
+        # rows: [(sign, bucket, count)]
+        self.buckets = sorted(((s, b, int(c)) for s, b, c in rows), key=lambda r: _key(r[0], r[1]))
+        self.count = sum(c for _, _, c in self.buckets)
+
+    @classmethod
+    def merged(cls, parts):
+        """Fusiona los sketches de varios shards: los (sign, bucket) repetidos se suman."""
+        totals = {}
+        for rows in parts:
+            for sign, bucket, count in rows:
+                totals[(sign, bucket)] = totals.get((sign, bucket), 0) + int(count)
+        return cls((sign, bucket, count) for (sign, bucket), count in totals.items())
+
+    def quantile(self, q: float):
+        """q en [0, 1]."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for sign, bucket, c in self.buckets:
+            seen += c
+            if seen > rank:
+                return _representative(sign, bucket)
+        sign, bucket, _ = self.buckets[-1]
+        return _representative(sign, bucket)
+
+    def percentile_rank(self, value: float):
+        """Porcentaje de la población por debajo de `value` (interpolando dentro de su bucket)."""
+        if not self.count:
+            return None
+        sign, bucket = _bucket_of(value)
+        target = _key(sign, bucket)
+        below = same = 0
+        for s, b, c in self.buckets:
+            key = _key(s, b)
+            if key < target:
+                below += c
+            elif key == target:
+                same = c
+            else:
+                break
+        return 100.0 * (below + same * _fraction_below(value, sign, bucket)) / self.count
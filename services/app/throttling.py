@@ -0,0 +1,214 @@
+import collections
+import math
+import threading
+import time
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse
+from .config import (
+    RATE_LIMIT_ENABLED, RATE_LIMIT_READ, RATE_LIMIT_WRITE, RATE_LIMIT_ADMIN,
+    RATE_LIMIT_USER_BUDGETS, RATE_LIMIT_GROUP_BUDGETS, RATE_LIMIT_MAX_KEYS,
+    DB_MAX_CONCURRENCY, DB_SLOT_TIMEOUT_SECONDS, DB_WAIT_SHED_SECONDS, DB_WAIT_WINDOW_SECONDS,
+)
+from .metrics import RATE_LIMITED, LOAD_SHED, DB_SLOT_WAIT_SECONDS, DB_SLOT_WAIT_RECENT, DB_SLOT_WAITING
+
+# --- Protección de la BD: límite por usuario y descarte de carga ---
+# 1) Token bucket por (usuario, tipo de ruta) y, si está configurado, otro compartido
+#    por (grupo, tipo de ruta): un script de laboratorio no se come el cupo de todos.
+#    Se aplica al validar el JWT (get_current_user) y responde 429 + Retry-After.
+# 2) Cupos de conexión a la BD por proceso (DB_MAX_CONCURRENCY). Si la espera media
+#    por un cupo supera DB_WAIT_SHED_SECONDS, las peticiones nuevas reciben 503 +
+#    Retry-After antes de hacer nada; al vaciarse la ventana se vuelve a dejar pasar.
+# El estado es por proceso (igual que replicas.py): con N tareas el tope real es N veces.
+
+ROLE_PRIORITY = ["Admins", "Labs", "Doctors", "Patients"]  # El grupo "efectivo" es el de más rango
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+SHED_EXEMPT_PATHS = {"/", "/health/live", "/health/ready"}
+SHED_EXEMPT_PREFIXES = ("/events/",)  # Los streams SSE no usan conexiones de la BD
+
+
+def parse_budget(spec: str):
+    """ "rate/ráfaga" -> (rate, burst). Sin ráfaga, la ráfaga es el propio rate."""
+    rate, _, burst = spec.partition("/")
+    rate = float(rate)
+    return rate, float(burst) if burst else max(rate, 1.0)
+
+
+def parse_group_budgets(spec: str) -> dict:
+    """ "Labs.write=20/100,Admins.admin=5/10" -> {("Labs", "write"): (20.0, 100.0), ...}"""
+    budgets = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        key, _, budget = item.partition("=")
+        group, _, route_class = key.strip().partition(".")
+        budgets[(group, route_class)] = parse_budget(budget.strip())
+    return budgets
+
+
+DEFAULT_BUDGETS = {
+    "read": parse_budget(RATE_LIMIT_READ),
+    "write": parse_budget(RATE_LIMIT_WRITE),
+    "admin": parse_budget(RATE_LIMIT_ADMIN),
+}
+USER_BUDGETS = parse_group_budgets(RATE_LIMIT_USER_BUDGETS)
+GROUP_BUDGETS = parse_group_budgets(RATE_LIMIT_GROUP_BUDGETS)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self) -> float:
+        """Segundos hasta que haya una ficha entera."""
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+
+class RateLimiter:
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, budget, now):
+        bucket = self._buckets.get(key)
+        if bucket is None or (bucket.rate, bucket.burst) != budget:
+            if len(self._buckets) >= self.max_keys:
+                self._prune(now)
+            bucket = self._buckets[key] = TokenBucket(budget[0], budget[1], now)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def _prune(self, now):
+        # Un bucket que ya se habría rellenado entero equivale a uno nuevo: se puede tirar
+        for key in [k for k, b in self._buckets.items() if b.tokens + (now - b.updated) * b.rate >= b.burst]:
+            del self._buckets[key]
+
+    def take(self, buckets):
+        """
+        buckets: [(scope, key, (rate, burst))]. Saca una ficha de TODOS o de ninguno.
+        Devuelve None si pasa, o (scope, segundos de espera) del que la rechazó.
+        """
+        now = time.monotonic()
+        with self._lock:
+            resolved = [(scope, self._bucket(key, budget, now)) for scope, key, budget in buckets]
+            for scope, bucket in resolved:
+                if bucket.tokens < 1:
+                    return scope, bucket.retry_after()
+            for _, bucket in resolved:
+                bucket.tokens -= 1
+        return None
+
+
+limiter = RateLimiter()
+
+
+def route_class(request: Request) -> str:
+    if request.url.path.startswith("/admin"):
+        return "admin"
+    return "read" if request.method in READ_METHODS else "write"
+
+
+def effective_group(user: dict):
+    groups = user.get("cognito:groups", [])
+    return next((g for g in ROLE_PRIORITY if g in groups), None)
+
+
+def enforce_rate_limit(request: Request, user: dict):
+    """Lanza 429 con Retry-After si el usuario (o su grupo) agotó el presupuesto de esta ruta."""
+    if not RATE_LIMIT_ENABLED:
+        return
+    kind = route_class(request)
+    group = effective_group(user)
+    username = user.get("username") or user.get("sub")
+    buckets = [("user", ("user", username, kind), USER_BUDGETS.get((group, kind), DEFAULT_BUDGETS[kind]))]
+    if (group, kind) in GROUP_BUDGETS:
+        buckets.append(("group", ("group", group, kind), GROUP_BUDGETS[(group, kind)]))
+    rejected = limiter.take(buckets)
+    if rejected is None:
+        return
+    scope, wait = rejected
+    RATE_LIMITED.labels(kind, scope).inc()
+    detail = "Demasiadas peticiones" if scope == "user" else f"Demasiadas peticiones del grupo {group}"
+    raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(wait)))})
+
+
+class DbSlots:
+    """
+    Semáforo de conexiones a la BD con registro de la espera. La espera media en la
+    ventana es la señal de saturación: sube antes de que la BD empiece a fallar.
+    """
+
+    def __init__(self, size: int, timeout: float, window: float):
+        self.timeout = timeout
+        self.window = window
+        self._sem = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._waits = collections.deque()  # (monotonic, segundos esperados)
+        self._wait_sum = 0.0
+
+    def acquire(self):
+        """Toma un cupo o lanza 503 si no aparece en `timeout` segundos."""
+        start = time.monotonic()
+        DB_SLOT_WAITING.inc()
+        try:
+            acquired = self._sem.acquire(timeout=self.timeout)
+        finally:
+            DB_SLOT_WAITING.dec()
+        waited = time.monotonic() - start
+        DB_SLOT_WAIT_SECONDS.observe(waited)
+        self._record(waited)
+        if not acquired:
+            LOAD_SHED.labels("db_timeout").inc()
+            raise HTTPException(status_code=503, detail="Base de datos saturada, reintenta en unos segundos",
+                                headers={"Retry-After": str(self.retry_after())})
+
+    def release(self):
+        self._sem.release()
+
+    def _record(self, waited):
+        now = time.monotonic()
+        with self._lock:
+            self._waits.append((now, waited))
+            self._wait_sum += waited
+            self._trim(now)
+
+    def _trim(self, now):
+        while self._waits and self._waits[0][0] < now - self.window:
+            self._wait_sum -= self._waits.popleft()[1]
+
+    def recent_wait(self) -> float:
+        with self._lock:
+            self._trim(time.monotonic())
+            recent = self._wait_sum / len(self._waits) if self._waits else 0.0
+        DB_SLOT_WAIT_RECENT.set(recent)
+        return recent
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.window))
+
+
+db_slots = DbSlots(DB_MAX_CONCURRENCY, DB_SLOT_TIMEOUT_SECONDS, DB_WAIT_WINDOW_SECONDS)
+
+
+async def load_shedding_middleware(request: Request, call_next):
+    path = request.url.path
+    if (
+        request.method != "OPTIONS" and path not in SHED_EXEMPT_PATHS and not path.startswith(SHED_EXEMPT_PREFIXES)
+        and db_slots.recent_wait() > DB_WAIT_SHED_SECONDS
+    ):
+        LOAD_SHED.labels("db_wait").inc()
+        return JSONResponse(
+            status_code=503, content={"detail": "Servicio saturado, reintenta en unos segundos"},
+            headers={"Retry-After": str(db_slots.retry_after())},
+        )
+    return await call_next(request)
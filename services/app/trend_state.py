@@ -0,0 +1,190 @@
+import math
+from .config import TREND_EWMA_ALPHA
+
+# --- Estado incremental de tendencia por (paciente, examen) ---
+# Una fila de tamaño fijo por serie con EWMA, media/varianza de Welford y la
+# pendiente por mínimos cuadrados (co-momento online, x = días desde el primer
+# resultado). Un trigger por SENTENCIA sobre lab_results la mantiene al día:
+#   * INSERT en orden cronológico -> O(1) por fila, sin releer el historial.
+#   * INSERT con fecha anterior al último punto, UPDATE o DELETE -> se
+#     reconstruye solo esa serie (el EWMA depende del orden y no se puede "restar").
+# Como en versioning.py, cubre cualquier camino de escritura (worker, upload, borrados).
+
+TREND_STATE_DDL = """
+CREATE TABLE IF NOT EXISTS lab_trend_state (
+    patient_id VARCHAR(100) NOT NULL, test_code VARCHAR(50) NOT NULL,
+    n BIGINT NOT NULL,
+    mean DOUBLE PRECISION NOT NULL, m2 DOUBLE PRECISION NOT NULL,       -- Welford sobre el valor
+    ewma DOUBLE PRECISION NOT NULL,
+    origin TIMESTAMP NOT NULL,                                          -- x = dias desde origin
+    mean_x DOUBLE PRECISION NOT NULL, m2_x DOUBLE PRECISION NOT NULL,
+    c_xy DOUBLE PRECISION NOT NULL,                                     -- pendiente = c_xy / m2_x
+    last_date TIMESTAMP NOT NULL, last_value DOUBLE PRECISION NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (patient_id, test_code)
+);
+
+-- La reconstruccion lee una serie completa: sin este indice seria un scan de toda la tabla
+CREATE INDEX IF NOT EXISTS idx_lab_results_patient_test_date ON lab_results (patient_id, test_code, test_date);
+
+-- Agrega a UNA serie sus puntos nuevos (ya ordenados) con una sola escritura del estado:
+-- actualizar la misma fila por cada punto deja una cadena de versiones muertas que cada
+-- UPDATE siguiente recorre (cuadratico con miles de puntos en una sentencia).
+-- FALSE si el primero llega antes que el ultimo punto guardado (hay que reconstruir).
+CREATE OR REPLACE FUNCTION lab_trend_state_push(p VARCHAR, t VARCHAR, ds TIMESTAMP[], ys DOUBLE PRECISION[])
+RETURNS boolean AS $$
+DECLARE
+    s lab_trend_state%ROWTYPE;
+    inserted INTEGER;
+    first_new INTEGER := 1;
+    x DOUBLE PRECISION; dx DOUBLE PRECISION; dy DOUBLE PRECISION;
+BEGIN
+    INSERT INTO lab_trend_state (patient_id, test_code, n, mean, m2, ewma, origin, mean_x, m2_x, c_xy, last_date, last_value)
+    VALUES (p, t, 1, ys[1], 0, ys[1], ds[1], 0, 0, 0, ds[1], ys[1])
+    ON CONFLICT (patient_id, test_code) DO NOTHING;
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    IF inserted > 0 THEN
+        IF cardinality(ys) = 1 THEN
+            RETURN TRUE;
+        END IF;
+        first_new := 2;  -- El primer punto ya es el estado inicial
+    END IF;
+
+    SELECT * INTO s FROM lab_trend_state WHERE patient_id = p AND test_code = t FOR UPDATE;
+    IF ds[1] < s.last_date THEN
+        RETURN FALSE;
+    END IF;
+
+    FOR i IN first_new..cardinality(ys) LOOP
+        x := EXTRACT(EPOCH FROM ds[i] - s.origin) / 86400.0;
+        dx := x - s.mean_x;
+        dy := ys[i] - s.mean;
+        s.n := s.n + 1;
+        s.mean := s.mean + dy / s.n;
+        s.mean_x := s.mean_x + dx / s.n;
+        s.m2 := s.m2 + dy * (ys[i] - s.mean);
+        s.m2_x := s.m2_x + dx * (x - s.mean_x);
+        s.c_xy := s.c_xy + dx * (ys[i] - s.mean);
+        s.ewma := __ALPHA__ * ys[i] + (1 - __ALPHA__) * s.ewma;
+    END LOOP;
+
+    UPDATE lab_trend_state
+    SET n = s.n, mean = s.mean, m2 = s.m2, ewma = s.ewma, mean_x = s.mean_x, m2_x = s.m2_x, c_xy = s.c_xy,
+        last_date = ds[cardinality(ds)], last_value = ys[cardinality(ys)], updated_at = CURRENT_TIMESTAMP
+    WHERE patient_id = p AND test_code = t;
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Recalcula desde el historial (en un solo pase por conjuntos) las series indicadas.
+-- El EWMA se obtiene con su forma cerrada: y_1 pesa (1-a)^(n-1) y y_i pesa a(1-a)^(n-i).
+CREATE OR REPLACE FUNCTION rebuild_lab_trend_state(ps VARCHAR[], ts VARCHAR[]) RETURNS void AS $$
+BEGIN
+    DELETE FROM lab_trend_state s USING unnest(ps, ts) AS k(p, t)
+    WHERE s.patient_id = k.p AND s.test_code = k.t;
+
+    INSERT INTO lab_trend_state (patient_id, test_code, n, mean, m2, ewma, origin, mean_x, m2_x, c_xy, last_date, last_value)
+    SELECT k.p, k.t, COUNT(*), AVG(y), COALESCE(regr_syy(y, x), 0),
+           SUM(y * CASE
+               WHEN (n - rn) * ln(1 - __ALPHA__) < -700 THEN 0    -- Peso despreciable (evita underflow)
+               WHEN rn = 1 THEN power(1 - __ALPHA__, n - 1)
+               ELSE __ALPHA__ * power(1 - __ALPHA__, n - rn)
+           END),
+           origin, AVG(x), COALESCE(regr_sxx(y, x), 0), COALESCE(regr_sxy(y, x), 0),
+           MAX(test_date), (array_agg(y ORDER BY rn DESC))[1]
+    -- LATERAL: un index scan por serie (un hash join contra toda la tabla seria mucho peor)
+    FROM (SELECT DISTINCT p, t FROM unnest(ps, ts) AS k(p, t)) k
+    CROSS JOIN LATERAL (
+        SELECT r.test_date, r.value::float8 AS y,
+               MIN(r.test_date) OVER () AS origin,
+               EXTRACT(EPOCH FROM r.test_date - MIN(r.test_date) OVER ()) / 86400.0 AS x,
+               ROW_NUMBER() OVER (ORDER BY r.test_date, r.id) AS rn,
+               COUNT(*) OVER () AS n
+        FROM lab_results r
+        WHERE r.patient_id = k.p AND r.test_code = k.t AND r.value IS NOT NULL AND r.test_date IS NOT NULL
+    ) pts
+    GROUP BY k.p, k.t, pts.origin;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_lab_trend_state() RETURNS trigger AS $$
+DECLARE
+    r RECORD;
+    stale_p VARCHAR[] := '{}';
+    stale_t VARCHAR[] := '{}';
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        -- Mismo orden de bloqueo que versioning.py; cada serie con sus puntos en orden cronologico
+        FOR r IN
+            SELECT patient_id, test_code,
+                   array_agg(test_date ORDER BY test_date, id) AS ds, array_agg(value::float8 ORDER BY test_date, id) AS ys
+            FROM new_rows
+            WHERE patient_id IS NOT NULL AND test_code IS NOT NULL AND value IS NOT NULL AND test_date IS NOT NULL
+            GROUP BY patient_id, test_code
+            ORDER BY patient_id, test_code
+        LOOP
+            IF NOT lab_trend_state_push(r.patient_id, r.test_code, r.ds, r.ys) THEN
+                stale_p := stale_p || r.patient_id;
+                stale_t := stale_t || r.test_code;
+            END IF;
+        END LOOP;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(patient_id), array_agg(test_code) INTO stale_p, stale_t
+        FROM (SELECT DISTINCT patient_id, test_code FROM old_rows ORDER BY 1, 2) k;
+    ELSE
+        -- Solo las series de filas cuyo dato cambio: re-banderear (solo abnormal_flag) no las reconstruye
+        SELECT array_agg(p), array_agg(t) INTO stale_p, stale_t FROM (
+            SELECT DISTINCT k.p, k.t
+            FROM old_rows o JOIN new_rows n USING (id)
+            CROSS JOIN LATERAL (VALUES (o.patient_id, o.test_code), (n.patient_id, n.test_code)) AS k(p, t)
+            WHERE (o.patient_id, o.test_code, o.test_date, o.value) IS DISTINCT FROM (n.patient_id, n.test_code, n.test_date, n.value)
+            ORDER BY 1, 2
+        ) k;
+    END IF;
+
+    IF cardinality(stale_p) > 0 THEN
+        PERFORM rebuild_lab_trend_state(stale_p, stale_t);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER lab_results_trend_ins AFTER INSERT ON lab_results
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION update_lab_trend_state();
+CREATE OR REPLACE TRIGGER lab_results_trend_del AFTER DELETE ON lab_results
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION update_lab_trend_state();
+CREATE OR REPLACE TRIGGER lab_results_trend_upd AFTER UPDATE ON lab_results
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION update_lab_trend_state();
+""".replace("__ALPHA__", repr(float(TREND_EWMA_ALPHA)))
+
+
+def ensure_trend_state(cursor):
+    """Crea la tabla de estado + triggers. El backfill (un pase por todo el historial) solo corre la primera vez."""
+    cursor.execute("SELECT to_regclass('lab_trend_state') IS NULL")
+    first_time = cursor.fetchone()[0]
+    cursor.execute(TREND_STATE_DDL)
+    if first_time:
+        cursor.execute("""
+            SELECT rebuild_lab_trend_state(array_agg(patient_id), array_agg(test_code))
+            FROM (SELECT DISTINCT patient_id, test_code FROM lab_results) k
+        """)
+
+
+def trend_statistics(row) -> dict:
+    """Fila de lab_trend_state -> estadísticos listos para la respuesta."""
+    n = row["n"]
+    variance = row["m2"] / (n - 1) if n > 1 else None
+    slope = row["c_xy"] / row["m2_x"] if row["m2_x"] > 0 else None
+    return {
+        "count": n,
+        "mean": round(row["mean"], 4),
+        "variance": round(variance, 4) if variance is not None else None,
+        "stddev": round(math.sqrt(max(variance, 0.0)), 4) if variance is not None else None,
+        "ewma": round(row["ewma"], 4),
+        "ewma_alpha": TREND_EWMA_ALPHA,
+        "slope_per_day": round(slope, 6) if slope is not None else None,
+        "slope_per_year": round(slope * 365.25, 4) if slope is not None else None,
+        "first_date": row["origin"],
+        "last_date": row["last_date"],
+        "last_value": row["last_value"],
+    }
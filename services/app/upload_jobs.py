@@ -0,0 +1,404 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+from .config import UPLOAD_JOB_WORKERS, UPLOAD_JOB_TXN_ROWS, UPLOAD_JOB_STALE_SECONDS, UPLOAD_JOB_TTL_HOURS
+from .metrics import UPLOAD_JOB_ROWS
+from .models import LabResultItem
+from .sharding import group_by_shard, home_shard, scatter
+from . import database, notifications  # database importa este módulo (migración): usar database.x
+
+logger = logging.getLogger(__name__)
+
+# --- Cargas masivas por trabajos (subida por partes reanudable) ---
+# El navegador crea un trabajo y le manda el archivo en partes numeradas (0, 1, 2...):
+# cada parte llega con su SHA-256, se verifica y se guarda en upload_job_chunks antes
+# de confirmarla. Si la pestaña se cierra o la red se corta, GET del trabajo dice cuál
+# es la próxima parte (next_chunk) y se sigue desde ahí. Reenviar una parte ya
+# confirmada con el mismo checksum es un no-op.
+# Al completarlo, un hilo en segundo plano lo procesa en transacciones grandes
+# (~UPLOAD_JOB_TXN_ROWS filas) y guarda el avance (chunks_processed) después de cada
+# COMMIT: si la tarea muere, otra lo retoma desde ahí (heartbeat vencido). Las filas
+# de una transacción que se repitan al retomar las descarta el índice de dedup_key.
+# Los trabajos viven en el primer shard; cada fila va al shard de su paciente.
+
+UPLOAD_JOBS_DDL = """
+CREATE TABLE IF NOT EXISTS upload_jobs (
+    id UUID PRIMARY KEY,
+    created_by VARCHAR(255) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'receiving',  -- receiving | queued | processing | done | failed
+    chunks_received INTEGER NOT NULL DEFAULT 0,
+    chunks_processed INTEGER NOT NULL DEFAULT 0,
+    rows_received BIGINT NOT NULL DEFAULT 0,
+    rows_inserted BIGINT NOT NULL DEFAULT 0,
+    rows_duplicate BIGINT NOT NULL DEFAULT 0,
+    rows_rejected BIGINT NOT NULL DEFAULT 0,
+    errors JSONB NOT NULL DEFAULT '[]',
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    heartbeat_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_upload_jobs_pending ON upload_jobs (status) WHERE status IN ('queued', 'processing');
+
+CREATE TABLE IF NOT EXISTS upload_job_chunks (
+    job_id UUID NOT NULL REFERENCES upload_jobs (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    sha256 CHAR(64) NOT NULL,
+    row_count INTEGER NOT NULL,
+    payload BYTEA NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+"""
+
+MAX_REPORTED_ERRORS = 50  # Filas rechazadas que se guardan con su motivo (el resto solo se cuenta)
+MAX_LENGTHS = {"patient_id": 100, "test_code": 50, "test_name": 150, "unit": 30}  # Columnas de lab_results
+MAX_ABS_VALUE = 1e8  # NUMERIC(10, 2)
+INSERT_PAGE_ROWS = 5000  # Filas por INSERT: los triggers por sentencia corren una vez por página
+
+INSERT_SQL = """
+INSERT INTO lab_results (patient_id, test_code, test_name, value, unit, test_date, abnormal_flag)
+SELECT v.*, lab_abnormal_flag(v.patient_id, v.test_code, v.value, v.test_date)
+FROM (VALUES %s) AS v (patient_id, test_code, test_name, value, unit, test_date)
+ON CONFLICT DO NOTHING
+RETURNING 1
+"""
+VALUES_TEMPLATE = "(%s, %s, %s, %s::numeric, %s, %s::timestamp)"
+
+JOB_FIELDS = """
+    id::text AS job_id, created_by, status, chunks_received, chunks_processed, rows_received,
+    rows_inserted, rows_duplicate, rows_rejected, errors, error, created_at, updated_at, finished_at
+"""
+
+
+def ensure_upload_jobs(cursor):
+    cursor.execute(UPLOAD_JOBS_DDL)
+
+
+def checksum(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _job_status(job: dict) -> dict:
+    job = dict(job)
+    job["next_chunk"] = job["chunks_received"]
+    for field in ("created_at", "updated_at", "finished_at"):
+        job[field] = job[field].isoformat() if job[field] else None
+    return job
+
+
+def create_job(owner: str) -> dict:
+    conn = database.get_db_connection(shard=home_shard())
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                f"INSERT INTO upload_jobs (id, created_by) VALUES (%s, %s) RETURNING {JOB_FIELDS}",
+                (str(uuid.uuid4()), owner),
+            )
+            job = cursor.fetchone()
+        conn.commit()
+        return _job_status(job)
+    finally:
+        conn.close()
+
+
+def get_job(job_id: str):
+    """Estado del trabajo o None. Si quedó huérfano (tarea muerta) se vuelve a encolar aquí."""
+    conn = database.get_db_connection(shard=home_shard())
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(f"""
+                SELECT {JOB_FIELDS}, status IN ('queued', 'processing')
+                    AND COALESCE(heartbeat_at, updated_at) < CURRENT_TIMESTAMP - make_interval(secs => %s) AS stale
+                FROM upload_jobs WHERE id = %s
+            """, (UPLOAD_JOB_STALE_SECONDS, job_id))
+            job = cursor.fetchone()
+    finally:
+        conn.close()
+    if job is None:
+        return None
+    if job.pop("stale"):
+        submit(job["job_id"])
+    return _job_status(job)
+
+
+def put_chunk(job_id: str, seq: int, payload: bytes, sha256: str, row_count: int) -> dict:
+    """
+    Guarda la parte `seq` -> {"acknowledged": True, ...}. Las partes van en orden: solo se
+    acepta la siguiente (next_chunk) o el reenvío idéntico de una ya confirmada.
+    ValueError / LookupError si no corresponde (el router lo traduce a 409 / 404).
+    """
+    conn = database.get_db_connection(shard=home_shard())
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT status, chunks_received FROM upload_jobs WHERE id = %s FOR UPDATE", (job_id,))
+            row = cursor.fetchone()
+            if row is None:
+                raise LookupError("Trabajo no encontrado")
+            status, received = row
+            if seq < received:
+                cursor.execute("SELECT sha256 FROM upload_job_chunks WHERE job_id = %s AND seq = %s", (job_id, seq))
+                stored = cursor.fetchone()
+                if stored is None or stored[0] != sha256:
+                    raise ValueError(f"La parte {seq} ya se recibió con otro contenido")
+                return {"acknowledged": True, "seq": seq, "sha256": sha256, "next_chunk": received}
+            if status != "receiving":
+                raise ValueError(f"El trabajo ya no recibe partes (estado: {status})")
+            if seq > received:
+                raise ValueError(f"Se esperaba la parte {received}, llegó la {seq}")
+            cursor.execute(
+                "INSERT INTO upload_job_chunks (job_id, seq, sha256, row_count, payload) VALUES (%s, %s, %s, %s, %s)",
+                (job_id, seq, sha256, row_count, psycopg2.Binary(payload)),
+            )
+            cursor.execute("""
+                UPDATE upload_jobs SET chunks_received = %s, rows_received = rows_received + %s,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (seq + 1, row_count, job_id))
+        conn.commit()
+        return {"acknowledged": True, "seq": seq, "sha256": sha256, "next_chunk": seq + 1}
+    finally:
+        conn.close()
+
+
+def complete_job(job_id: str, total_chunks: int = None) -> dict:
+    """Cierra la recepción y encola el procesamiento (también reintenta uno fallido)."""
+    conn = database.get_db_connection(shard=home_shard())
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT status, chunks_received FROM upload_jobs WHERE id = %s FOR UPDATE", (job_id,))
+            row = cursor.fetchone()
+            if row is None:
+                raise LookupError("Trabajo no encontrado")
+            status, received = row
+            if status not in ("receiving", "failed"):
+                raise ValueError(f"El trabajo ya está {status}")
+            if total_chunks is not None and total_chunks != received:
+                raise ValueError(f"Faltan partes: se recibieron {received} de {total_chunks}")
+            cursor.execute("""
+                UPDATE upload_jobs SET status = 'queued', error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            """, (job_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    submit(job_id)
+    return get_job(job_id)
+
+
+# --- Procesamiento en segundo plano ---
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def submit(job_id: str):
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=UPLOAD_JOB_WORKERS, thread_name_prefix="upload-job")
+    _executor.submit(process_job, job_id)
+
+
+def resume_pending():
+    """
+    Al arrancar: retoma los trabajos encolados o cuyo heartbeat venció (la tarea que los
+    procesaba murió) y borra los que llevan UPLOAD_JOB_TTL_HOURS sin moverse.
+    """
+    conn = database.get_db_connection(gated=False, shard=home_shard())
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                DELETE FROM upload_jobs WHERE status NOT IN ('queued', 'processing')
+                AND updated_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+            """, (UPLOAD_JOB_TTL_HOURS,))
+            expired = cursor.rowcount
+            cursor.execute("""
+                SELECT id::text FROM upload_jobs WHERE status = 'queued'
+                OR (status = 'processing' AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+            """, (UPLOAD_JOB_STALE_SECONDS,))
+            pending = [job_id for (job_id,) in cursor.fetchall()]
+        conn.commit()
+    finally:
+        conn.close()
+    for job_id in pending:
+        submit(job_id)
+    if pending or expired:
+        logger.info("Trabajos de carga: %d retomados, %d vencidos borrados", len(pending), expired)
+
+
+def clean_result(record) -> tuple:
+    """Valida una fila igual que /lab/upload-results -> tupla del INSERT. ValueError con el motivo."""
+    if not isinstance(record, dict):
+        raise ValueError("La fila no es un objeto JSON")
+    try:
+        item = LabResultItem(**record)
+    except ValueError as e:
+        errors = getattr(e, "errors", lambda: [])()
+        raise ValueError("; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in errors) or str(e))
+    for field, limit in MAX_LENGTHS.items():
+        if len(getattr(item, field)) > limit:
+            raise ValueError(f"{field} supera {limit} caracteres")
+    if not abs(item.value) < MAX_ABS_VALUE:
+        raise ValueError(f"value fuera de rango: {item.value}")
+    return (item.patient_id, item.test_code, item.test_name, item.value, item.unit, item.test_date)
+
+
+class _Batch:
+    """Filas de una transacción: válidas por shard + rechazadas con su ubicación."""
+
+    def __init__(self):
+        self.rows = []
+        self.rejected = []
+        self.last_seq = None
+
+    def add_chunk(self, seq: int, payload: bytes):
+        self.last_seq = seq
+        try:
+            records = json.loads(bytes(payload))
+        except ValueError:
+            records = None
+        if not isinstance(records, list):  # El router ya lo validó; por si acaso
+            self.rejected.append({"chunk": seq, "row": None, "error": "La parte no es una lista JSON"})
+            return
+        for index, record in enumerate(records):
+            try:
+                self.rows.append(((seq, index), clean_result(record)))
+            except ValueError as e:
+                self.rejected.append({"chunk": seq, "row": index, "error": str(e)})
+
+
+def _insert_shard(conn, rows):
+    """INSERT por páginas -> (insertadas, [(ubicación, motivo)] rechazadas por la BD)."""
+    inserted, rejected = 0, []
+    with conn.cursor() as cursor:
+        for start in range(0, len(rows), INSERT_PAGE_ROWS):
+            page = rows[start:start + INSERT_PAGE_ROWS]
+            cursor.execute("SAVEPOINT page")
+            try:
+                inserted += len(execute_values(
+                    cursor, INSERT_SQL, [row for _, row in page], template=VALUES_TEMPLATE,
+                    page_size=INSERT_PAGE_ROWS, fetch=True,
+                ))
+                cursor.execute("RELEASE SAVEPOINT page")
+                continue
+            except (psycopg2.DataError, psycopg2.IntegrityError):
+                cursor.execute("ROLLBACK TO SAVEPOINT page")
+            # La BD rechazó alguna fila que pasó la validación: esa página fila por fila
+            for where, row in page:
+                cursor.execute("SAVEPOINT row")
+                try:
+                    inserted += len(execute_values(cursor, INSERT_SQL, [row], template=VALUES_TEMPLATE, fetch=True))
+                    cursor.execute("RELEASE SAVEPOINT row")
+                except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT row")
+                    rejected.append((where, str(e).strip().splitlines()[0]))
+    return inserted, rejected
+
+
+def _claim(cursor, job_id: str):
+    """Toma el trabajo si está encolado o abandonado -> (procesadas, recibidas) o None."""
+    cursor.execute("""
+        UPDATE upload_jobs SET status = 'processing', heartbeat_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s AND (status = 'queued' OR (
+            status = 'processing' AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)))
+        RETURNING chunks_processed, chunks_received, jsonb_array_length(errors)
+    """, (job_id, UPLOAD_JOB_STALE_SECONDS))
+    return cursor.fetchone()
+
+
+def _flush(job_conn, job_id: str, batch: _Batch, reported: int) -> int:
+    """Una transacción por shard con las filas del lote; después se guarda el avance."""
+    by_shard = group_by_shard(batch.rows, key=lambda item: item[1][0])
+    conns = database.ShardConnections(gated=False)
+    try:
+        results = scatter(lambda shard: _insert_shard(conns.get(shard), by_shard[shard]), by_shard, operation="upload_job")
+        conns.commit()
+    except Exception:
+        conns.rollback()
+        raise
+    finally:
+        conns.close()
+
+    inserted = sum(count for count, _ in results)
+    rejected = batch.rejected + [
+        {"chunk": where[0], "row": where[1], "error": error} for _, failures in results for where, error in failures
+    ]
+    duplicates = len(batch.rows) - inserted - (len(rejected) - len(batch.rejected))
+    errors = rejected[:max(0, MAX_REPORTED_ERRORS - reported)]
+    with job_conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE upload_jobs SET chunks_processed = %s, rows_inserted = rows_inserted + %s,
+                rows_duplicate = rows_duplicate + %s, rows_rejected = rows_rejected + %s,
+                errors = errors || %s::jsonb, heartbeat_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        """, (batch.last_seq + 1, inserted, duplicates, len(rejected), json.dumps(errors), job_id))
+    job_conn.commit()
+    UPLOAD_JOB_ROWS.labels("inserted").inc(inserted)
+    UPLOAD_JOB_ROWS.labels("duplicate").inc(duplicates)
+    UPLOAD_JOB_ROWS.labels("rejected").inc(len(rejected))
+    if batch.rows:
+        notifications.publish(notifications.results_event(
+            "insert", [(row[0], row[1], row[5]) for _, row in batch.rows]
+        ))
+    return reported + len(errors)
+
+
+def process_job(job_id: str):
+    """Procesa las partes pendientes en transacciones de ~UPLOAD_JOB_TXN_ROWS filas."""
+    try:
+        job_conn = database.get_db_connection(gated=False, shard=home_shard())
+    except Exception as e:
+        logger.error("Trabajo de carga %s: sin conexión (%s); se retoma más tarde", job_id, getattr(e, "detail", e))
+        return
+    start = time.perf_counter()
+    try:
+        with job_conn.cursor() as cursor:
+            claimed = _claim(cursor, job_id)
+            job_conn.commit()
+            if claimed is None:
+                return  # Ya lo procesa otra tarea (o no existe / ya terminó)
+            processed, received, reported = claimed
+            logger.info("Trabajo de carga %s: procesando partes %d..%d", job_id, processed, received - 1)
+
+            batch = _Batch()
+            for seq in range(processed, received):
+                cursor.execute("SELECT payload FROM upload_job_chunks WHERE job_id = %s AND seq = %s", (job_id, seq))
+                batch.add_chunk(seq, cursor.fetchone()[0])
+                if len(batch.rows) >= UPLOAD_JOB_TXN_ROWS or seq == received - 1:
+                    reported = _flush(job_conn, job_id, batch, reported)
+                    batch = _Batch()
+
+            # Las partes ya no hacen falta: queda el resumen
+            cursor.execute("DELETE FROM upload_job_chunks WHERE job_id = %s", (job_id,))
+            cursor.execute("""
+                UPDATE upload_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s RETURNING rows_inserted, rows_duplicate, rows_rejected
+            """, (job_id,))
+            inserted, duplicates, rejected = cursor.fetchone()
+        job_conn.commit()
+        logger.info(
+            "Trabajo de carga %s terminado en %.1f s: %d insertadas, %d duplicadas, %d rechazadas",
+            job_id, time.perf_counter() - start, inserted, duplicates, rejected,
+        )
+    except Exception as e:
+        # Lo confirmado hasta el último lote queda; complete_job() lo reintenta desde ahí
+        logger.exception("Trabajo de carga %s falló: %s", job_id, e)
+        try:
+            job_conn.rollback()
+            with job_conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE upload_jobs SET status = 'failed', error = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s
+                """, (str(getattr(e, "detail", e)), job_id))
+            job_conn.commit()
+        except Exception:
+            logger.exception("No se pudo marcar el trabajo %s como fallido", job_id)
+    finally:
+        job_conn.close()
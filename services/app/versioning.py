@@ -0,0 +1,118 @@
+import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import timezone
+from fastapi import Request, Response
+
+# --- Versión de datos por (paciente, examen) para GETs condicionales ---
+# Un trigger por SENTENCIA sobre lab_results incrementa el contador de cada
+# (patient_id, test_code) afectado en INSERT / UPDATE / DELETE. Así cualquier
+# camino de escritura (worker, /lab/upload-results, borrados de admin o catálogo)
+# invalida los ETag sin tener que acordarse de hacerlo en cada endpoint.
+
+VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS lab_data_versions (
+    patient_id VARCHAR(100) NOT NULL, test_code VARCHAR(50) NOT NULL,
+    version BIGINT NOT NULL DEFAULT 1, updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (patient_id, test_code)
+);
+
+CREATE OR REPLACE FUNCTION bump_lab_data_versions() RETURNS trigger AS $$
+BEGIN
+    -- ORDER BY: todas las transacciones bloquean las filas en el mismo orden (sin deadlocks)
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO lab_data_versions (patient_id, test_code)
+        SELECT DISTINCT patient_id, test_code FROM new_rows
+        WHERE patient_id IS NOT NULL AND test_code IS NOT NULL ORDER BY 1, 2
+        ON CONFLICT (patient_id, test_code) DO UPDATE
+        SET version = lab_data_versions.version + 1, updated_at = CURRENT_TIMESTAMP;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        INSERT INTO lab_data_versions (patient_id, test_code)
+        SELECT DISTINCT patient_id, test_code FROM old_rows
+        WHERE patient_id IS NOT NULL AND test_code IS NOT NULL ORDER BY 1, 2
+        ON CONFLICT (patient_id, test_code) DO UPDATE
+        SET version = lab_data_versions.version + 1, updated_at = CURRENT_TIMESTAMP;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER lab_results_version_ins AFTER INSERT ON lab_results
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_lab_data_versions();
+CREATE OR REPLACE TRIGGER lab_results_version_del AFTER DELETE ON lab_results
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_lab_data_versions();
+CREATE OR REPLACE TRIGGER lab_results_version_upd AFTER UPDATE ON lab_results
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION bump_lab_data_versions();
+"""
+
+
+def ensure_version_tracking(cursor):
+    """Crea la tabla de versiones + triggers. El backfill (scan completo) solo corre la primera vez."""
+    cursor.execute("SELECT to_regclass('lab_data_versions') IS NULL")
+    first_time = cursor.fetchone()[0]
+    cursor.execute(VERSION_DDL)
+    if first_time:
+        cursor.execute("""
+            INSERT INTO lab_data_versions (patient_id, test_code, version, updated_at)
+            SELECT patient_id, test_code, 1, MAX(COALESCE(ingested_at, CURRENT_TIMESTAMP))
+            FROM lab_results WHERE patient_id IS NOT NULL AND test_code IS NOT NULL
+            GROUP BY patient_id, test_code
+            ON CONFLICT DO NOTHING
+        """)
+
+
+class Validators:
+    """ETag / Last-Modified de una respuesta, calculados a partir de la versión de datos."""
+
+    def __init__(self, version, updated_at, variant=""):
+        digest = hashlib.md5(variant.encode()).hexdigest()[:8]
+        self.etag = f'W/"{version}-{digest}"'
+        self.last_modified = updated_at.replace(tzinfo=timezone.utc) if updated_at else None
+
+    def matches(self, request: Request) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            candidates = {tag.strip() for tag in if_none_match.split(",")}
+            return "*" in candidates or self.etag in candidates or self.etag[2:] in candidates
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since and self.last_modified:
+            try:
+                return self.last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def headers(self) -> dict:
+        headers = {"ETag": self.etag, "Cache-Control": "private, no-cache"}
+        if self.last_modified:
+            headers["Last-Modified"] = format_datetime(self.last_modified, usegmt=True)
+        return headers
+
+    def not_modified(self) -> Response:
+        return Response(status_code=304, headers=self.headers())
+
+    def apply(self, response: Response) -> Response:
+        response.headers.update(self.headers())
+        return response
+
+
+def test_validators(conn, patient_id, test_code, variant=""):
+    """Una lectura por PK: versión de un (paciente, examen)."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT version, updated_at FROM lab_data_versions WHERE patient_id = %s AND test_code = %s",
+            (patient_id, test_code),
+        )
+        row = cursor.fetchone()
+    return Validators(*(row or (0, None)), variant=variant)
+
+
+def patient_validators(conn, patient_id, variant=""):
+    """Versión de TODOS los exámenes de un paciente (los contadores solo crecen, así que la suma cambia siempre)."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT COALESCE(SUM(version), 0), MAX(updated_at) FROM lab_data_versions WHERE patient_id = %s",
+            (patient_id,),
+        )
+        row = cursor.fetchone()
+    return Validators(*row, variant=variant)
@@ -0,0 +1,114 @@
+"""
+Perfil de arranque del API: cuánto cuesta importar cada módulo y cada paso de init.
+
+Importa app.main en un proceso limpio con `python -X importtime` (varias corridas,
+mediana por módulo) y reporta los módulos de app.* y los paquetes externos más
+caros. Con --init además mide, en este proceso, el primer uso de lo que es
+perezoso (clientes de AWS, NumPy) y cada paso de init_db contra la BD.
+
+Desde services/:
+    python -m benchmarks.startup                          # Solo imports
+    python -m benchmarks.startup --budget-ms 600          # Falla (exit 1) si el import pasa el presupuesto
+    DB_HOST=localhost python -m benchmarks.startup --init --db-password postgres
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+
+def import_profile(runs: int) -> dict:
+    """{módulo: (ms propios, ms acumulados)} con la mediana de `runs` corridas."""
+    samples = defaultdict(lambda: ([], []))
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import app.main"],
+            capture_output=True, text=True, env=env, check=True,
+        )
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            _, self_us, cumulative_us, name = (part.strip() for part in line.replace("import time:", "|", 1).split("|"))
+            samples[name][0].append(int(self_us) / 1000)
+            samples[name][1].append(int(cumulative_us) / 1000)
+    return {name: (statistics.median(s), statistics.median(c)) for name, (s, c) in samples.items()}
+
+
+def first_use_costs() -> dict:
+    """Lo que ya no se paga al importar: se paga (una vez) en el primer uso."""
+    costs = {}
+    from app import aws
+    for name, factory in (("aws.secrets_client", aws.secrets_client), ("aws.cognito_client", aws.cognito_client)):
+        start = time.perf_counter()
+        factory()
+        costs[name] = round((time.perf_counter() - start) * 1000, 1)
+    start = time.perf_counter()
+    import app.indicators  # noqa: F401  (NumPy)
+    costs["app.indicators (numpy)"] = round((time.perf_counter() - start) * 1000, 1)
+    return costs
+
+
+def init_profile(db_password):
+    from app import database
+    if db_password:  # Desarrollo local: sin Secrets Manager
+        database._secret_cache.update(value=db_password, expires=float("inf"))
+    start = time.perf_counter()
+    result = database.init_db()
+    result["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Perfil de import / init del API")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="Paquetes externos más caros a mostrar")
+    parser.add_argument("--budget-ms", type=float, help="Falla si el import de app.main (mediana) lo supera")
+    parser.add_argument("--init", action="store_true", help="Mide también el primer uso de lo perezoso e init_db")
+    parser.add_argument("--db-password", help="Con --init: password directo en vez de Secrets Manager")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    modules = import_profile(args.runs)
+    total = modules["app.main"][1]
+    app_modules = sorted(((n, t) for n, t in modules.items() if n.startswith("app.")), key=lambda x: -x[1][1])
+    packages = sorted(
+        ((n, t) for n, t in modules.items() if "." not in n and n != "app" and t[1] >= 1),
+        key=lambda x: -x[1][1],
+    )[:args.top]
+    report = {
+        "import_ms": round(total, 1),
+        "app_modules": {n: {"self_ms": round(s, 1), "cumulative_ms": round(c, 1)} for n, (s, c) in app_modules},
+        "packages": {n: round(c, 1) for n, (_, c) in packages},
+    }
+    if args.init:
+        report["first_use_ms"] = first_use_costs()
+        report["init_db"] = init_profile(args.db_password)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Import de app.main: {total:.0f} ms (mediana de {args.runs})\n")
+        print(f"{'módulo':<28} {'propio ms':>10} {'acum. ms':>10}")
+        for name, (self_ms, cumulative_ms) in app_modules:
+            print(f"{name:<28} {self_ms:10.1f} {cumulative_ms:10.1f}")
+        print(f"\n{'paquete externo':<28} {'acum. ms':>10}")
+        for name, (_, cumulative_ms) in packages:
+            print(f"{name:<28} {cumulative_ms:10.1f}")
+        if args.init:
+            print("\nPrimer uso (fuera del arranque):")
+            for name, ms in report["first_use_ms"].items():
+                print(f"  {name:<26} {ms:10.1f}")
+            print(f"\ninit_db: {report['init_db']}")
+
+    if args.budget_ms is not None and total > args.budget_ms:
+        print(f"\nFALLA: el import ({total:.0f} ms) supera el presupuesto de {args.budget_ms:.0f} ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Autoescalado de workers a partir de datos medidos (sin AWS).
+
+Modo simulación: con el ritmo REAL de un worker (filas/s de benchmark.py o el
+gauge worker_processing_rate de producción) y un perfil de llegada, simula la
+regla de target tracking segundo a segundo: cuántos workers habría, cuánto
+crecería la cola y qué lag vería un resultado.
+
+    python autoscale_sim.py --rate 900 --arrivals 50,50,2500,2500,300 --phase-seconds 600 --target-lag 30
+
+Modo en vivo: lee el /metrics de los workers en marcha y dice cuántos harían falta ahora.
+
+    python autoscale_sim.py --metrics-url http://localhost:9100/metrics --target-lag 30
+"""
+import argparse
+import collections
+import urllib.request
+
+from prometheus_client.parser import text_string_to_metric_families
+
+from autoscaling import desired_workers
+
+
+def scrape(url):
+    """(mensajes visibles, mensajes/s) de un worker."""
+    with urllib.request.urlopen(url, timeout=5) as response:
+        text = response.read().decode()
+    visible = rate = 0.0
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            if sample.name == "worker_queue_messages" and sample.labels.get("state") == "visible":
+                visible = sample.value
+            elif sample.name == "worker_processing_rate":
+                rate = sample.value
+    return visible, rate
+
+
+def live(args):
+    samples = [scrape(url) for url in args.metrics_url]
+    visible = max(v for v, _ in samples)  # Todos ven la misma cola
+    rates = [r for _, r in samples if r > 0]
+    rate_per_worker = sum(rates) / len(rates) if rates else args.rate
+    # En régimen estable lo que llega es lo que se procesa (cota inferior si la cola está creciendo)
+    desired = desired_workers(visible, rate_per_worker, args.target_lag, sum(rates), args.min_workers, args.max_workers)
+    print(f"Visibles: {visible:.0f} | ritmo por worker: {rate_per_worker:.1f} msg/s | "
+          f"workers: {len(samples)} -> {desired}")
+
+
+def simulate(args):
+    arrivals = [float(a) for a in args.arrivals.split(",")]
+    total_seconds = len(arrivals) * args.phase_seconds
+    workers, pending_starts = args.min_workers, collections.deque()  # (segundo en que arranca, cuántos)
+    queue = collections.deque()  # [segundo de llegada, mensajes] en orden FIFO
+    visible = 0.0
+    last_scale = -args.cooldown
+    arrived_since_eval = 0.0
+    worker_seconds = 0
+    max_lag = 0.0
+
+    print(f"{'t (min)':>8} {'llegan/s':>9} {'workers':>8} {'en cola':>10} {'lag (s)':>8}")
+    for t in range(total_seconds):
+        rate_in = arrivals[t // args.phase_seconds]
+        queue.append([t, rate_in])
+        visible += rate_in
+        arrived_since_eval += rate_in
+        while pending_starts and pending_starts[0][0] <= t:
+            workers += pending_starts.popleft()[1]
+
+        capacity = workers * args.rate
+        while capacity > 0 and queue:
+            taken = min(capacity, queue[0][1])
+            queue[0][1] -= taken
+            capacity -= taken
+            visible -= taken
+            if queue[0][1] <= 1e-9:
+                max_lag = max(max_lag, t - queue.popleft()[0])
+        lag = t - queue[0][0] if queue else 0
+        worker_seconds += workers
+
+        # Evaluación de la política (como CloudWatch: cada `evaluation` segundos)
+        # (llegadas/s medidas en la ventana, como NumberOfMessagesSent de SQS en CloudWatch)
+        if t % args.evaluation == 0:
+            arrival_rate = arrived_since_eval / args.evaluation
+            arrived_since_eval = 0.0
+            starting = sum(n for _, n in pending_starts)
+            desired = desired_workers(visible, args.rate, args.target_lag, arrival_rate, args.min_workers, args.max_workers)
+            if desired > workers + starting and t - last_scale >= args.cooldown:
+                pending_starts.append((t + args.startup_seconds, desired - workers - starting))
+                last_scale = t
+            elif desired < workers and not starting and t - last_scale >= args.scale_in_cooldown:
+                workers = desired  # El worker que sobra termina su lote y sale
+                last_scale = t
+
+        if t % args.report_every == 0:
+            print(f"{t / 60:8.1f} {rate_in:9.0f} {workers:8d} {visible:10.0f} {lag:8.0f}")
+
+    print(f"\nLag máximo: {max(max_lag, lag):.0f} s | worker-horas: {worker_seconds / 3600:.2f} "
+          f"| cola al final: {visible:.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dimensionado / autoescalado de workers de ingesta")
+    parser.add_argument("--rate", type=float, default=500.0, help="Mensajes/s que procesa UN worker (medido)")
+    parser.add_argument("--target-lag", type=float, default=60.0, help="Segundos de backlog aceptables")
+    parser.add_argument("--min-workers", type=int, default=1)
+    parser.add_argument("--max-workers", type=int, default=10)
+    parser.add_argument("--metrics-url", action="append", help="/metrics de un worker (modo en vivo, repetible)")
+    parser.add_argument("--arrivals", default="50,50,2000,2000,200", help="Llegadas/s por fase (modo simulación)")
+    parser.add_argument("--phase-seconds", type=int, default=600)
+    parser.add_argument("--evaluation", type=int, default=60, help="Segundos entre evaluaciones de la política")
+    parser.add_argument("--cooldown", type=int, default=120, help="Cooldown de scale-out")
+    parser.add_argument("--scale-in-cooldown", type=int, default=300)
+    parser.add_argument("--startup-seconds", type=int, default=60, help="Lo que tarda en arrancar una tarea Fargate")
+    parser.add_argument("--report-every", type=int, default=120)
+    args = parser.parse_args()
+
+    if args.metrics_url:
+        live(args)
+    else:
+        simulate(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import logging
+import math
+import os
+import threading
+from metrics import QUEUE_MESSAGES, QUEUE_OLDEST_AGE, PROCESSING_RATE, BACKLOG_SECONDS, processing_rate
+
+logger = logging.getLogger("worker")
+
+# --- Señales para dimensionar los workers ---
+# Un hilo muestrea la cola cada QUEUE_STATS_SECONDS y publica profundidad, edad del
+# mensaje más viejo, ritmo de procesamiento y backlog en segundos (Prometheus y,
+# si CLOUDWATCH_NAMESPACE está definido, CloudWatch). Con eso:
+#   workers = ceil((llegadas/s + visibles / lag aceptable) / ritmo por worker)
+# El término de llegadas evita el serrucho de escalar solo por backlog: al vaciar la
+# cola el backlog cae a 0 pero las llegadas siguen. autoscale_sim.py usa esta misma regla.
+
+QUEUE_STATS_SECONDS = float(os.environ.get("QUEUE_STATS_SECONDS", "15"))
+CLOUDWATCH_NAMESPACE = os.environ.get("CLOUDWATCH_NAMESPACE")  # Ej: "HealthTrends/Worker"; vacío = no publicar
+SERVICE_NAME = os.environ.get("SERVICE_NAME", "healthtrends-processor-service")
+
+
+def desired_workers(visible, rate_per_worker, target_lag_seconds, arrival_rate=0.0, min_workers=1, max_workers=10):
+    """Workers para absorber `arrival_rate` msg/s y además vaciar `visible` en `target_lag_seconds`."""
+    if rate_per_worker <= 0:
+        return min_workers if not visible else max_workers
+    needed = math.ceil((arrival_rate + visible / target_lag_seconds) / rate_per_worker)
+    return max(min_workers, min(max_workers, needed))
+
+
+class QueueMonitor:
+    def __init__(self, queue, interval=QUEUE_STATS_SECONDS):
+        self.queue = queue
+        self.interval = interval
+        self._batch_oldest_age = 0.0
+        self._lag_p95 = 0.0
+        self._stop = threading.Event()
+        self._cloudwatch = None
+        if CLOUDWATCH_NAMESPACE:
+            import boto3
+            self._cloudwatch = boto3.client("cloudwatch")
+
+    def observe_batch(self, result):
+        """Resultado de process_batch. SQS no da la edad del más viejo por API: usamos la del lote."""
+        if result.get("oldest_age_seconds") is not None:
+            self._batch_oldest_age = result["oldest_age_seconds"]
+        if result.get("lag_seconds"):
+            self._lag_p95 = result["lag_seconds"]["p95"]
+
+    def start(self):
+        threading.Thread(target=self._run, name="queue-monitor", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:  # Las métricas nunca deben tumbar al worker
+                logger.warning("No se pudieron muestrear las métricas de la cola: %s", e)
+
+    def sample(self):
+        stats = self.queue.stats()
+        oldest = stats["oldest_age_seconds"]
+        if oldest is None:
+            oldest = self._batch_oldest_age
+        rate = processing_rate.rate()
+        backlog = stats["visible"] / rate if rate > 0 else (0.0 if not stats["visible"] else float("inf"))
+
+        QUEUE_MESSAGES.labels("visible").set(stats["visible"])
+        QUEUE_MESSAGES.labels("in_flight").set(stats["in_flight"])
+        QUEUE_OLDEST_AGE.set(oldest)
+        PROCESSING_RATE.set(rate)
+        BACKLOG_SECONDS.set(backlog)
+        if self._cloudwatch is not None:
+            self._publish(stats, oldest, rate)
+        return {**stats, "oldest_age_seconds": oldest, "rate": rate, "backlog_seconds": backlog}
+
+    def _publish(self, stats, oldest, rate):
+        dims = [{"Name": "ServiceName", "Value": SERVICE_NAME}]
+        self._cloudwatch.put_metric_data(Namespace=CLOUDWATCH_NAMESPACE, MetricData=[
+            # Por tarea: con estadística Sum da el ritmo total del servicio
+            {"MetricName": "ProcessingRate", "Dimensions": dims, "Value": rate, "Unit": "Count/Second"},
+            {"MetricName": "QueueVisibleMessages", "Dimensions": dims, "Value": stats["visible"], "Unit": "Count"},
+            {"MetricName": "OldestMessageAge", "Dimensions": dims, "Value": oldest, "Unit": "Seconds"},
+            {"MetricName": "IngestLagP95", "Dimensions": dims, "Value": self._lag_p95, "Unit": "Seconds"},
+        ])
@@ -0,0 +1,83 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# --- Métricas Prometheus del worker ---
+# messages/s = rate(worker_messages_total[1m])
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+
+MESSAGES = Counter(
+    "worker_messages_total", "Mensajes procesados por resultado",
+    ["result"],  # processed | failed | duplicate (reentregado, ya estaba en la BD)
+)
+BATCH_SIZE = Histogram(
+    "worker_batch_size", "Mensajes recibidos por lote",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+BATCH_SECONDS = Histogram(
+    "worker_batch_duration_seconds", "Tiempo total de procesamiento de un lote",
+)
+COMMIT_SECONDS = Histogram(
+    "worker_commit_duration_seconds", "Latencia del commit de cada lote",
+)
+INGEST_LAG_SECONDS = Histogram(
+    "worker_ingest_lag_seconds", "Desde que API Gateway recibió el resultado hasta el commit de su fila",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600),
+)
+BATCH_LAG_SECONDS = Gauge(
+    "worker_batch_lag_seconds", "Lag de punta a punta del último lote, por cuantil",
+    ["quantile"],  # 0.5 | 0.95 | 1 (máximo)
+)
+QUEUE_MESSAGES = Gauge(
+    "worker_queue_messages", "Mensajes en la cola (aproximado en SQS)",
+    ["state"],  # visible | in_flight
+)
+QUEUE_OLDEST_AGE = Gauge(
+    "worker_queue_oldest_message_age_seconds",
+    "Edad del mensaje más viejo (cola en memoria) o del más viejo recibido en el último lote (SQS)",
+)
+PROCESSING_RATE = Gauge(
+    "worker_processing_rate", "Mensajes procesados por segundo por este worker (ventana móvil)",
+)
+BACKLOG_SECONDS = Gauge(
+    "worker_backlog_seconds", "Segundos que tardaría ESTE worker en vaciar lo visible al ritmo actual",
+)
+LOOP_ERRORS = Counter(
+    "worker_loop_errors_total", "Errores en el bucle principal",
+    ["kind"],  # db_connection | db_error | other
+)
+
+
+def start_metrics_server():
+    """Expone /metrics en METRICS_PORT (0 = desactivado)."""
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+        logging.getLogger("worker").info("Métricas en :%d/metrics", METRICS_PORT)
+
+
+class RateMeter:
+    """Mensajes/s en una ventana móvil (lo que de verdad procesa un worker, con la BD real)."""
+
+    def __init__(self, window_seconds=60):
+        self.window = window_seconds
+        self._events = deque()  # (monotonic, n)
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+
+    def add(self, n):
+        with self._lock:
+            self._events.append((time.monotonic(), n))
+
+    def rate(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._events and self._events[0][0] < now - self.window:
+                self._events.popleft()
+            total = sum(n for _, n in self._events)
+        return total / max(min(self.window, now - self._started), 1e-9)
+
+
+processing_rate = RateMeter()
@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+# --- Abstracción de la cola de ingesta ---
+# El worker solo necesita tres operaciones: recibir, (enviar) y borrar
+# (más stats() para las métricas de profundidad que consume el autoescalado).
+# Así podemos correrlo contra SQS real, contra un SQS local compatible
+# (ElasticMQ / LocalStack vía SQS_ENDPOINT_URL) o contra una cola en memoria
+# para benchmarks sin ninguna credencial de AWS.
+
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND", "sqs")          # "sqs" o "memory"
+SQS_QUEUE_URL = os.environ.get("SQS_QUEUE_URL")
+SQS_ENDPOINT_URL = os.environ.get("SQS_ENDPOINT_URL")           # Ej: http://localhost:9324 (ElasticMQ)
+
+SQS_MAX_BATCH = 10  # Límite de SQS para receive_message y delete_message_batch
+
+
+class SQSQueue:
+    """Cola SQS real (o compatible, si se pasa endpoint_url)."""
+
+    def __init__(self, queue_url, endpoint_url=None, region_name=None):
+        import boto3
+        self.queue_url = queue_url
+        self.client = boto3.client(
+            "sqs",
+            endpoint_url=endpoint_url,
+            region_name=region_name or os.environ.get("AWS_REGION", "us-east-1"),
+        )
+
+    def send(self, body):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=body)
+
+    def send_batch(self, bodies):
+        for i in range(0, len(bodies), SQS_MAX_BATCH):
+            chunk = bodies[i:i + SQS_MAX_BATCH]
+            self.client.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{"Id": str(n), "MessageBody": b} for n, b in enumerate(chunk)],
+            )
+
+    def receive(self, max_messages=SQS_MAX_BATCH, wait_seconds=20):
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max_messages,
+            WaitTimeSeconds=wait_seconds,          # Long Polling
+            AttributeNames=["SentTimestamp"],      # Para medir el lag de punta a punta
+            MessageAttributeNames=["correlation_id", "enqueued_at"],
+        )
+        return response.get("Messages", [])
+
+    def stats(self):
+        """Profundidad aproximada (SQS no expone la edad del más viejo: esa es la métrica de CloudWatch)."""
+        attrs = self.client.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=["ApproximateNumberOfMessages", "ApproximateNumberOfMessagesNotVisible"],
+        )["Attributes"]
+        return {
+            "visible": int(attrs["ApproximateNumberOfMessages"]),
+            "in_flight": int(attrs["ApproximateNumberOfMessagesNotVisible"]),
+            "oldest_age_seconds": None,
+        }
+
+    def delete_batch(self, receipt_handles):
+        # Una llamada por cada 10 mensajes en lugar de una por mensaje
+        for i in range(0, len(receipt_handles), SQS_MAX_BATCH):
+            chunk = receipt_handles[i:i + SQS_MAX_BATCH]
+            self.client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{"Id": str(n), "ReceiptHandle": h} for n, h in enumerate(chunk)],
+            )
+
+
+class InMemoryQueue:
+    """
+    Cola en memoria con la misma semántica básica que SQS:
+    los mensajes recibidos quedan invisibles durante `visibility_timeout`
+    y vuelven a la cola si nadie los borra.
+    """
+
+    def __init__(self, visibility_timeout=300):
+        self.visibility_timeout = visibility_timeout
+        self._visible = deque()
+        self._in_flight = {}  # receipt_handle -> (deadline, message)
+        self._cond = threading.Condition()
+
+    def send(self, body):
+        self.send_batch([body])
+
+    def send_batch(self, bodies):
+        sent_ms = str(int(time.time() * 1000))
+        with self._cond:
+            for body in bodies:
+                self._visible.append({
+                    "MessageId": str(uuid.uuid4()),
+                    "Body": body,
+                    "Attributes": {"SentTimestamp": sent_ms},
+                })
+            self._cond.notify_all()
+
+    def _requeue_expired(self):
+        now = time.monotonic()
+        expired = [h for h, (deadline, _) in self._in_flight.items() if deadline <= now]
+        for handle in expired:
+            _, msg = self._in_flight.pop(handle)
+            self._visible.append(msg)
+
+    def receive(self, max_messages=SQS_MAX_BATCH, wait_seconds=20):
+        deadline = time.monotonic() + wait_seconds
+        with self._cond:
+            while True:
+                self._requeue_expired()
+                if self._visible:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(min(remaining, 1.0))
+
+            batch = []
+            while self._visible and len(batch) < max_messages:
+                msg = self._visible.popleft()
+                handle = str(uuid.uuid4())
+                self._in_flight[handle] = (time.monotonic() + self.visibility_timeout, msg)
+                batch.append(dict(msg, ReceiptHandle=handle))
+            return batch
+
+    def delete_batch(self, receipt_handles):
+        with self._cond:
+            for handle in receipt_handles:
+                self._in_flight.pop(handle, None)
+
+    def stats(self):
+        with self._cond:
+            oldest = min((int(m["Attributes"]["SentTimestamp"]) for m in self._visible), default=None)
+            return {
+                "visible": len(self._visible),
+                "in_flight": len(self._in_flight),
+                "oldest_age_seconds": time.time() - oldest / 1000 if oldest is not None else 0.0,
+            }
+
+    def pending(self):
+        """(visibles, en vuelo) — útil para saber cuándo se vació la cola."""
+        with self._cond:
+            return len(self._visible), len(self._in_flight)
+
+
+def get_queue():
+    """Construye la cola según QUEUE_BACKEND."""
+    if QUEUE_BACKEND == "memory":
+        return InMemoryQueue()
+    return SQSQueue(SQS_QUEUE_URL, endpoint_url=SQS_ENDPOINT_URL)
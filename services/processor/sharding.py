@@ -0,0 +1,116 @@
+import bisect
+import hashlib
+import os
+import psycopg2
+from collections import namedtuple
+
+# --- Shard de cada mensaje (sharding de pacientes) ---
+# Copia del anillo de app/sharding.py: la imagen del worker no lleva el paquete app.
+# Con el mismo DB_SHARDS / SHARD_VNODES ambos mandan a cada paciente al mismo shard;
+# si se cambia el hash o el formato hay que cambiarlo en los dos
+# (tests/processor/test_sharding.py verifica que den lo mismo).
+
+DB_SHARDS = os.environ.get("DB_SHARDS", "")
+SHARD_VNODES = int(os.environ.get("SHARD_VNODES", "128"))
+
+Shard = namedtuple("Shard", ["name", "host", "port", "dbname"])
+
+
+def parse_shards(spec, default_host, default_dbname):
+    """ "s0=db-a,s1=db-b:5433/pacientes" -> [Shard]. Vacío = un solo shard "default"."""
+    shards = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, target = item.partition("=")
+        if not sep or not name.strip() or not target.strip():
+            raise ValueError(f"Shard inválido: {item!r} (se espera nombre=host[:puerto][/bd])")
+        address, _, dbname = target.strip().partition("/")
+        host, _, port = address.partition(":")
+        shards.append(Shard(name.strip(), host, int(port) if port else None, dbname or default_dbname))
+    if not shards:
+        return [Shard("default", default_host, None, default_dbname)]
+    names = [shard.name for shard in shards]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Nombres de shard repetidos: {names}")
+    return shards
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, shards, vnodes=SHARD_VNODES):
+        self.shards = list(shards)
+        points = sorted((_hash(f"{shard.name}#{i}"), n) for n, shard in enumerate(self.shards) for i in range(vnodes))
+        self._points = [point for point, _ in points]
+        self._owners = [self.shards[n] for _, n in points]
+
+    def lookup(self, key):
+        if len(self.shards) == 1:
+            return self.shards[0]
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[i]
+
+
+class ShardConnections:
+    """Una conexión por shard, abierta al primer uso; `connect(shard)` la crea."""
+
+    def __init__(self, shards, connect):
+        self.ring = HashRing(shards)
+        self._connect = connect
+        self._conns = {}
+
+    @classmethod
+    def for_connection(cls, conn):
+        """Un solo shard con una conexión ya abierta (benchmark, pruebas)."""
+        shard = Shard("default", None, None, None)
+        pool = cls([shard], connect=None)
+        pool._conns[shard] = conn
+        return pool
+
+    @property
+    def shards(self):
+        return self.ring.shards
+
+    def group(self, items, patient_id):
+        """{shard: [items]} según patient_id(item); conserva el orden de llegada."""
+        groups = {}
+        for item in items:
+            groups.setdefault(self.ring.lookup(str(patient_id(item))), []).append(item)
+        return groups
+
+    def get(self, shard):
+        conn = self._conns.get(shard)
+        if conn is None:
+            conn = self._conns[shard] = self._connect(shard)
+        return conn
+
+    def reset(self, shard):
+        """Descarta la conexión (caída): la próxima vez se vuelve a conectar."""
+        conn = self._conns.pop(shard, None)
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def rollback(self, shard=None):
+        """
+        ROLLBACK de un shard (o de todos): una transacción abortada dejaría la conexión
+        respondiendo InFailedSqlTransaction a todo. Si ni el ROLLBACK pasa, se descarta.
+        """
+        for target in [shard] if shard is not None else list(self._conns):
+            conn = self._conns.get(target)
+            if conn is None:
+                continue
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self.reset(target)
+
+    def close(self):
+        for shard in list(self._conns):
+            self.reset(shard)
@@ -1,185 +1,353 @@
 import os
+import logging
 import boto3
 import json
 import psycopg2 # Biblioteca de Python para conectarse a PostgreSQL
+from psycopg2.extras import execute_values
 import time
+from queues import get_queue
+from logger import setup_logging, flush_logging, correlation_id
+from metrics import (
+    MESSAGES, BATCH_SIZE, BATCH_SECONDS, COMMIT_SECONDS, LOOP_ERRORS, INGEST_LAG_SECONDS, BATCH_LAG_SECONDS,
+    processing_rate, start_metrics_server,
+)
+from autoscaling import QueueMonitor
+from sharding import DB_SHARDS, ShardConnections, parse_shards
+
+logger = logging.getLogger("worker")
 
 # --- Configuración (leída desde variables de entorno) ---
-SQS_QUEUE_URL = os.environ.get("SQS_QUEUE_URL")
 DB_SECRET_ARN = os.environ.get("DB_SECRET_ARN") # ARN del secreto de la contraseña de RDS
 DB_HOST = os.environ.get("DB_HOST")             # Endpoint de la instancia RDS
 DB_NAME = "postgres"  # O el nombre que prefieras, 'postgres' es el por defecto
 DB_USER = "postgres"
-
-# --- Clientes de AWS ---
-sqs_client = boto3.client("sqs")
-secrets_client = boto3.client("secretsmanager")
+SHARDS = parse_shards(DB_SHARDS, DB_HOST, DB_NAME)  # Vacío = un solo shard en DB_HOST
 
 def get_db_password():
     """Obtiene la contraseña de la BD desde AWS Secrets Manager."""
-    print("Obteniendo contraseña de Secrets Manager...")
+    logger.info("Obteniendo contraseña de Secrets Manager...")
     try:
+        # Cliente creado aquí (y no al importar) para poder usar el worker sin AWS (benchmark)
+        secrets_client = boto3.client("secretsmanager")
         response = secrets_client.get_secret_value(SecretId=DB_SECRET_ARN)
         # SIN json.loads AQUÍ
         return response['SecretString']
     except Exception as e:
-        print(f"Error al obtener la contraseña: {e}")
+        logger.error("Error al obtener la contraseña: %s", e)
         raise e
 
-def connect_to_db(password):
-    """Se conecta a la base de datos RDS PostgreSQL."""
-    print(f"Conectando a la BD en host: {DB_HOST}...")
+def connect_to_db(password, shard=SHARDS[0]):
+    """Se conecta a la base de datos RDS PostgreSQL (al primario del shard)."""
+    logger.info("Conectando a la BD en host: %s (shard %s)...", shard.host, shard.name)
     try:
         conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
+            host=shard.host,
+            port=shard.port,
+            database=shard.dbname,
             user=DB_USER,
             password=password,
             connect_timeout=5
         )
-        print("Conexión a la BD exitosa.")
+        logger.info("Conexión a la BD exitosa.")
         return conn
     except Exception as e:
-        print(f"Error al conectar a la BD: {e}")
+        logger.error("Error al conectar a la BD: %s", e)
         raise e
 
-def process_message(msg, cursor):
-    """Procesa un solo mensaje SQS y lo inserta en la BD."""
+# La bandera de anormal se calcula en el mismo INSERT con lab_abnormal_flag()
+# (la crea la migración de arranque de la API, junto con los rangos de referencia).
+# ON CONFLICT DO NOTHING contra el índice único de dedup_key: un mensaje reentregado
+# por SQS (p. ej. el worker cayó entre el COMMIT y el borrado) no duplica el resultado.
+# RETURNING cuenta cuántas filas entraron de verdad.
+INSERT_SQL = """
+INSERT INTO lab_results (patient_id, test_code, test_name, value, unit, test_date, abnormal_flag)
+SELECT v.*, lab_abnormal_flag(v.patient_id, v.test_code, v.value, v.test_date)
+FROM (VALUES %s) AS v (patient_id, test_code, test_name, value, unit, test_date)
+ON CONFLICT DO NOTHING
+RETURNING 1;
+"""
+# Tipos explícitos: dentro de un VALUES suelto Postgres no puede inferirlos
+VALUES_TEMPLATE = "(%s, %s, %s, %s::numeric, %s, %s::timestamp)"
+
+def parse_message(msg):
+    """
+    Valida el cuerpo del mensaje y devuelve la tupla de parámetros del INSERT.
+    Lanza ValueError si el mensaje está mal formado, ANTES de tocar la BD:
+    un error de SQL abortaría la transacción de todo el lote.
+    """
     try:
-        print(f"Procesando mensaje: {msg['MessageId']}")
         body = json.loads(msg['Body'])
+    except (TypeError, json.JSONDecodeError) as e:
+        raise ValueError(f"JSON inválido: {e}")
 
-        # Asegúrate de que los nombres de las columnas coincidan con tu script SQL
-        sql = """
-        INSERT INTO lab_results (patient_id, test_code, test_name, value, unit, test_date)
-        VALUES (%s, %s, %s, %s, %s, %s);
-        """
-        
-        # Asume que tu script 'setup_database.sql' (que crearemos después)
-        # crea una tabla con estas columnas.
-        # (Ajusta los 'get' si tu JSON es diferente)
-        params = (
-            body.get('patient_id'),
-            body.get('test_code'),
-            body.get('test_name'),
-            body.get('value'),
-            body.get('unit'),
-            body.get('test_date') # Asegúrate de que la Lambda de ingesta lo añada o ya venga
-        )
-        
-        cursor.execute(sql, params)
-        print(f"Mensaje {msg['MessageId']} insertado.")
-        return True
-    except Exception as e:
-        print(f"Error al procesar mensaje {msg['MessageId']}: {e}")
-        return False
+    if not isinstance(body, dict):
+        raise ValueError("El cuerpo no es un objeto JSON")
+    if not body.get('patient_id') or not body.get('test_code'):
+        raise ValueError("Faltan patient_id o test_code")
+
+    value = body.get('value')
+    if value is not None:
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Valor no numérico: {value!r}")
+
+    return (
+        body.get('patient_id'),
+        body.get('test_code'),
+        body.get('test_name'),
+        value,
+        body.get('unit'),
+        body.get('test_date') # Asegúrate de que la Lambda de ingesta lo añada o ya venga
+    )
+
+def message_correlation_id(msg):
+    """El correlation id que puso la Lambda de ingesta (o el MessageId si no viene)."""
+    attr = msg.get('MessageAttributes', {}).get('correlation_id', {})
+    return attr.get('StringValue') or msg['MessageId']
+
+def message_enqueued_at(msg):
+    """Epoch (s) en que el resultado entró al sistema: el stamp de la Lambda o, si no viene, el SentTimestamp de SQS."""
+    attr = msg.get('MessageAttributes', {}).get('enqueued_at', {})
+    stamp = attr.get('StringValue') or msg.get('Attributes', {}).get('SentTimestamp')
+    try:
+        return int(stamp) / 1000 if stamp else None
+    except ValueError:
+        return None
+
+def lag_percentiles(lags):
+    """p50 / p95 / máximo de los lags de un lote (nearest-rank; los lotes son chicos)."""
+    ordered = sorted(lags)
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+    return {"p50": pick(0.5), "p95": pick(0.95), "max": ordered[-1]}
+
+def parse_batch(messages):
+    """[(mensaje, parámetros)] de los mensajes válidos; los mal formados se loguean y quedan fuera."""
+    valid = []
+    for msg in messages:
+        try:
+            correlation_id.set(message_correlation_id(msg))
+            valid.append((msg, parse_message(msg)))
+        except ValueError as e:
+            logger.warning("Mensaje mal formado: %s", e, extra={"message_id": msg['MessageId']})
+        finally:
+            correlation_id.set(None)
+    return valid
+
+def insert_isolated(msg, params, cursor):
+    """
+    Inserta un solo mensaje dentro de un SAVEPOINT: si la BD lo rechaza, el resto del lote sigue.
+    Devuelve las filas insertadas (0 = duplicado) o None si se rechazó.
+    """
+    try:
+        correlation_id.set(message_correlation_id(msg))
+        cursor.execute("SAVEPOINT msg")
+        inserted = len(execute_values(cursor, INSERT_SQL, [params], template=VALUES_TEMPLATE, fetch=True))
+        cursor.execute("RELEASE SAVEPOINT msg")
+        return inserted
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT msg")
+        logger.warning("Error al procesar mensaje: %s", e, extra={"message_id": msg['MessageId']})
+        return None
+    finally:
+        correlation_id.set(None)
+
+def insert_batch(valid, db_conn):
+    """
+    Inserta y confirma en un shard -> (mensajes confirmados, duplicados, segundos del commit).
+    Los duplicados (ya estaban en la BD) también cuentan como confirmados: se borran de la cola.
+    """
+    with db_conn.cursor() as cursor:
+        try:
+            # Un solo INSERT multi-fila: los triggers por sentencia de lab_results
+            # (versiones, tendencias, rollups, sketches) corren una vez por lote
+            rows = execute_values(cursor, INSERT_SQL, [params for _, params in valid], template=VALUES_TEMPLATE, fetch=True)
+            processed = [msg for msg, _ in valid]
+            duplicates = len(valid) - len(rows)
+        except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+            # Alguna fila rechazada (fecha inválida, valor fuera de rango...): fila por fila
+            logger.warning("Lote rechazado (%s), reintentando mensaje por mensaje", e)
+            db_conn.rollback()
+            results = [(msg, insert_isolated(msg, params, cursor)) for msg, params in valid]
+            processed = [msg for msg, inserted in results if inserted is not None]
+            duplicates = sum(1 for _, inserted in results if inserted == 0)
+
+        # Confirmar la transacción a la BD
+        commit_start = time.perf_counter()
+        db_conn.commit()
+        return processed, duplicates, time.perf_counter() - commit_start
+
+def process_batch(messages, db, queue):
+    """
+    Procesa un lote en UNA transacción por shard y borra de la cola los mensajes insertados.
+    `db` es un ShardConnections. Si un shard está caído, sus mensajes vuelven a la cola y
+    los de los demás shards siguen su curso (igual si la BD rechaza el lote con otro error).
+    Devuelve estadísticas del lote (las usa también el benchmark).
+    """
+    batch_start = time.perf_counter()
+    received_at = time.time()
+    enqueued = [message_enqueued_at(m) for m in messages]
+    oldest_age = max((received_at - t for t in enqueued if t is not None), default=None)
+    valid = parse_batch(messages)
+    processed, duplicates, commit_seconds = [], 0, 0.0
+    for shard, items in db.group(valid, patient_id=lambda item: item[1][0]).items():
+        try:
+            inserted, skipped, seconds = insert_batch(items, db.get(shard))
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            LOOP_ERRORS.labels("db_connection").inc()
+            logger.error("Error de conexión al shard %s: %s. Se reconecta en el próximo lote.", shard.name, e)
+            db.reset(shard)
+            continue
+        except psycopg2.Error as e:
+            # Cualquier otro error de la BD (un trigger, lab_abnormal_flag, InternalError...):
+            # ROLLBACK para no dejar la conexión abortada; los mensajes del shard se reentregan
+            LOOP_ERRORS.labels("db_error").inc()
+            logger.error("Error de BD en el shard %s: %s. Sus mensajes vuelven a la cola.", shard.name, e)
+            db.rollback(shard)
+            continue
+        processed += inserted
+        duplicates += skipped
+        commit_seconds += seconds
+    committed_at = time.time()
+
+    # Lag de punta a punta (API Gateway -> fila confirmada) de cada mensaje insertado
+    lags = [committed_at - t for t in map(message_enqueued_at, processed) if t is not None]
+    lag = lag_percentiles(lags) if lags else None
+    for value in lags:
+        INGEST_LAG_SECONDS.observe(value)
+    if lag:
+        BATCH_LAG_SECONDS.labels("0.5").set(lag["p50"])
+        BATCH_LAG_SECONDS.labels("0.95").set(lag["p95"])
+        BATCH_LAG_SECONDS.labels("1").set(lag["max"])
+    logger.debug("Lote de mensajes confirmado en la BD.", extra={"sample": True, "lag_seconds": lag})
+
+    # Borrar mensajes de la cola (los fallidos se quedan para reintento / DLQ)
+    if processed:
+        queue.delete_batch([msg['ReceiptHandle'] for msg in processed])
+
+    failed = len(messages) - len(processed)
+    BATCH_SIZE.observe(len(messages))
+    COMMIT_SECONDS.observe(commit_seconds)
+    BATCH_SECONDS.observe(time.perf_counter() - batch_start)
+    MESSAGES.labels("processed").inc(len(processed) - duplicates)
+    processing_rate.add(len(processed))  # Los fallidos vuelven a la cola: no cuentan como vaciado
+    if failed:
+        MESSAGES.labels("failed").inc(failed)
+    if duplicates:
+        MESSAGES.labels("duplicate").inc(duplicates)
+        logger.info("%d mensajes reentregados descartados (ya estaban en la BD)", duplicates)
+
+    return {
+        "processed": processed,
+        "failed": failed,
+        "duplicates": duplicates,
+        "commit_seconds": commit_seconds,
+        "lags": lags,
+        "lag_seconds": lag,
+        "oldest_age_seconds": oldest_age,
+    }
+
+def ensure_tables(connection):
+    """Crea las tablas base si no existen (Tarea 11.1) y verifica que el shard ya esté migrado."""
+    with connection.cursor() as c:
+        logger.info("Verificando tablas en la base de datos...")
+
+        # 1. Tabla de Resultados (Ya existía)
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS lab_results (
+            id SERIAL PRIMARY KEY,
+            patient_id VARCHAR(100),
+            test_code VARCHAR(50),
+            test_name VARCHAR(150),
+            value NUMERIC(10, 2),
+            unit VARCHAR(30),
+            test_date TIMESTAMP,
+            ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+
+        # 2. NUEVA TABLA: Perfiles de Pacientes
+        # Aquí guardaremos lo que capturemos en el registro
+        c.execute("""
+        CREATE TABLE IF NOT EXISTS patient_profiles (
+            patient_id VARCHAR(100) PRIMARY KEY, -- El email o username de Cognito
+            full_name VARCHAR(200),
+            dob DATE,
+            gender VARCHAR(20),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+
+        # 3. Bandera de resultado anormal (la calcula lab_abnormal_flag() al insertar)
+        c.execute("ALTER TABLE lab_results ADD COLUMN IF NOT EXISTS abnormal_flag CHAR(1);")
+
+        # 4. lab_abnormal_flag() la crea la migración de la API (con los rangos de referencia):
+        # sin ella cada INSERT falla, así que el worker no arranca hasta que el shard esté migrado
+        c.execute("SELECT to_regprocedure('lab_abnormal_flag(varchar,varchar,numeric,timestamp)') IS NOT NULL")
+        if not c.fetchone()[0]:
+            connection.rollback()
+            raise RuntimeError(
+                f"La BD {connection.info.dbname} en {connection.info.host} no tiene lab_abnormal_flag(): "
+                "arranca la API (o corre init_db) contra este shard antes que el worker"
+            )
+
+        connection.commit()
+        logger.info("Tablas 'lab_results' y 'patient_profiles' listas.")
 
-def main_loop():
+def main_loop(queue=None):
     """El bucle principal del worker."""
 
-    print("Iniciando worker...")
-    print("Iniciando worker... VERSION 2 (CORREGIDA)")
+    logger.info("Iniciando worker...")
+    queue = queue or get_queue()
+    start_metrics_server()
+    # Profundidad / edad / ritmo de la cola para el autoescalado
+    monitor = QueueMonitor(queue)
+    monitor.start()
     
-    # 1. Obtener contraseña y conectar a la BD (solo una vez al inicio)
+    # 1. Obtener contraseña (solo una vez al inicio); cada shard se conecta en su primer lote
     db_password = get_db_password()
-    db_conn = connect_to_db(db_password)
+    db = ShardConnections(SHARDS, lambda shard: connect_to_db(db_password, shard))
     
     while True:
         try:
-            print("Buscando mensajes en SQS...")
-            
-            # 2. Pedir mensajes a SQS
-            response = sqs_client.receive_message(
-                QueueUrl=SQS_QUEUE_URL,
-                MaxNumberOfMessages=10, # Procesar en lotes de 10
-                WaitTimeSeconds=20      # Espera 20 segundos por mensajes (Long Polling)
-            )
-
-            messages = response.get("Messages", [])
+            # 2. Pedir mensajes (lotes de 10, Long Polling de 20 segundos)
+            messages = queue.receive(max_messages=10, wait_seconds=20)
             
             if not messages:
-                print("No hay mensajes, volviendo a esperar.")
+                logger.debug("No hay mensajes, volviendo a esperar.", extra={"sample": True})
                 continue
 
-            print(f"Recibidos {len(messages)} mensajes.")
+            logger.debug("Recibidos %d mensajes.", len(messages), extra={"sample": True})
             
-            # 3. Procesar mensajes en una transacción
-            with db_conn.cursor() as cursor:
-                receipt_handles = [] # Lista de mensajes a borrar
-                
-                for msg in messages:
-                    if process_message(msg, cursor):
-                        receipt_handles.append(msg['ReceiptHandle'])
-
-                # 4. Confirmar la transacción a la BD
-                db_conn.commit()
-                print("Lote de mensajes confirmado en la BD.")
-
-                # 5. Borrar mensajes de SQS
-                if receipt_handles:
-                    print(f"Borrando {len(receipt_handles)} mensajes de SQS.")
-                    for handle in receipt_handles:
-                        sqs_client.delete_message(
-                            QueueUrl=SQS_QUEUE_URL,
-                            ReceiptHandle=handle
-                        )
-
-        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
-            print(f"Error de conexión a la BD: {e}. Reconectando...")
-            # Si la conexión a la BD se pierde, vuelve a conectar
-            db_conn.close()
-            db_conn = connect_to_db(db_password)
+            # 3. Procesar, confirmar y borrar en una transacción por shard
+            # (una conexión caída se descarta dentro y se reconecta en el próximo lote)
+            monitor.observe_batch(process_batch(messages, db, queue))
             
         except Exception as e:
-            print(f"Error en el bucle principal: {e}")
+            LOOP_ERRORS.labels("other").inc()
+            logger.exception("Error en el bucle principal: %s", e)
+            db.rollback()  # Ninguna conexión queda con la transacción abortada
             time.sleep(5) # Esperar un poco antes de reintentar
 
 # ... (Todo el código de arriba se queda IGUAL, no lo cambies) ...
 
-# ... (Funciones get_db_password, connect_to_db, process_message, main_loop IGUALES) ...
+# ... (Funciones get_db_password, connect_to_db, process_batch, main_loop IGUALES) ...
 
 if __name__ == "__main__":
+    setup_logging()
     # --- Script para crear las tablas (Tarea 11.1) ---
     try:
         password = get_db_password()
-        connection = connect_to_db(password)
-        with connection.cursor() as c:
-            print("Verificando tablas en la base de datos...")
-            
-            # 1. Tabla de Resultados (Ya existía)
-            c.execute("""
-            CREATE TABLE IF NOT EXISTS lab_results (
-                id SERIAL PRIMARY KEY,
-                patient_id VARCHAR(100),
-                test_code VARCHAR(50),
-                test_name VARCHAR(150),
-                value NUMERIC(10, 2),
-                unit VARCHAR(30),
-                test_date TIMESTAMP,
-                ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """)
-            
-            # 2. NUEVA TABLA: Perfiles de Pacientes
-            # Aquí guardaremos lo que capturemos en el registro
-            c.execute("""
-            CREATE TABLE IF NOT EXISTS patient_profiles (
-                patient_id VARCHAR(100) PRIMARY KEY, -- El email o username de Cognito
-                full_name VARCHAR(200),
-                dob DATE,
-                gender VARCHAR(20),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            """)
-            
-            connection.commit()
-            print("✅ Tablas 'lab_results' y 'patient_profiles' listas.")
-            
-        connection.close()
+        for shard in SHARDS:
+            connection = connect_to_db(password, shard)
+            ensure_tables(connection)
+            connection.close()
 
         # Iniciar el bucle del worker
         main_loop()
         
     except Exception as e:
-        print(f"Error crítico al iniciar el worker: {e}")
+        logger.critical("Error crítico al iniciar el worker: %s", e, exc_info=True)
+        flush_logging()
         exit(1)
\ No newline at end of file
@@ -48,7 +48,7 @@ resource "aws_lb_target_group" "backend_tg" {
   target_type = "ip" 
 
   health_check {
-    path                = "/" # Ruta raíz de FastAPI
+    path                = "/health/ready" # Readiness: arranque terminado + BD respondiendo
     interval            = 30
     timeout             = 5
     healthy_threshold   = 2
@@ -134,6 +134,28 @@ resource "aws_lb_listener_rule" "api_routing_part_2" {
   }
 }
 
+# --- 5C. Reglas de Ruteo API (Parte 3: Salud y tiempo real) ---
+# Sondas de salud (para verificarlas desde afuera; el ALB usa las suyas contra el target group)
+# y el stream SSE de resultados (el keepalive del API mantiene viva la conexión ante el idle timeout)
+resource "aws_lb_listener_rule" "api_routing_part_3" {
+  listener_arn = aws_lb_listener.http.arn
+  priority     = 102
+
+  action {
+    type             = "forward"
+    target_group_arn = aws_lb_target_group.backend_tg.arn
+  }
+
+  condition {
+    path_pattern {
+      values = [
+        "/health/*",
+        "/events/*"
+      ]
+    }
+  }
+}
+
 # --- 6. Output ---
 output "alb_dns_name" {
   description = "La URL publica del Balanceador de Carga"
@@ -2,6 +2,12 @@
 resource "aws_ecs_cluster" "main_cluster" {
   name = "healthtrends-cluster"
 
+  # RunningTaskCount por servicio (lo usa el autoescalado del processor)
+  setting {
+    name  = "containerInsights"
+    value = "enabled"
+  }
+
   tags = {
     Name = "healthtrends-cluster"
   }
@@ -30,7 +36,9 @@ resource "aws_ecs_task_definition" "processor_task" {
       environment = [
         { name = "SQS_QUEUE_URL", value = aws_sqs_queue.new_results_queue.id },
         { name = "DB_SECRET_ARN", value = aws_secretsmanager_secret.db_password_secret.arn },
-        { name = "DB_HOST",       value = aws_db_instance.main_db.address }
+        { name = "DB_HOST",       value = aws_db_instance.main_db.address },
+        { name = "DB_SHARDS",     value = var.db_shards },
+        { name = "CLOUDWATCH_NAMESPACE", value = "HealthTrends/Processor" }
       ]
 
       logConfiguration = {
@@ -58,6 +66,82 @@ resource "aws_ecs_service" "processor_service" {
     security_groups  = [aws_security_group.ecs_sg.id]
     assign_public_ip = false
   }
+
+  # El número de tareas lo gobierna el autoescalado
+  lifecycle {
+    ignore_changes = [desired_count]
+  }
+}
+
+# --- Autoescalado del Processor por backlog de la cola ---
+# Target tracking sobre "mensajes visibles por tarea". El objetivo sale de datos medidos:
+#   ritmo de un worker (benchmark.py / worker_processing_rate) x lag aceptable en segundos.
+# services/processor/autoscale_sim.py simula la política antes de tocar estos valores.
+resource "aws_appautoscaling_target" "processor_target" {
+  service_namespace  = "ecs"
+  resource_id        = "service/${aws_ecs_cluster.main_cluster.name}/${aws_ecs_service.processor_service.name}"
+  scalable_dimension = "ecs:service:DesiredCount"
+  min_capacity       = var.processor_min_tasks
+  max_capacity       = var.processor_max_tasks
+}
+
+resource "aws_appautoscaling_policy" "processor_backlog_per_task" {
+  name               = "healthtrends-processor-backlog-per-task"
+  policy_type        = "TargetTrackingScaling"
+  service_namespace  = aws_appautoscaling_target.processor_target.service_namespace
+  resource_id        = aws_appautoscaling_target.processor_target.resource_id
+  scalable_dimension = aws_appautoscaling_target.processor_target.scalable_dimension
+
+  target_tracking_scaling_policy_configuration {
+    target_value       = var.processor_messages_per_second * var.processor_target_lag_seconds
+    scale_out_cooldown = 120
+    scale_in_cooldown  = 300
+
+    customized_metric_specification {
+      metrics {
+        id          = "visible"
+        return_data = false
+        metric_stat {
+          metric {
+            namespace   = "AWS/SQS"
+            metric_name = "ApproximateNumberOfMessagesVisible"
+            dimensions {
+              name  = "QueueName"
+              value = aws_sqs_queue.new_results_queue.name
+            }
+          }
+          stat = "Sum"
+        }
+      }
+
+      metrics {
+        id          = "tasks"
+        return_data = false
+        metric_stat {
+          metric {
+            namespace   = "ECS/ContainerInsights"
+            metric_name = "RunningTaskCount"
+            dimensions {
+              name  = "ClusterName"
+              value = aws_ecs_cluster.main_cluster.name
+            }
+            dimensions {
+              name  = "ServiceName"
+              value = aws_ecs_service.processor_service.name
+            }
+          }
+          stat = "Average"
+        }
+      }
+
+      metrics {
+        id          = "backlog_per_task"
+        label       = "Mensajes visibles por tarea"
+        expression  = "visible / IF(tasks > 0, tasks, 1)"
+        return_data = true
+      }
+    }
+  }
 }
 
 # Grupo de Seguridad para Processor (Worker)
@@ -112,16 +196,32 @@ resource "aws_ecs_task_definition" "portal_task" {
         {
           containerPort = 80
           hostPort      = 80
+        },
+        {
+          # /metrics de Prometheus: portal_sg no abre este puerto al ALB (solo scraper interno)
+          containerPort = 9100
+          hostPort      = 9100
         }
       ]
 
       environment = [
         { name = "DB_SECRET_ARN", value = aws_secretsmanager_secret.db_password_secret.arn },
         { name = "DB_HOST",       value = aws_db_instance.main_db.address },
+        { name = "DB_SHARDS",     value = var.db_shards },
         { name = "USER_POOL_ID",  value = aws_cognito_user_pool.user_pool.id },
-        { name = "APP_CLIENT_ID", value = aws_cognito_user_pool_client.app_client.id }
+        { name = "APP_CLIENT_ID", value = aws_cognito_user_pool_client.app_client.id },
+        { name = "METRICS_PORT",  value = "9100" }
       ]
 
+      # Liveness: solo reinicia la tarea si el proceso deja de responder (la BD no cuenta)
+      healthCheck = {
+        command     = ["CMD-SHELL", "python -c \"import urllib.request; urllib.request.urlopen('http://localhost/health/live', timeout=3)\" || exit 1"]
+        interval    = 30
+        timeout     = 5
+        retries     = 3
+        startPeriod = 30
+      }
+
       logConfiguration = {
         logDriver = "awslogs"
         options = {
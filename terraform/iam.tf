@@ -91,6 +91,15 @@ resource "aws_iam_role_policy" "ecs_processor_policy" {
         Effect   = "Allow",
         Resource = aws_secretsmanager_secret.db_password_secret.arn
       },
+      {
+        # Métricas de la cola y del lag (autoescalado); la acción no admite ARN de recurso
+        Action   = "cloudwatch:PutMetricData",
+        Effect   = "Allow",
+        Resource = "*",
+        Condition = {
+          StringEquals = { "cloudwatch:namespace" = "HealthTrends/Processor" }
+        }
+      },
       {
         # ECR y Logs
         Action = [
@@ -21,6 +21,13 @@ resource "aws_lambda_function" "ingest_lambda" {
   handler = "handler.lambda_handler" # Archivo: handler.py, Función: lambda_handler
   runtime = "python3.11"           # O la versión de Python que prefieras
 
+  # Logs estructurados en JSON (el runtime agrega requestId y nivel a cada línea)
+  logging_config {
+    log_format            = "JSON"
+    application_log_level = "INFO"
+    system_log_level      = "WARN"
+  }
+
   # ¡Clave! Pasa la URL de SQS a nuestro código Python
   environment {
     variables = {
@@ -54,6 +61,12 @@ resource "aws_lambda_function" "post_confirmation_trigger" {
   role             = aws_iam_role.lambda_trigger_role.arn
   handler          = "handler.lambda_handler"
   runtime          = "python3.11"
+
+  logging_config {
+    log_format            = "JSON"
+    application_log_level = "INFO"
+    system_log_level      = "WARN"
+  }
 }
 
 # --- Permiso: Dejar que Cognito invoque esta Lambda ---
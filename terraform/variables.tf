@@ -19,4 +19,36 @@ variable "allowed_ips" {
   description = "Lista de IPs permitidas para acceder al Frontend (formato CIDR)"
   type        = list(string)
   default     = ["0.0.0.0/0"] # CAMBIA ESTO por tu IP pública, ej: ["201.123.45.67/32"]
-}
\ No newline at end of file
+}
+
+# --- Autoescalado del Processor (ver services/processor/autoscale_sim.py) ---
+variable "processor_min_tasks" {
+  description = "Tareas mínimas del worker de ingesta."
+  type        = number
+  default     = 1
+}
+
+variable "processor_max_tasks" {
+  description = "Tareas máximas del worker de ingesta (ojo con las conexiones de RDS)."
+  type        = number
+  default     = 10
+}
+
+variable "processor_messages_per_second" {
+  description = "Mensajes/s que procesa UNA tarea, medido con benchmark.py o worker_processing_rate."
+  type        = number
+  default     = 500
+}
+
+variable "processor_target_lag_seconds" {
+  description = "Segundos de backlog aceptables por tarea antes de escalar."
+  type        = number
+  default     = 60
+}
+
+# --- Sharding de pacientes (ver services/app/sharding.py) ---
+variable "db_shards" {
+  description = "\"nombre=host[:puerto][/bd]\" separados por coma; vacío = un solo shard (la instancia main_db). API y worker deben recibir el mismo valor."
+  type        = string
+  default     = ""
+}
@@ -2,6 +2,10 @@ import boto3
 import requests
 import pytest
 import os
+import json
+import time
+import hashlib
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 # 1. Cargar variables de entorno desde el archivo .env
@@ -15,6 +19,8 @@ REGION = os.getenv("AWS_REGION")
 CLIENT_ID = os.getenv("COGNITO_CLIENT_ID")
 USERNAME = os.getenv("TEST_USERNAME")
 PASSWORD = os.getenv("TEST_PASSWORD")
+# Puerto interno de métricas de una tarea del API, p. ej. http://10.0.1.23:9100 (opcional)
+METRICS_URL = os.getenv("METRICS_URL")
 
 # Validación preventiva: Si falta algo en el .env, avisamos antes de empezar
 if not all([API_URL, REGION, CLIENT_ID, USERNAME, PASSWORD]):
@@ -56,6 +62,23 @@ def api_headers(auth_token):
         "Content-Type": "application/json"
     }
 
+# Paciente sobre el que escriben los tests que suben resultados (requieren rol Labs o Admins)
+TEST_PATIENT_ID = os.getenv("TEST_PATIENT_ID", "test-automation-patient")
+
+def upload_results(api_headers, values, test_code="GLUCOSE", test_name="Glucosa", unit="mg/dL"):
+    """Sube resultados del paciente de prueba con fechas nuevas (no se descartan como duplicados)."""
+    start = datetime.now() - timedelta(days=1)
+    payload = [
+        {
+            "patient_id": TEST_PATIENT_ID, "test_code": test_code, "test_name": test_name,
+            "value": value, "unit": unit, "test_date": (start + timedelta(seconds=i)).isoformat(),
+        }
+        for i, value in enumerate(values)
+    ]
+    response = requests.post(f"{API_URL}/lab/upload-results", json=payload, headers=api_headers)
+    assert response.status_code == 200, f"Falló la carga con {response.status_code}: {response.text}"
+    return response.json()
+
 # --- TESTS DE ENDPOINTS ---
 
 def test_health_check():
@@ -112,4 +135,323 @@ def test_create_patient_profile(api_headers):
     
     response = requests.post(url, json=payload, headers=api_headers)
     assert response.status_code == 200 or response.status_code == 201
-    assert "message" in response.json()
\ No newline at end of file
+    assert "message" in response.json()
+
+def test_metrics_not_public():
+    """/metrics no se sirve por el ALB: las métricas viven en el puerto interno METRICS_PORT"""
+    url = f"{API_URL}/metrics"
+    print(f"\nProbando: {url}")
+
+    response = requests.get(url, timeout=5)
+    assert "http_requests_total" not in response.text, "Las métricas Prometheus quedaron expuestas en el listener público"
+
+@pytest.mark.skipif(not METRICS_URL, reason="METRICS_URL no configurada (solo alcanzable desde la VPC)")
+def test_metrics_endpoint():
+    """Verifica que el puerto interno exponga las métricas Prometheus por ruta"""
+    url = f"{METRICS_URL}/metrics"
+    print(f"\nProbando: {url}")
+
+    response = requests.get(url, timeout=5)
+    assert response.status_code == 200, f"Falló con {response.status_code}"
+    assert "http_requests_total" in response.text, "Faltan las métricas por ruta"
+
+def test_conditional_get_trends(api_headers):
+    """GET condicional: mismo ETag -> 304 sin cuerpo; tras una carga nueva el ETag cambia"""
+    upload_results(api_headers, [95.0])
+    for path in ["available_tests", "trends/GLUCOSE"]:
+        url = f"{API_URL}/trends/patient/{TEST_PATIENT_ID}/{path}"
+        print(f"\nProbando: {url}")
+
+        first = requests.get(url, headers=api_headers)
+        assert first.status_code == 200, f"Falló con {first.status_code}: {first.text}"
+        etag = first.headers.get("ETag")
+        assert etag, "La respuesta no trae ETag"
+
+        cached = requests.get(url, headers={**api_headers, "If-None-Match": etag})
+        assert cached.status_code == 304, f"Con el mismo ETag se esperaba 304, llegó {cached.status_code}"
+        assert not cached.content, "Un 304 no lleva cuerpo"
+
+    # Dato nuevo: el ETag viejo ya no vale
+    upload_results(api_headers, [101.0])
+    fresh = requests.get(url, headers={**api_headers, "If-None-Match": etag})
+    assert fresh.status_code == 200, f"Tras la carga se esperaba 200, llegó {fresh.status_code}"
+    assert fresh.headers.get("ETag") != etag, "El ETag no cambió después de la carga"
+
+def test_abnormal_results_pagination(api_headers):
+    """Worklist de anormales: paginar de a 1 da lo mismo que una sola página, sin repetidos ni huecos"""
+    upload_results(api_headers, [250.0, 260.0, 270.0])  # Fuera del rango de GLUCOSE -> bandera 'H'
+    url = f"{API_URL}/patients/abnormal-results"
+    print(f"\nProbando: {url}")
+
+    response = requests.get(url, params={"limit": 10, "test_code": "GLUCOSE"}, headers=api_headers)
+    assert response.status_code == 200, f"Falló con {response.status_code}: {response.text}"
+    expected = response.json()["items"]
+    assert len(expected) >= 3, "No aparecen los resultados anormales recién cargados"
+    assert all(item["abnormal_flag"] for item in expected), "La worklist trae resultados sin bandera"
+
+    pages, cursor = [], None
+    while len(pages) < len(expected):
+        params = {"limit": 1, "test_code": "GLUCOSE"}
+        if cursor:
+            params["cursor"] = cursor
+        page = requests.get(url, params=params, headers=api_headers)
+        assert page.status_code == 200, f"Falló la página {len(pages) + 1} con {page.status_code}: {page.text}"
+        body = page.json()
+        assert len(body["items"]) == 1, "Cada página debería traer exactamente un resultado"
+        pages += body["items"]
+        cursor = body["next_cursor"]
+        assert cursor, "Falta next_cursor con páginas por recorrer"
+
+    keys = [(item["patient_id"], item["id"], item["test_date"]) for item in pages]
+    assert len(set(keys)) == len(keys), "La paginación repitió resultados"
+    assert pages == expected, "Paginar de a 1 no coincide con la página completa (huecos o desorden)"
+
+def test_abnormal_results_bad_cursor(api_headers):
+    """Un cursor mal formado es un 400, no un 500"""
+    for cursor in ["basura", "2024-01-01T00:00:00|no-es-id", "a|b|c|d"]:
+        response = requests.get(f"{API_URL}/patients/abnormal-results", params={"cursor": cursor}, headers=api_headers)
+        assert response.status_code == 400, f"Cursor {cursor!r}: se esperaba 400, llegó {response.status_code}"
+
+
+def test_patient_summary(api_headers):
+    """Resumen del dashboard: una entrada por examen con último valor, cantidad y riesgo; 304 con su ETag"""
+    upload_results(api_headers, [98.0])
+    url = f"{API_URL}/trends/patient/{TEST_PATIENT_ID}/summary"
+    print(f"\nProbando: {url}")
+
+    response = requests.get(url, headers=api_headers)
+    assert response.status_code == 200, f"Falló con {response.status_code}: {response.text}"
+    body = response.json()
+    glucose = next((t for t in body["tests"] if t["test_code"] == "GLUCOSE"), None)
+    assert glucose, "El resumen no incluye GLUCOSE tras cargar resultados"
+    assert glucose["count"] >= 1 and "risk_level" in glucose, "Faltan campos en la entrada del resumen"
+
+    cached = requests.get(url, headers={**api_headers, "If-None-Match": response.headers["ETag"]})
+    assert cached.status_code == 304, f"Con el mismo ETag se esperaba 304, llegó {cached.status_code}"
+
+def test_trend_stats(api_headers):
+    """Estadísticos incrementales: cada carga suma al conteo y actualiza el último valor"""
+    upload_results(api_headers, [90.0])
+    url = f"{API_URL}/trends/patient/{TEST_PATIENT_ID}/trend-stats/GLUCOSE"
+    print(f"\nProbando: {url}")
+
+    before = requests.get(url, headers=api_headers)
+    assert before.status_code == 200, f"Falló con {before.status_code}: {before.text}"
+    for field in ["count", "mean", "stddev", "ewma", "slope_per_day", "last_value"]:
+        assert field in before.json(), f"Falta '{field}' en los estadísticos"
+
+    upload_results(api_headers, [100.0, 110.0])
+    after = requests.get(url, headers=api_headers).json()
+    assert after["count"] == before.json()["count"] + 2, "El conteo no sumó los resultados nuevos"
+
+    missing = requests.get(f"{API_URL}/trends/patient/{TEST_PATIENT_ID}/trend-stats/NO-EXISTE", headers=api_headers)
+    assert missing.status_code == 404, f"Examen sin datos: se esperaba 404, llegó {missing.status_code}"
+
+def test_rollups(api_headers):
+    """Pirámide de rollups: los buckets anuales suman todos los resultados; resolución inválida -> 400"""
+    upload_results(api_headers, [92.0, 96.0])
+    url = f"{API_URL}/trends/patient/{TEST_PATIENT_ID}/rollups/GLUCOSE"
+    print(f"\nProbando: {url}")
+
+    response = requests.get(url, params={"resolution": "year"}, headers=api_headers)
+    assert response.status_code == 200, f"Falló con {response.status_code}: {response.text}"
+    body = response.json()
+    assert body["resolution"] == "year"
+    stats = requests.get(f"{API_URL}/trends/patient/{TEST_PATIENT_ID}/trend-stats/GLUCOSE", headers=api_headers).json()
+    assert sum(b["count"] for b in body["buckets"]) == stats["count"], "Los rollups no cuadran con el total de resultados"
+
+    picked = requests.get(url, params={"min_points": 1}, headers=api_headers)
+    assert picked.status_code == 200 and picked.json()["resolution"] == "year", "Con min_points=1 debería elegir la resolución más gruesa"
+
+    bad = requests.get(url, params={"resolution": "hour"}, headers=api_headers)
+    assert bad.status_code == 400, f"Resolución inválida: se esperaba 400, llegó {bad.status_code}"
+
+def test_analytics(api_headers):
+    """Indicadores de tendencia: una serie por indicador alineada con los puntos; indicador inválido -> 400"""
+    upload_results(api_headers, [94.0, 97.0, 99.0])
+    url = f"{API_URL}/trends/patient/{TEST_PATIENT_ID}/analytics/GLUCOSE"
+    print(f"\nProbando: {url}")
+
+    response = requests.get(url, params={"indicators": "sma:7d,ewma:14d,zscore"}, headers=api_headers)
+    assert response.status_code == 200, f"Falló con {response.status_code}: {response.text}"
+    body = response.json()
+    assert len(body["indicators"]) == 3, f"Se pidieron 3 indicadores, llegaron {list(body['indicators'])}"
+    assert body["returned"] == len(body["timestamps"]) == len(body["values"])
+    for key, values in body["indicators"].items():
+        assert len(values) == body["returned"], f"El indicador {key} no está alineado con los puntos"
+
+    bad = requests.get(url, params={"indicators": "macd"}, headers=api_headers)
+    assert bad.status_code == 400, f"Indicador inválido: se esperaba 400, llegó {bad.status_code}"
+
+def test_columnar_trends(api_headers):
+    """Formato columnar: mismos puntos que el formato por filas, en arrays paralelos; la respuesta grande va comprimida"""
+    upload_results(api_headers, [80.0 + i for i in range(30)])
+    url = f"{API_URL}/trends/patient/{TEST_PATIENT_ID}/trends/GLUCOSE"
+    print(f"\nProbando: {url}")
+
+    rows = requests.get(url, headers={**api_headers, "Accept-Encoding": "gzip"})
+    assert rows.status_code == 200, f"Falló con {rows.status_code}: {rows.text}"
+    assert rows.headers.get("Content-Encoding") == "gzip", "La respuesta grande no vino comprimida"
+    assert "Accept-Encoding" in rows.headers.get("Vary", ""), "Falta Vary: Accept-Encoding"
+
+    response = requests.get(url, params={"format": "columnar"}, headers=api_headers)
+    assert response.status_code == 200, f"Falló con {response.status_code}: {response.text}"
+    body = response.json()
+    assert body["format"] == "columnar"
+    assert len(body["timestamps"]) == len(body["values"]) == len(rows.json()["history"]), "El formato columnar no trae los mismos puntos"
+
+def test_population_percentiles(api_headers):
+    """Percentiles de población desde los sketches: crecientes y con el percentil del paciente"""
+    upload_results(api_headers, [70.0, 90.0, 110.0])
+    url = f"{API_URL}/trends/population/GLUCOSE/percentiles"
+    print(f"\nProbando: {url}")
+
+    response = requests.get(url, params={"patient_id": TEST_PATIENT_ID}, headers=api_headers)
+    assert response.status_code == 200, f"Falló con {response.status_code}: {response.text}"
+    body = response.json()
+    values = list(body["percentiles"].values())
+    assert list(body["percentiles"]) == ["p5", "p25", "p50", "p75", "p95"]
+    assert values == sorted(values), "Los percentiles no son crecientes"
+    assert 0 <= body["patient"]["percentile_rank"] <= 100, "Falta el percentil del paciente"
+
+    bad = requests.get(url, params={"percentiles": "50,150"}, headers=api_headers)
+    assert bad.status_code == 400, f"Percentil fuera de rango: se esperaba 400, llegó {bad.status_code}"
+
+def test_health_probes():
+    """Liveness siempre 200; readiness 200 con la BD respondiendo"""
+    live = requests.get(f"{API_URL}/health/live", timeout=5)
+    assert live.status_code == 200, f"Liveness falló con {live.status_code}"
+    assert live.json()["status"] == "alive"
+
+    ready = requests.get(f"{API_URL}/health/ready", timeout=5)
+    assert ready.status_code == 200, f"Readiness falló con {ready.status_code}: {ready.text}"
+    assert ready.json()["database"] == "ok", f"Algún shard no responde: {ready.json()}"
+
+def test_results_event_stream(api_headers):
+    """SSE: el stream abre con 'ready' y avisa cuando se confirman resultados del paciente"""
+    url = f"{API_URL}/events/results"
+    print(f"\nProbando: {url}")
+
+    with requests.get(url, params={"patient_ids": TEST_PATIENT_ID}, headers=api_headers, stream=True, timeout=30) as stream:
+        assert stream.status_code == 200, f"Falló con {stream.status_code}: {stream.text}"
+        assert stream.headers["Content-Type"].startswith("text/event-stream")
+        events = (line for line in stream.iter_lines(decode_unicode=True) if line.startswith("event: "))
+        assert next(events) == "event: ready", "El stream no abrió con el evento 'ready'"
+
+        upload_results(api_headers, [93.0])
+        assert next(events) == "event: results", "No llegó el aviso de resultados nuevos"
+
+    bad = requests.get(url, params={"patient_ids": " , "}, headers=api_headers)
+    assert bad.status_code == 400, f"Sin pacientes: se esperaba 400, llegó {bad.status_code}"
+
+def test_upload_is_idempotent(api_headers):
+    """Reenviar el mismo lote (reintento tras un timeout) no duplica resultados"""
+    start = datetime.now() - timedelta(days=2)
+    payload = [
+        {
+            "patient_id": TEST_PATIENT_ID, "test_code": "GLUCOSE", "test_name": "Glucosa",
+            "value": 91.0 + i, "unit": "mg/dL", "test_date": (start + timedelta(seconds=i)).isoformat(),
+        }
+        for i in range(3)
+    ]
+    url = f"{API_URL}/lab/upload-results"
+    print(f"\nProbando: {url}")
+
+    first = requests.post(url, json=payload, headers=api_headers)
+    assert first.status_code == 200, f"Falló con {first.status_code}: {first.text}"
+    assert first.json()["inserted"] == 3 and first.json()["duplicates"] == 0
+
+    retry = requests.post(url, json=payload, headers=api_headers)
+    assert retry.status_code == 200, f"El reintento falló con {retry.status_code}: {retry.text}"
+    assert retry.json()["inserted"] == 0, "El reintento volvió a insertar resultados"
+    assert retry.json()["duplicates"] == 3, "El reintento no reportó los duplicados omitidos"
+
+def test_upload_job(api_headers):
+    """Carga por partes: se suben las partes con su SHA-256, se cierra el trabajo y se procesa en segundo plano"""
+    start = datetime.now() - timedelta(days=3)
+    rows = [
+        {
+            "patient_id": TEST_PATIENT_ID, "test_code": "GLUCOSE", "test_name": "Glucosa",
+            "value": 85.0 + i, "unit": "mg/dL", "test_date": (start + timedelta(seconds=i)).isoformat(),
+        }
+        for i in range(4)
+    ]
+    rows[3] = {"patient_id": TEST_PATIENT_ID}  # Fila inválida: se rechaza sin frenar el resto
+    url = f"{API_URL}/lab/upload-jobs"
+    print(f"\nProbando: {url}")
+
+    created = requests.post(url, headers=api_headers)
+    assert created.status_code == 201, f"Falló con {created.status_code}: {created.text}"
+    job_url = f"{url}/{created.json()['job_id']}"
+
+    def put_chunk(seq, chunk, sha=None):
+        data = json.dumps(chunk).encode()
+        headers = {**api_headers, "X-Chunk-SHA256": sha or hashlib.sha256(data).hexdigest()}
+        return requests.put(f"{job_url}/chunks/{seq}", data=data, headers=headers)
+
+    corrupt = put_chunk(0, rows[:2], sha="0" * 64)
+    assert corrupt.status_code == 400, f"Checksum incorrecto: se esperaba 400, llegó {corrupt.status_code}"
+    for seq, chunk in enumerate([rows[:2], rows[2:]]):
+        response = put_chunk(seq, chunk)
+        assert response.status_code == 200, f"Falló la parte {seq} con {response.status_code}: {response.text}"
+
+    complete = requests.post(f"{job_url}/complete", params={"total_chunks": 2}, headers=api_headers)
+    assert complete.status_code == 202, f"Falló el cierre con {complete.status_code}: {complete.text}"
+    for _ in range(60):
+        status = requests.get(job_url, headers=api_headers).json()
+        if status["status"] in ("done", "failed"):
+            break
+        time.sleep(0.5)
+    assert status["status"] == "done", f"El trabajo no terminó bien: {status}"
+    assert status["rows_inserted"] == 3 and status["rows_rejected"] == 1, f"Conteos inesperados: {status}"
+
+def test_slow_queries(api_headers):
+    """Log de queries lentas por huella SQL (puede venir vacío si nada superó SLOW_QUERY_MS)"""
+    url = f"{API_URL}/admin/slow-queries"
+    print(f"\nProbando: {url}")
+
+    response = requests.get(url, params={"limit": 5, "order_by": "mean_ms"}, headers=api_headers)
+    assert response.status_code == 200, f"Falló con {response.status_code}: {response.text}"
+    entries = response.json()
+    assert isinstance(entries, list) and len(entries) <= 5
+    means = [e["mean_ms"] for e in entries]
+    assert means == sorted(means, reverse=True), "Las queries no vienen ordenadas por order_by"
+    for e in entries:
+        assert {"fingerprint", "count", "max_ms", "routes", "last_plan"} <= set(e), f"Faltan campos: {e}"
+
+    bad = requests.get(url, params={"order_by": "fingerprint"}, headers=api_headers)
+    assert bad.status_code == 422, f"order_by inválido: se esperaba 422, llegó {bad.status_code}"
+
+def test_profile_import(api_headers):
+    """Importación de perfiles en CSV: filas inválidas se reportan; reimportar lo mismo no cambia nada"""
+    body = (
+        "patient_id,full_name,dob,gender,email\n"
+        "test-import-1,Paciente Importado Uno,1980-05-17,F,uno@example.com\n"
+        "test-import-2,Paciente Importado Dos,1975-11-02,M,\n"
+        "test-import-3,Fecha Mala,17/05/1980,F,\n"
+    ).encode()
+    url = f"{API_URL}/admin/profiles/import"
+    print(f"\nProbando: {url}")
+
+    headers = {**api_headers, "Content-Type": "text/csv"}
+    first = requests.post(url, data=body, headers=headers)
+    assert first.status_code == 200, f"Falló con {first.status_code}: {first.text}"
+    result = first.json()
+    assert result["received"] == 3 and result["rejected"] == 1, f"Conteos inesperados: {result}"
+    assert result["inserted"] + result["updated"] + result["unchanged"] == 2
+    assert result["errors"], "La fila con fecha inválida no se reportó"
+
+    again = requests.post(url, data=body, headers=headers).json()
+    assert again["unchanged"] == 2 and again["inserted"] == again["updated"] == 0, f"Reimportar modificó perfiles: {again}"
+
+def test_bulk_assign_roles_validation(api_headers):
+    """Asignación masiva de roles: los lotes inválidos se rechazan antes de tocar Cognito"""
+    url = f"{API_URL}/admin/assign-roles"
+    print(f"\nProbando: {url}")
+
+    empty = requests.post(url, json={"assignments": []}, headers=api_headers)
+    assert empty.status_code == 400, f"Lote vacío: se esperaba 400, llegó {empty.status_code}"
+
+    repeated = [{"email": "uno@example.com", "role": "Doctors"}, {"email": " UNO@example.com", "role": "Labs"}]
+    response = requests.post(url, json={"assignments": repeated}, headers=api_headers)
+    assert response.status_code == 400, f"Emails repetidos: se esperaba 400, llegó {response.status_code}"
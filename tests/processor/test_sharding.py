@@ -0,0 +1,49 @@
+import os
+import sys
+import pytest
+
+# El worker lleva su propia copia del anillo de hash (su imagen no incluye el paquete app).
+# Si las dos copias no dan el mismo shard para un paciente, el worker escribe donde la
+# API no lee: estos tests comparan ambas con las mismas topologías.
+SERVICES = os.path.join(os.path.dirname(__file__), "..", "..", "services")
+sys.path.insert(0, os.path.abspath(SERVICES))
+sys.path.insert(0, os.path.abspath(os.path.join(SERVICES, "processor")))
+
+from app import sharding as api_sharding  # noqa: E402
+import sharding as worker_sharding  # noqa: E402  (services/processor/sharding.py)
+
+TOPOLOGIES = [
+    "s0=db-a",
+    "s0=db-a,s1=db-b",
+    "s0=db-a,s1=db-b:5433/pacientes,s2=db-c",
+    "norte=10.0.0.1,sur=10.0.0.2,este=10.0.0.3,oeste=10.0.0.4/historico",
+]
+PATIENT_IDS = [f"patient-{i}" for i in range(2000)] + ["", "ñandú@example.com", "550e8400-e29b-41d4-a716-446655440000"]
+
+@pytest.mark.parametrize("spec", TOPOLOGIES)
+def test_parse_shards_parity(spec):
+    """Mismo DB_SHARDS -> mismos shards (nombre, host, puerto, BD) en la API y en el worker"""
+    api = api_sharding.parse_shards(spec, "default-host", "postgres")
+    worker = worker_sharding.parse_shards(spec, "default-host", "postgres")
+    assert [tuple(s) for s in api] == [tuple(s) for s in worker]
+
+@pytest.mark.parametrize("spec", TOPOLOGIES)
+@pytest.mark.parametrize("vnodes", [1, 16, 128])
+def test_ring_lookup_parity(spec, vnodes):
+    """Cada paciente cae en el mismo shard según los dos anillos"""
+    api_ring = api_sharding.HashRing(api_sharding.parse_shards(spec, "h", "postgres"), vnodes=vnodes)
+    worker_ring = worker_sharding.HashRing(worker_sharding.parse_shards(spec, "h", "postgres"), vnodes=vnodes)
+    mismatches = [pid for pid in PATIENT_IDS if api_ring.lookup(pid).name != worker_ring.lookup(pid).name]
+    assert not mismatches, f"{len(mismatches)} pacientes van a shards distintos, p. ej. {mismatches[:5]}"
+
+def test_default_vnodes_parity():
+    """SHARD_VNODES por defecto igual en los dos lados"""
+    assert api_sharding.SHARD_VNODES == worker_sharding.SHARD_VNODES
+
+@pytest.mark.parametrize("spec", ["s0=db-a,s0=db-b", "s0=db-a,s1=db-b,s1=db-c", "s0", "=db-a"])
+def test_invalid_specs_rejected_by_both(spec):
+    """Una topología inválida (nombres repetidos, sin host) la rechazan los dos"""
+    with pytest.raises(ValueError):
+        api_sharding.parse_shards(spec, "h", "postgres")
+    with pytest.raises(ValueError):
+        worker_sharding.parse_shards(spec, "h", "postgres")